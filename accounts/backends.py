@@ -0,0 +1,34 @@
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import User
+from django.db.models import Value
+from django.db.models.functions import Lower
+
+
+class EmailBackend(ModelBackend):
+    """
+    Log in with an email address instead of a username. The address is
+    matched case-insensitively in one query served by the LOWER(email)
+    index (accounts migration 0006); if several accounts share it, the most
+    recently joined one is used. Username logins (the admin) fall through
+    to ModelBackend.
+    """
+
+    def authenticate(self, request, username=None, password=None, email=None, **kwargs):
+        if email is None:
+            return super().authenticate(request, username=username, password=password, **kwargs)
+        if not email or password is None:
+            return None
+
+        user = (
+            User.objects.annotate(email_lower=Lower('email'))
+            .filter(email_lower=Lower(Value(email.strip())))
+            .order_by('-date_joined')
+            .first()
+        )
+        if user is None:
+            # Hash anyway so an unknown address takes as long as a wrong password
+            User().set_password(password)
+            return None
+        if user.check_password(password) and self.user_can_authenticate(user):
+            return user
+        return None
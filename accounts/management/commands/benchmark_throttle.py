@@ -0,0 +1,80 @@
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.contrib.sessions.backends.signed_cookies import SessionStore
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from accounts import throttle
+from accounts.views import custom_login
+
+
+class Command(BaseCommand):
+    help = 'Time login attempts that are rejected by the throttle against ones that reach password hashing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=50, help='Timed attempts per case')
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        self.stdout.write(f'Throttle cache: {type(throttle._cache()).__name__}')
+        factory = RequestFactory()
+
+        def attempt(email, ip):
+            request = factory.post('/login/', {'email': email, 'password': 'wrong password'}, REMOTE_ADDR=ip)
+            request.user = _Anonymous()
+            request.session = SessionStore()
+            request._messages = FallbackStorage(request)
+            return custom_login(request)
+
+        with transaction.atomic():
+            User.objects.create_user('bench_throttle', 'bench-throttle@example.com', 'right password')
+
+            # Each wrong-password attempt gets a fresh IP and email bucket, so every one is hashed
+            hashed = self.time(lambda i: attempt('bench-throttle@example.com', f'198.51.100.{i % 250}'), repeat,
+                               before=lambda: throttle.reset(
+                                   (throttle.LOGIN_PER_EMAIL, 'bench-throttle@example.com')))
+
+            # Drain one IP's bucket, then time attempts it rejects
+            ip = '203.0.113.7'
+            while attempt(f'drain-{time.time_ns()}@example.com', ip).status_code != 429:
+                pass
+            with CaptureQueriesContext(connection) as queries:
+                rejected = self.time(lambda i: attempt('bench-throttle@example.com', ip), repeat)
+
+            transaction.set_rollback(True)
+
+        throttle.reset((throttle.LOGIN_PER_IP, ip), (throttle.LOGIN_PER_EMAIL, 'bench-throttle@example.com'))
+        for i in range(250):
+            throttle.reset((throttle.LOGIN_PER_IP, f'198.51.100.{i}'))
+
+        self.write_timings('wrong password (hashed)', hashed)
+        self.write_timings('throttled (rejected)', rejected)
+        self.stdout.write(f'Queries during {repeat} rejected attempts: {len(queries)}')
+        self.stdout.write(self.style.SUCCESS(
+            f'A rejected attempt costs {statistics.median(rejected) / statistics.median(hashed):.1%} '
+            f'of a hashed one'
+        ))
+
+    def time(self, func, repeat, before=None):
+        timings = []
+        for i in range(repeat):
+            if before:
+                before()
+            start = time.perf_counter()
+            func(i)
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
+
+    def write_timings(self, label, timings):
+        self.stdout.write(
+            f'{label}: median {statistics.median(timings):.2f} ms, '
+            f'min {min(timings):.2f} ms, max {max(timings):.2f} ms'
+        )
+
+
+class _Anonymous:
+    is_authenticated = False
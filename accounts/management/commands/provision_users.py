@@ -0,0 +1,172 @@
+import csv
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+from operator import or_
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group, User
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.core.validators import validate_email
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.functions import Lower
+from accounts.forms import validate_password_strength
+from accounts.models import TrainerProfile
+
+
+def _hash(password):
+    return make_password(password)
+
+
+class Command(BaseCommand):
+    help = 'Create user accounts, trainer profiles and group memberships in bulk from a CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_file',
+                            help='CSV with email, first_name, last_name, password, pu_code, designation '
+                                 'and optional supervisor (email) columns')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Processes hashing passwords (default: one per CPU)')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of rows inserted per query')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Validate the file without creating anything')
+
+    def handle(self, *args, **options):
+        rows = self.read(options['csv_file'])
+        existing = set(
+            User.objects.annotate(email_lower=Lower('email'))
+            .filter(email_lower__in=[row['email'].lower() for _, row in rows])
+            .values_list('email_lower', flat=True)
+        )
+        supervisors = self.supervisors(rows)
+
+        accepted, rejects, seen = [], [], set()
+        for line, row in rows:
+            error = self.validate(row, existing, seen, supervisors)
+            if error:
+                rejects.append((line, error))
+            else:
+                seen.add(row['email'].lower())
+                accepted.append(row)
+
+        for line, error in rejects:
+            self.stdout.write(self.style.WARNING(f'  line {line}: {error}'))
+        if options['dry_run'] or not accepted:
+            self.stdout.write(self.style.WARNING(
+                f'{"Dry run: " if options["dry_run"] else ""}{len(accepted)} users would be created, '
+                f'{len(rejects)} rows rejected'
+            ))
+            return
+
+        usernames = self.usernames([row['email'] for row in accepted])
+        # PBKDF2 is CPU-bound, so spread it over processes rather than threads
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=django.setup) as pool:
+            passwords = list(pool.map(_hash, [row['password'] for row in accepted], chunksize=16))
+
+        batch_size = options['batch_size']
+        with transaction.atomic():
+            # bulk_create skips the create_profile signal, so profiles are inserted here
+            users = User.objects.bulk_create([
+                User(username=username, email=row['email'], first_name=row['first_name'],
+                     last_name=row['last_name'], password=password, is_active=True)
+                for row, username, password in zip(accepted, usernames, passwords)
+            ], batch_size=batch_size)
+
+            TrainerProfile.objects.bulk_create([
+                TrainerProfile(user=user, pu_code=row['pu_code'] or None, designation=row['designation'],
+                               supervisor_id=supervisors.get(row['supervisor'].lower()))
+                for user, row in zip(users, accepted)
+            ], batch_size=batch_size)
+
+            groups = {}
+            for designation in {row['designation'] for row in accepted}:
+                groups[designation], _ = Group.objects.get_or_create(name=designation)
+            User.groups.through.objects.bulk_create([
+                User.groups.through(user_id=user.pk, group_id=groups[row['designation']].pk)
+                for user, row in zip(users, accepted)
+            ], batch_size=batch_size)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Successfully created {len(users)} users, {len(rejects)} rows rejected'
+        ))
+
+    def read(self, path):
+        """[(line number, row)] with stripped values and defaults filled in"""
+        try:
+            with open(path, newline='', encoding='utf-8-sig') as handle:
+                reader = csv.DictReader(handle)
+                if 'email' not in (reader.fieldnames or ()):
+                    raise CommandError('CSV needs at least an email column')
+                rows = []
+                for line, row in enumerate(reader, start=2):
+                    row = {key: (value or '').strip() for key, value in row.items() if key}
+                    row.setdefault('designation', '')
+                    row['designation'] = row['designation'] or 'WT'
+                    for column in ('first_name', 'last_name', 'password', 'pu_code', 'supervisor'):
+                        row.setdefault(column, '')
+                    rows.append((line, row))
+                return rows
+        except OSError as e:
+            raise CommandError(f'Cannot read {path}: {e}')
+
+    def supervisors(self, rows):
+        """{lowercase email: user id} for the supervisors named in the file, in one query"""
+        emails = {row['supervisor'].lower() for _, row in rows if row['supervisor']}
+        if not emails:
+            return {}
+        found = (
+            User.objects.annotate(email_lower=Lower('email'))
+            .filter(email_lower__in=emails)
+            .order_by('date_joined')
+            .values_list('email_lower', 'id')
+        )
+        # Newest account wins for shared addresses, as in EmailBackend
+        return dict(found)
+
+    def validate(self, row, existing, seen, supervisors):
+        email = row['email'].lower()
+        try:
+            validate_email(row['email'])
+        except ValidationError:
+            return f'Invalid email "{row["email"]}"'
+        if email in existing:
+            return f'{row["email"]} is already registered'
+        if email in seen:
+            return f'{row["email"]} appears more than once in this file'
+        if row['designation'] not in dict(TrainerProfile.DESIGNATION_CHOICES):
+            return f'Unknown designation "{row["designation"]}"'
+        if row['designation'] in ('PUM', 'WT') and not row['pu_code']:
+            return 'PU Code is required for PUM and WT designations.'
+        if row['supervisor'] and row['supervisor'].lower() not in supervisors:
+            return f'Unknown supervisor "{row["supervisor"]}"'
+        if not row['password']:
+            return 'Password is required.'
+        try:
+            validate_password_strength(row['password'])
+        except ValidationError as e:
+            return ' '.join(e.messages)
+        return None
+
+    def usernames(self, emails):
+        """
+        A unique username per email, derived as verify_email does (local
+        part, then local part + 1, 2, ...), from one query over all prefixes.
+        """
+        bases = [re.sub(r'[^\w.@+-]', '', email.split('@')[0])[:140] or 'user' for email in emails]
+        taken = set(
+            User.objects.filter(reduce(or_, (Q(username__startswith=base) for base in set(bases))))
+            .values_list('username', flat=True)
+        )
+        usernames = []
+        for base in bases:
+            username, counter = base, 1
+            while username in taken:
+                username = f'{base}{counter}'
+                counter += 1
+            taken.add(username)
+            usernames.append(username)
+        return usernames
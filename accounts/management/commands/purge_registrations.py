@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from accounts.models import EmailVerification, PendingUserRegistration
+
+
+class Command(BaseCommand):
+    help = 'Delete expired pending registrations and verified or stale email verifications in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of rows deleted per query')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - PendingUserRegistration.EXPIRY
+        pending = self.purge(
+            PendingUserRegistration.objects.filter(created_at__lt=cutoff), options['batch_size'],
+        )
+        verifications = self.purge(
+            EmailVerification.objects.filter(is_verified=True)
+            | EmailVerification.objects.filter(is_verified=False, created_at__lt=cutoff),
+            options['batch_size'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Deleted {pending} expired pending registrations and {verifications} stale email verifications'
+        ))
+
+    def purge(self, queryset, batch_size):
+        # Short deletes by primary key instead of one long-running statement over the whole table
+        deleted = 0
+        while True:
+            ids = list(queryset.values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                return deleted
+            count, _ = queryset.model.objects.filter(pk__in=ids).delete()
+            deleted += count
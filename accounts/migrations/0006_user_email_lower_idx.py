@@ -0,0 +1,17 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0005_pendinguserregistration_designation_and_more'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    # auth.User belongs to another app, so its index for EmailBackend's lookup is created here
+    operations = [
+        migrations.RunSQL(
+            sql='CREATE INDEX accounts_user_email_lower_idx ON auth_user (LOWER(email));',
+            reverse_sql='DROP INDEX accounts_user_email_lower_idx;',
+        ),
+    ]
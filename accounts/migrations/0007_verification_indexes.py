@@ -0,0 +1,33 @@
+# Generated by Django 6.0 on 2026-10-18 18:15
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0006_user_email_lower_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailverification',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='emailverification',
+            index=models.Index(fields=['is_verified', 'created_at'], name='verification_stale_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pendinguserregistration',
+            index=models.Index(fields=['email', 'verification_code'], name='pending_email_code_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pendinguserregistration',
+            index=models.Index(fields=['created_at'], name='pending_created_idx'),
+        ),
+    ]
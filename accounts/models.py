@@ -50,6 +50,8 @@ class TrainerProfile(models.Model):
 
 class PendingUserRegistration(models.Model):
     """Temporarily stores registration data until email is verified"""
+    EXPIRY = timedelta(hours=24)
+
     email = models.EmailField(unique=True)
     first_name = models.CharField(max_length=30)
     last_name = models.CharField(max_length=30)
@@ -62,7 +64,7 @@ class PendingUserRegistration(models.Model):
     
     def is_expired(self):
         """Check if registration link has expired (24 hours)"""
-        expiration_time = self.created_at + timedelta(hours=24)
+        expiration_time = self.created_at + self.EXPIRY
         return timezone.now() > expiration_time
     
     def save(self, *args, **kwargs):
@@ -77,12 +79,25 @@ class PendingUserRegistration(models.Model):
     class Meta:
         verbose_name = "Pending User Registration"
         verbose_name_plural = "Pending User Registrations"
+        indexes = [
+            # verify_email: one row probe by (email, code)
+            models.Index(fields=['email', 'verification_code'], name='pending_email_code_idx'),
+            # purge_registrations: expired rows
+            models.Index(fields=['created_at'], name='pending_created_idx'),
+        ]
 
 
 class EmailVerification(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     code = models.CharField(max_length=6, blank=True)
     is_verified = models.BooleanField(default=False)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # purge_registrations: verified or stale rows
+            models.Index(fields=['is_verified', 'created_at'], name='verification_stale_idx'),
+        ]
 
     def save(self, *args, **kwargs):
         if not self.code:
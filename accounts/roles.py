@@ -0,0 +1,131 @@
+"""
+Role resolution.
+
+A user's designation, PU code and group names are loaded with one query
+and kept in their session as claims (RolesMiddleware hands roles_for the
+session). The session is read on every request anyway, so role checks
+cost no queries; the claims are also memoised on the user object for the
+rest of the request. Claims are reloaded once they are CLAIMS_TTL
+seconds old, so a role change made through any process reaches every
+session within that time. Changes made in this process (see signals.py)
+take effect for its requests straight away.
+"""
+import time
+
+from django.contrib.auth.models import User
+
+from .models import TrainerProfile
+
+SESSION_KEY = '_roles'
+# Seconds a session trusts its claims before reloading them
+CLAIMS_TTL = 60
+
+# Groups whose members pass accounts.utils.is_admin
+ADMIN_GROUPS = ('Admin', 'Project Manager', 'Monitoring Manager', 'Supervisor')
+
+
+class Roles:
+    """Permission claims of one user"""
+
+    def __init__(self, claims):
+        self.has_profile = claims.get('has_profile', False)
+        self.designation = claims.get('designation')
+        self.pu_code = claims.get('pu_code')
+        self.groups = frozenset(claims.get('groups', ()))
+        self.is_superuser = claims.get('is_superuser', False)
+
+    @property
+    def is_admin_designation(self):
+        """PM, PRC, GE or IT designation (TrainerProfile.is_admin)"""
+        return self.has_profile and self.designation in TrainerProfile.ADMIN_DESIGNATIONS
+
+    @property
+    def in_admin_group(self):
+        """Superuser or member of an admin group (accounts.utils.is_admin)"""
+        return self.is_superuser or bool(self.groups.intersection(ADMIN_GROUPS))
+
+    @property
+    def is_admin(self):
+        """Dashboard admin: by designation, or by group for users without a profile"""
+        return self.is_admin_designation if self.has_profile else self.in_admin_group
+
+    @property
+    def is_pum(self):
+        return self.has_profile and self.designation == 'PUM'
+
+    @property
+    def is_wt(self):
+        return self.has_profile and self.designation == 'WT'
+
+    @property
+    def is_supervisor(self):
+        return 'Supervisor' in self.groups
+
+    @property
+    def is_trainer(self):
+        return 'Trainer' in self.groups
+
+    @property
+    def is_staff(self):
+        """Sees other trainers' records on the dashboard"""
+        return self.is_admin or self.is_supervisor or self.is_pum
+
+
+ANONYMOUS = Roles({})
+
+
+_changed_at = 0.0  # time.time() of the last role change made in this process
+
+
+def invalidate():
+    """Reload claims loaded before now, e.g. after a profile or group changed"""
+    global _changed_at
+    _changed_at = time.time()
+
+
+def load(user_id):
+    """Claims for a user straight from the database, in one query"""
+    rows = User.objects.filter(pk=user_id).values_list(
+        'is_superuser', 'trainerprofile__id', 'trainerprofile__designation', 'trainerprofile__pu_code', 'groups__name',
+    )
+    claims = {'has_profile': False, 'designation': None, 'pu_code': None, 'groups': [], 'is_superuser': False}
+    for is_superuser, profile_id, designation, pu_code, group in rows:
+        claims.update(is_superuser=is_superuser, has_profile=profile_id is not None,
+                      designation=designation, pu_code=pu_code)
+        if group:
+            claims['groups'].append(group)
+    return claims
+
+
+def roles_for(user):
+    """The user's Roles, resolved at most once per user object (i.e. per request)"""
+    if user is None or not user.is_authenticated:
+        return ANONYMOUS
+    roles = getattr(user, '_roles', None)
+    if roles is not None:
+        return roles
+
+    session = getattr(user, '_roles_session', None)
+    entry = session.get(SESSION_KEY) if session is not None else None
+    now = time.time()
+    if entry and entry['user'] == user.pk and entry['loaded_at'] > max(_changed_at, now - CLAIMS_TTL):
+        claims = entry['claims']
+    else:
+        claims = load(user.pk)
+        if session is not None:
+            session[SESSION_KEY] = {'user': user.pk, 'loaded_at': now, 'claims': claims}
+
+    user._roles = Roles(claims)
+    return user._roles
+
+
+class RolesMiddleware:
+    """Lets roles_for() keep the request user's claims in their session"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.user.is_authenticated:
+            request.user._roles_session = request.session
+        return self.get_response(request)
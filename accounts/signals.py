@@ -1,9 +1,43 @@
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
-from django.contrib.auth.models import User
+from django.contrib.auth.models import Group, User
 from .models import TrainerProfile
+from . import roles
 
 @receiver(post_save, sender=User)
 def create_profile(sender, instance, created, **kwargs):
     if created:
         TrainerProfile.objects.create(user=instance)
+
+
+def _invalidate():
+    roles.invalidate()
+    # A request may reload the old claims before this transaction commits
+    transaction.on_commit(roles.invalidate)
+
+
+@receiver(post_save, sender=User)
+def user_changed(sender, instance, created, update_fields=None, **kwargs):
+    # Logins only touch last_login, which no claim depends on
+    if not created and update_fields != frozenset(['last_login']):
+        _invalidate()
+
+
+@receiver(post_save, sender=TrainerProfile)
+@receiver(post_delete, sender=TrainerProfile)
+def profile_changed(sender, instance, **kwargs):
+    _invalidate()
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def groups_changed(sender, instance, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        _invalidate()
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def group_changed(sender, instance, **kwargs):
+    if not kwargs.get('created'):
+        _invalidate()
@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.mail import send_mail
+from jobs.queue import task
+from .models import PendingUserRegistration
+
+
+@task('accounts.send_verification_email')
+def send_verification_email(pending_id):
+    """Email the current verification code for a pending registration"""
+    pending_registration = PendingUserRegistration.objects.filter(pk=pending_id).first()
+    if pending_registration is None:
+        # Already verified or expired and removed
+        return
+
+    send_mail(
+        subject='Verify your email - CabiRos',
+        message=f'Hello {pending_registration.first_name},\n\nYour verification code is: {pending_registration.verification_code}\n\nPlease enter this code to complete your registration. This code will expire in 24 hours.',
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        recipient_list=[pending_registration.email],
+        fail_silently=False,
+    )
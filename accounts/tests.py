@@ -1,3 +1,134 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import Group, User
+from django.contrib.sessions.backends.db import SessionStore
+from django.test import RequestFactory, TestCase, override_settings
+
+from . import roles, throttle
+
+
+class RolesTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('trainer', 'trainer@example.com', 'password')
+        self.session = SessionStore()
+
+    def request_user(self):
+        """The user as the next request sees it: a fresh object bound to the session"""
+        user = User.objects.get(pk=self.user.pk)
+        user._roles_session = self.session
+        return user
+
+    def test_warm_role_checks_cost_no_queries(self):
+        user = self.request_user()
+        with self.assertNumQueries(1):
+            roles.roles_for(user)
+        user = self.request_user()
+        with self.assertNumQueries(0):
+            self.assertFalse(roles.roles_for(user).is_supervisor)
+            self.assertFalse(roles.roles_for(user).is_admin)
+
+    def test_dashboard_requests_do_not_query_roles(self):
+        self.client.force_login(self.user)
+        self.client.get('/mileage/dashboard/')
+        with mock.patch.object(roles, 'load', wraps=roles.load) as load:
+            response = self.client.get('/mileage/dashboard/')
+        self.assertEqual(response.status_code, 200)
+        load.assert_not_called()
+
+    def test_role_change_in_this_process_applies_immediately(self):
+        roles.roles_for(self.request_user())
+        self.user.groups.add(Group.objects.create(name='Supervisor'))
+        self.assertTrue(roles.roles_for(self.request_user()).is_supervisor)
+
+        profile = self.user.trainerprofile
+        profile.designation = 'PM'
+        profile.save()
+        self.assertTrue(roles.roles_for(self.request_user()).is_admin)
+
+    def test_change_from_another_process_applies_after_the_ttl(self):
+        roles.roles_for(self.request_user())
+        # Another process adds the group: no signal reaches this one
+        with mock.patch.object(roles, 'invalidate'):
+            self.user.groups.add(Group.objects.create(name='Supervisor'))
+        self.assertFalse(roles.roles_for(self.request_user()).is_supervisor)
+
+        with mock.patch('accounts.roles.time.time', return_value=self.session[roles.SESSION_KEY]['loaded_at'] + roles.CLAIMS_TTL):
+            self.assertTrue(roles.roles_for(self.request_user()).is_supervisor)
+
+    def test_claims_of_another_user_are_ignored(self):
+        roles.roles_for(self.request_user())
+        other = User.objects.create_user('admin', 'admin@example.com', 'password', is_superuser=True)
+        other._roles_session = self.session
+        self.assertTrue(roles.roles_for(other).in_admin_group)
+
+
+class ThrottleTests(TestCase):
+    def test_bucket_empties_and_refills(self):
+        limit = (throttle.LOGIN_PER_EMAIL, 'trainer@example.com')
+        capacity = throttle.LOGIN_PER_EMAIL.capacity
+
+        self.assertEqual([throttle.take(limit, now=1000) for _ in range(capacity)], [0] * capacity)
+        wait = throttle.take(limit, now=1000)
+        self.assertGreater(wait, 0)
+        # One token is back after period / capacity seconds
+        self.assertEqual(throttle.take(limit, now=1000 + wait), 0)
+
+    def test_rejected_attempt_spends_nothing(self):
+        email = (throttle.LOGIN_PER_EMAIL, 'trainer@example.com')
+        ip = (throttle.LOGIN_PER_IP, '198.51.100.1')
+        for _ in range(throttle.LOGIN_PER_EMAIL.capacity):
+            throttle.take(ip, email, now=1000)
+
+        self.assertGreater(throttle.take(ip, email, now=1000), 0)
+        # The IP bucket was not charged for the rejected attempt
+        remaining = throttle.LOGIN_PER_IP.capacity - throttle.LOGIN_PER_EMAIL.capacity
+        waits = [throttle.take(ip, (throttle.LOGIN_PER_EMAIL, f'other{i}@example.com'), now=1000)
+                 for i in range(remaining)]
+        self.assertEqual(waits, [0] * remaining)
+        self.assertGreater(throttle.take(ip, now=1000), 0)
+
+    def test_reset_refills(self):
+        limit = (throttle.LOGIN_PER_EMAIL, 'trainer@example.com')
+        for _ in range(throttle.LOGIN_PER_EMAIL.capacity):
+            throttle.take(limit, now=1000)
+        throttle.reset(limit)
+        self.assertEqual(throttle.take(limit, now=1000), 0)
+
+    def test_unset_values_are_not_limited(self):
+        self.assertEqual(throttle.take((throttle.LOGIN_PER_IP, None), (throttle.LOGIN_PER_EMAIL, '')), 0)
+
+    def test_login_is_rejected_once_the_email_bucket_is_empty(self):
+        data = {'email': 'nobody@example.com', 'password': 'wrong password'}
+        for _ in range(throttle.LOGIN_PER_EMAIL.capacity):
+            self.assertEqual(self.client.post('/login/', data).status_code, 200)
+        self.assertEqual(self.client.post('/login/', data).status_code, 429)
+
+
+class ClientIpTests(TestCase):
+    def request(self, forwarded=None):
+        extra = {'HTTP_X_FORWARDED_FOR': forwarded} if forwarded is not None else {}
+        return RequestFactory().get('/', REMOTE_ADDR='10.0.0.1', **extra)
+
+    @override_settings(TRUSTED_PROXY_HOPS=0)
+    def test_direct_connection_uses_remote_addr(self):
+        self.assertEqual(throttle.client_ip(self.request('203.0.113.9')), '10.0.0.1')
+
+    @override_settings(TRUSTED_PROXY_HOPS=1)
+    def test_behind_one_proxy_uses_the_address_it_appended(self):
+        # The first entry came from the client and is ignored
+        self.assertEqual(throttle.client_ip(self.request('1.2.3.4, 203.0.113.9')), '203.0.113.9')
+
+    @override_settings(TRUSTED_PROXY_HOPS=2)
+    def test_behind_two_proxies(self):
+        self.assertEqual(throttle.client_ip(self.request('203.0.113.9, 10.0.0.2')), '203.0.113.9')
+
+    @override_settings(TRUSTED_PROXY_HOPS=1)
+    def test_missing_header_skips_the_ip_bucket(self):
+        self.assertIsNone(throttle.client_ip(self.request()))
+
+    @override_settings(TRUSTED_PROXY_HOPS=1)
+    def test_clients_behind_the_router_get_their_own_buckets(self):
+        for i in range(throttle.LOGIN_PER_IP.capacity + 5):
+            response = self.client.post('/login/', {'email': f'user{i}@example.com', 'password': 'typo'},
+                                        REMOTE_ADDR='10.0.0.1', HTTP_X_FORWARDED_FOR=f'203.0.113.{i}')
+            self.assertEqual(response.status_code, 200)
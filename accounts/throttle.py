@@ -0,0 +1,118 @@
+"""
+Token-bucket throttling for login and email verification.
+
+Every failed login costs a full password hash and every verification guess
+a database lookup, so attempts are rationed per client IP and per email
+before either happens. Each bucket holds `capacity` attempts and refills
+continuously over `period` seconds.
+
+Bucket state lives in the cache named by THROTTLE_CACHE (the database
+backed 'throttle' alias in settings) so all workers share it. If that
+cache is not configured or is unreachable (e.g. its table has not been
+created yet), a process-local memory cache takes over; limits then apply
+per worker, which is weaker but keeps logins working. Reads and writes are
+not atomic, so concurrent requests may each get a last token; that is
+acceptable for rationing guesses.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import InvalidCacheBackendError, caches
+from django.core.cache.backends.locmem import LocMemCache
+
+KEY_PREFIX = 'accounts:throttle:'
+
+_local = LocMemCache('accounts-throttle', {'OPTIONS': {'MAX_ENTRIES': 10000}})
+
+
+class Bucket:
+    def __init__(self, name, capacity, period):
+        self.name = name
+        self.capacity = capacity
+        self.rate = capacity / period  # tokens per second
+        self.period = period
+
+    def key(self, value):
+        digest = hashlib.sha256(str(value).strip().lower().encode()).hexdigest()[:32]
+        return f'{KEY_PREFIX}{self.name}:{digest}'
+
+    def refill(self, state, now):
+        """Tokens available now from a stored (tokens, timestamp) state"""
+        if state is None:
+            return self.capacity
+        tokens, stamp = state
+        return min(self.capacity, tokens + (now - stamp) * self.rate)
+
+
+LOGIN_PER_IP = Bucket('login-ip', capacity=30, period=15 * 60)
+LOGIN_PER_EMAIL = Bucket('login-email', capacity=5, period=15 * 60)
+VERIFY_PER_IP = Bucket('verify-ip', capacity=10, period=15 * 60)
+VERIFY_PER_EMAIL = Bucket('verify-email', capacity=5, period=15 * 60)
+
+
+def _cache():
+    try:
+        return caches[getattr(settings, 'THROTTLE_CACHE', 'default')]
+    except InvalidCacheBackendError:
+        return _local
+
+
+def client_ip(request):
+    """
+    The client's address, or None if it cannot be told apart from a proxy's
+    (per-IP buckets are then skipped). Behind TRUSTED_PROXY_HOPS proxies
+    REMOTE_ADDR is the nearest proxy, and each proxy appended the address it
+    saw to X-Forwarded-For, so the client is that many entries from the end;
+    anything before that was sent by the client and may be forged.
+    """
+    hops = getattr(settings, 'TRUSTED_PROXY_HOPS', 0)
+    if not hops:
+        return request.META.get('REMOTE_ADDR') or 'unknown'
+    forwarded = [part.strip() for part in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')]
+    forwarded = [part for part in forwarded if part]
+    if len(forwarded) < hops:
+        return None
+    return forwarded[-hops]
+
+
+def take(*limits, now=None):
+    """
+    Spend one token from each (bucket, value) pair whose value is set.
+    Returns 0 if the attempt may go ahead, else the seconds until it may;
+    a rejected attempt spends nothing. One cache read and one write.
+    """
+    now = time.time() if now is None else now
+    limits = [(bucket, bucket.key(value)) for bucket, value in limits if value]
+    if not limits:
+        return 0
+
+    cache = _cache()
+    keys = [key for _, key in limits]
+    try:
+        states = cache.get_many(keys)
+    except Exception:
+        cache = _local
+        states = cache.get_many(keys)
+
+    tokens = {key: bucket.refill(states.get(key), now) for bucket, key in limits}
+    wait = max((1 - tokens[key]) / bucket.rate for bucket, key in limits)
+    if wait > 0:
+        return int(wait) + 1
+
+    updates = {key: (tokens[key] - 1, now) for _, key in limits}
+    timeout = max(bucket.period for bucket, _ in limits)
+    try:
+        cache.set_many(updates, timeout=timeout)
+    except Exception:
+        _local.set_many(updates, timeout=timeout)
+    return 0
+
+
+def reset(*limits):
+    """Refill buckets, e.g. an email's login bucket after a successful login"""
+    keys = [bucket.key(value) for bucket, value in limits if value]
+    try:
+        _cache().delete_many(keys)
+    except Exception:
+        _local.delete_many(keys)
@@ -2,20 +2,14 @@ from functools import wraps
 from django.shortcuts import redirect
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
+from .roles import roles_for
 
 
 def is_trainer(user):
-    return user.groups.filter(name='Trainer').exists()
+    return roles_for(user).is_trainer
 
 def is_admin(user):
-    return user.is_superuser or user.groups.filter(
-        name__in=[
-            'Admin',
-            'Project Manager',
-            'Monitoring Manager',
-            'Supervisor'
-        ]
-    ).exists()
+    return roles_for(user).in_admin_group
 
 
 def admin_required(view_func):
@@ -25,15 +19,14 @@ def admin_required(view_func):
     @wraps(view_func)
     @login_required
     def wrapper(request, *args, **kwargs):
-        try:
-            if request.user.trainerprofile.is_admin():
-                return view_func(request, *args, **kwargs)
-            else:
-                messages.error(request, 'You do not have permission to access this page. Admin access required.')
-                return redirect('home')
-        except:
+        roles = roles_for(request.user)
+        if not roles.has_profile:
             messages.error(request, 'Profile not found. Please contact administrator.')
             return redirect('home')
+        if roles.is_admin_designation:
+            return view_func(request, *args, **kwargs)
+        messages.error(request, 'You do not have permission to access this page. Admin access required.')
+        return redirect('home')
     return wrapper
 
 
@@ -44,14 +37,12 @@ def pum_or_admin_required(view_func):
     @wraps(view_func)
     @login_required
     def wrapper(request, *args, **kwargs):
-        try:
-            profile = request.user.trainerprofile
-            if profile.is_admin() or profile.is_pum():
-                return view_func(request, *args, **kwargs)
-            else:
-                messages.error(request, 'You do not have permission to access this page. PUM or Admin access required.')
-                return redirect('home')
-        except:
+        roles = roles_for(request.user)
+        if not roles.has_profile:
             messages.error(request, 'Profile not found. Please contact administrator.')
             return redirect('home')
+        if roles.is_admin_designation or roles.is_pum:
+            return view_func(request, *args, **kwargs)
+        messages.error(request, 'You do not have permission to access this page. PUM or Admin access required.')
+        return redirect('home')
     return wrapper
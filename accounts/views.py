@@ -13,6 +13,9 @@ from django.contrib.auth import authenticate, login
 from django.contrib.auth.forms import AuthenticationForm
 from django.contrib.auth.views import PasswordResetView, PasswordResetDoneView, PasswordResetConfirmView, PasswordResetCompleteView, PasswordChangeView
 from .utils import admin_required, pum_or_admin_required
+from .roles import roles_for
+from . import throttle
+from jobs.queue import enqueue
 from datetime import date, timedelta
 from django.db.models import Q
 
@@ -24,14 +27,8 @@ def register_user(request):
             # Save to PendingUserRegistration (NOT to User yet)
             pending_registration = form.save(commit=True)
             
-            # Send verification code to email
-            send_mail(
-                subject='Verify your email - CabiRos',
-                message=f'Hello {pending_registration.first_name},\n\nYour verification code is: {pending_registration.verification_code}\n\nPlease enter this code to complete your registration. This code will expire in 24 hours.',
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                recipient_list=[pending_registration.email],
-                fail_silently=False,
-            )
+            # Send verification code to email from the background worker
+            enqueue('accounts.send_verification_email', pending_id=pending_registration.id)
             
             messages.success(request, 'Registration submitted! Please check your email for the verification code.')
             # Store email in session to display on verify page
@@ -50,11 +47,31 @@ def register_user(request):
 from django.contrib import messages
 
 
+def _minutes(seconds):
+    minutes = -(-seconds // 60)
+    return f"{minutes} minute{'s' if minutes != 1 else ''}"
+
+
 def verify_email(request):
     if request.method == 'POST':
-        code = request.POST.get('code')
+        code = (request.POST.get('code') or '').strip()
+        # Codes are only unique per email: the session's address, or the one typed on another device
+        email = (request.POST.get('email') or request.session.get('pending_email') or '').strip()
+        # Ration guesses at the 6-digit code before touching the database
+        wait = throttle.take(
+            (throttle.VERIFY_PER_IP, throttle.client_ip(request)),
+            (throttle.VERIFY_PER_EMAIL, email),
+        )
+        if wait:
+            messages.error(request, f'Too many verification attempts. Please try again in {_minutes(wait)}.')
+            return render(request, 'accounts/verify_email.html',
+                          {'pending_email': request.session.get('pending_email')}, status=429)
         try:
+            if not email:
+                raise PendingUserRegistration.DoesNotExist
+            # One probe on pending_email_code_idx
             pending_registration = PendingUserRegistration.objects.get(
+                email=email,
                 verification_code=code,
                 is_verified=False
             )
@@ -191,33 +208,23 @@ def custom_login(request):
     if request.method == 'POST':
         email = request.POST.get('email')
         password = request.POST.get('password')
-        
-        # Check if email exists
-        try:
-            user = User.objects.get(email=email)
-            # Email exists, check password
-            user_auth = authenticate(request, username=user.username, password=password)
-            if user_auth is not None:
-                login(request, user_auth)
-                messages.success(request, f"Welcome back, {user_auth.first_name}!")
-                return redirect('home')
-            else:
-                # Email exists but password is wrong
-                messages.error(request, "Incorrect password. Please try again.")
-        except User.DoesNotExist:
-            # Email doesn't exist
-            messages.error(request, "No account found with this email address. Please check your email or register for a new account.")
-        except User.MultipleObjectsReturned:
-            # Multiple users with same email - use the most recent one
-            user = User.objects.filter(email=email).order_by('-date_joined').first()
-            user_auth = authenticate(request, username=user.username, password=password)
-            if user_auth is not None:
-                login(request, user_auth)
-                messages.success(request, f"Welcome back, {user_auth.first_name}!")
-                return redirect('home')
-            else:
-                messages.error(request, "Incorrect password. Please try again.")
-        
+
+        # Ration attempts before any password hashing or user lookup
+        wait = throttle.take((throttle.LOGIN_PER_IP, throttle.client_ip(request)), (throttle.LOGIN_PER_EMAIL, email))
+        if wait:
+            messages.error(request, f"Too many login attempts. Please try again in {_minutes(wait)}.")
+            return render(request, 'registration/login.html', {'form': AuthenticationForm()}, status=429)
+
+        # EmailBackend: one indexed lookup, duplicate emails resolve to the newest account
+        user_auth = authenticate(request, email=email, password=password)
+        if user_auth is not None:
+            throttle.reset((throttle.LOGIN_PER_EMAIL, email))
+            login(request, user_auth)
+            messages.success(request, f"Welcome back, {user_auth.first_name}!")
+            return redirect('home')
+        # Same answer for unknown emails and wrong passwords, as the timing is the same too
+        messages.error(request, "Incorrect email or password. Please try again.")
+
         # Return form (empty) so AuthenticationForm doesn't add generic auth errors
         form = AuthenticationForm()
         return render(request, 'registration/login.html', {'form': form})
@@ -324,7 +331,7 @@ def mark_attendance(request):
 @login_required
 def view_attendance(request):
     """View attendance records - admins see all, staff see their own"""
-    profile = request.user.trainerprofile
+    is_admin_user = roles_for(request.user).is_admin_designation
     
     # Filter parameters
     status_filter = request.GET.get('status', '')
@@ -333,7 +340,7 @@ def view_attendance(request):
     user_filter = request.GET.get('user', '')
     
     # Base queryset
-    if profile.is_admin():
+    if is_admin_user:
         # Admins see all attendance
         attendances = Attendance.objects.all()
     else:
@@ -350,17 +357,17 @@ def view_attendance(request):
     if date_to:
         attendances = attendances.filter(date__lte=date_to)
     
-    if user_filter and profile.is_admin():
+    if user_filter and is_admin_user:
         attendances = attendances.filter(user_id=user_filter)
     
     attendances = attendances.select_related('user', 'marked_by').order_by('-date', 'user__first_name')
     
     # Get all users for admin filter dropdown
-    all_users = User.objects.filter(trainerprofile__isnull=False).order_by('first_name') if profile.is_admin() else None
+    all_users = User.objects.filter(trainerprofile__isnull=False).order_by('first_name') if is_admin_user else None
     
     context = {
         'attendances': attendances,
-        'is_admin': profile.is_admin(),
+        'is_admin': is_admin_user,
         'all_users': all_users,
         'status_filter': status_filter,
         'date_from': date_from,
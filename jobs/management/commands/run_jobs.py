@@ -0,0 +1,49 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from jobs.queue import purge_done, requeue_stale, run_next
+
+PURGE_INTERVAL = 60 * 60
+
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs (image derivatives, emails, ...)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Exit when no job is due instead of polling')
+        parser.add_argument('--sleep', type=float, default=2.0,
+                            help='Seconds to wait between polls when the queue is empty')
+        parser.add_argument('--stale-after', type=int, default=600,
+                            help='Seconds after which a RUNNING job is assumed abandoned')
+        parser.add_argument('--keep-done', type=int, default=7,
+                            help='Days to keep finished jobs before deleting them')
+
+    def handle(self, *args, **options):
+        stale_after = timedelta(seconds=options['stale_after'])
+        keep_done = timedelta(days=options['keep_done'])
+        last_purge = None
+
+        while True:
+            job = run_next()
+            if job is not None:
+                style = self.style.SUCCESS if job.status == 'DONE' else self.style.WARNING
+                self.stdout.write(style(f'{job.task} #{job.id}: {job.status} (attempt {job.attempts})'))
+                continue
+
+            requeued = requeue_stale(stale_after)
+            if requeued:
+                self.stdout.write(self.style.WARNING(f'Requeued {requeued} abandoned job(s)'))
+                continue
+
+            # Clear out finished jobs whenever the queue is idle, at most once an hour
+            if last_purge is None or time.monotonic() - last_purge >= PURGE_INTERVAL:
+                last_purge = time.monotonic()
+                purged = purge_done(keep_done)
+                if purged:
+                    self.stdout.write(self.style.SUCCESS(f'Deleted {purged} finished job(s)'))
+
+            if options['once']:
+                break
+            time.sleep(options['sleep'])
@@ -0,0 +1,120 @@
+"""
+Database-backed job queue.
+
+Apps register task functions with @task('app.name') in their tasks.py and
+queue work with enqueue('app.name', **payload). The run_jobs command claims
+due jobs one at a time and retries failures with exponential backoff.
+Finished jobs are deleted after a while by purge_done; failed ones stay
+for inspection.
+"""
+import traceback
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Job
+
+# Retry delays: 30s, 1m, 2m, 4m ... capped at one hour
+BASE_DELAY = 30
+MAX_DELAY = 60 * 60
+
+_registry = {}
+
+
+def task(name):
+    """Register a function as the handler for jobs named `name`"""
+    def decorator(func):
+        _registry[name] = func
+        return func
+    return decorator
+
+
+def enqueue(task_name, run_at=None, max_attempts=5, **payload):
+    """Queue a job; the payload must be JSON-serialisable keyword arguments"""
+    return Job.objects.create(
+        task=task_name,
+        payload=payload,
+        run_at=run_at or timezone.now(),
+        max_attempts=max_attempts,
+    )
+
+
+def enqueue_many(task_name, payloads, max_attempts=5):
+    """Queue one job per payload with a single INSERT"""
+    now = timezone.now()
+    return Job.objects.bulk_create([
+        Job(task=task_name, payload=payload, run_at=now, max_attempts=max_attempts)
+        for payload in payloads
+    ])
+
+
+def backoff(attempts):
+    """Seconds to wait before the next try after `attempts` failed attempts"""
+    return min(BASE_DELAY * 2 ** (attempts - 1), MAX_DELAY)
+
+
+def claim_next():
+    """Mark the next due job RUNNING and return it, or None if nothing is due"""
+    while True:
+        now = timezone.now()
+        with transaction.atomic():
+            job = (
+                Job.objects.select_for_update(skip_locked=True)
+                .filter(status='PENDING', run_at__lte=now)
+                .order_by('run_at', 'id')
+                .first()
+            )
+            if job is None:
+                return None
+            # The conditional update also protects databases without row locks
+            claimed = Job.objects.filter(pk=job.pk, status='PENDING').update(
+                status='RUNNING', attempts=job.attempts + 1, locked_at=now,
+            )
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+
+def run_next():
+    """Run one due job; returns the job (with its new status) or None"""
+    job = claim_next()
+    if job is None:
+        return None
+
+    func = _registry.get(job.task)
+    try:
+        if func is None:
+            raise LookupError(f'No task registered as "{job.task}"')
+        func(**job.payload)
+    except Exception:
+        job.last_error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            job.status = 'FAILED'
+        else:
+            job.status = 'PENDING'
+            job.run_at = timezone.now() + timedelta(seconds=backoff(job.attempts))
+    else:
+        job.status = 'DONE'
+        job.last_error = ''
+
+    job.locked_at = None
+    job.save(update_fields=['status', 'run_at', 'locked_at', 'last_error', 'updated_at'])
+    return job
+
+
+def requeue_stale(older_than):
+    """Return RUNNING jobs whose worker died (locked longer than `older_than`) to the queue"""
+    return Job.objects.filter(
+        status='RUNNING',
+        locked_at__lt=timezone.now() - older_than,
+    ).update(status='PENDING', locked_at=None)
+
+
+def purge_done(older_than):
+    """Delete DONE jobs finished more than `older_than` ago; returns how many"""
+    deleted, _ = Job.objects.filter(
+        status='DONE',
+        updated_at__lt=timezone.now() - older_than,
+    ).delete()
+    return deleted
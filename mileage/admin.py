@@ -1,6 +1,12 @@
 from django.contrib import admin
 from .models import MileageRecord
 from .models import MileageImage
+from .models import MileageRollup
+from .models import DistanceRule
+from .models import StoredBlob
+from .models import PhotoMetadata
+from .models import RecordVersion
+from . import history
 from django.utils.html import mark_safe
 
 
@@ -11,27 +17,78 @@ class MileageImageAdmin(admin.ModelAdmin):
 
     def thumbnail(self, obj):
         if obj.image:
-            return mark_safe(f'<img src="{obj.image.url}" style="max-width: 120px; max-height:80px;" />')
+            return mark_safe(f'<img src="{obj.thumb_url}" style="max-width: 120px; max-height:80px;" />')
         return '-'
     thumbnail.short_description = 'Image'
 
 @admin.register(MileageRecord)
 class MileageAdmin(admin.ModelAdmin):
-    list_display = ('trainer', 'date', 'distance', 'status', 'preview')
-    list_filter = ('status', 'date')
-    readonly_fields = ('preview',)
+    list_display = ('trainer', 'date', 'distance', 'status', 'photo_match', 'preview')
+    list_filter = ('status', 'photo_match', 'capture_mismatch', 'date')
+    readonly_fields = ('preview', 'photo_match', 'photo_match_record', 'capture_mismatch')
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            return super().save_model(request, obj, form, change)
+        before = history.snapshot(MileageRecord.objects.get(pk=obj.pk))
+        super().save_model(request, obj, form, change)
+        history.record_change(obj, before, request.user, history.ADMIN)
 
     def preview(self, obj):
         # Show start_photo and first additional image as thumbnails
         imgs = []
         if obj.start_photo:
-            imgs.append(obj.start_photo.url)
+            imgs.append(obj.start_photo_thumb_url)
         first = obj.images.first()
         if first and first.image:
-            imgs.append(first.image.url)
+            imgs.append(first.thumb_url)
 
         if imgs:
             html = ''.join([f'<img src="{u}" style="max-width: 120px; max-height:80px; margin-right:4px;"/>' for u in imgs])
             return mark_safe(html)
         return '-'
     preview.short_description = 'Photos'
+
+
+@admin.register(MileageRollup)
+class MileageRollupAdmin(admin.ModelAdmin):
+    list_display = ('trainer', 'period', 'total_km', 'record_count', 'warning_count', 'alert_count')
+    list_filter = ('period',)
+    list_select_related = ('trainer',)
+
+
+@admin.register(DistanceRule)
+class DistanceRuleAdmin(admin.ModelAdmin):
+    list_display = ('designation', 'pu_code', 'effective_from', 'warning_km', 'alert_km', 'updated_at')
+    list_filter = ('designation', 'effective_from')
+
+
+@admin.register(StoredBlob)
+class StoredBlobAdmin(admin.ModelAdmin):
+    list_display = ('name', 'size', 'ref_count', 'created_at')
+    search_fields = ('sha256', 'name')
+    readonly_fields = ('sha256', 'name', 'size', 'ref_count', 'thumb_name', 'display_name', 'created_at')
+
+
+@admin.register(PhotoMetadata)
+class PhotoMetadataAdmin(admin.ModelAdmin):
+    list_display = ('record', 'field', 'captured_at', 'device_model', 'latitude', 'longitude')
+    list_filter = ('field', 'device_model')
+    list_select_related = ('record__trainer',)
+
+
+@admin.register(RecordVersion)
+class RecordVersionAdmin(admin.ModelAdmin):
+    list_display = ('record', 'version', 'source', 'changed_by', 'created_at')
+    list_filter = ('source',)
+    list_select_related = ('record__trainer', 'changed_by')
+    readonly_fields = ('record', 'version', 'source', 'changed_by', 'changes', 'created_at')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
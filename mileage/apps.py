@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class MileageConfig(AppConfig):
     name = "mileage"
+
+    def ready(self):
+        import mileage.signals
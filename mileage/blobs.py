@@ -0,0 +1,102 @@
+"""
+Content-addressed photo storage.
+
+Uploads are hashed (SHA-256) chunk by chunk before anything is sent to
+storage. Content that is already stored is referenced again instead of
+uploaded, so re-saving a draft with the same photo costs no bandwidth
+and no extra copy. StoredBlob.ref_count tracks how many record fields
+and images point at each blob. References are taken by the rows that
+store a name, not by the upload, so an abandoned upload leaves a blob
+with no references. Only gc_blobs deletes blobs, once they have had no
+references for GRACE_HOURS since they were last handed out or released;
+that covers the gap between an upload reusing a blob and its record
+saving the reference.
+"""
+import hashlib
+import os
+from collections import Counter
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import StoredBlob
+
+BLOB_DIR = 'blobs'
+
+# Unreferenced blobs are kept this long after their last use (see gc_blobs)
+GRACE_HOURS = 24
+
+
+def content_hash(content):
+    """SHA-256 of an uploaded file, read in chunks"""
+    digest = hashlib.sha256()
+    for chunk in content.chunks():
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()
+
+
+def blob_name(sha256, filename):
+    ext = os.path.splitext(filename)[1].lower() or '.jpg'
+    return f'{BLOB_DIR}/{sha256[:2]}/{sha256}{ext}'
+
+
+def existing(hashes):
+    """
+    {sha256: name} for the hashes that are already stored. Marks them used
+    first, so a pending deletion skips them while the caller saves its
+    reference; a blob deleted before the mark is not returned.
+    """
+    hashes = set(hashes)
+    StoredBlob.objects.filter(sha256__in=hashes).update(last_used_at=timezone.now())
+    return dict(StoredBlob.objects.filter(sha256__in=hashes).values_list('sha256', 'name'))
+
+
+def register(sha256, name, size, storage):
+    """
+    Record a freshly uploaded blob. If another request stored the same
+    content meanwhile, keep theirs, drop our copy and return their name.
+    """
+    try:
+        with transaction.atomic():
+            StoredBlob.objects.create(sha256=sha256, name=name, size=size)
+        return name
+    except IntegrityError:
+        storage.delete(name)
+        return StoredBlob.objects.values_list('name', flat=True).get(sha256=sha256)
+
+
+def acquire(names):
+    """Add one reference per stored name; `names` may repeat"""
+    for name, count in Counter(filter(None, names)).items():
+        StoredBlob.objects.filter(name=name).update(ref_count=F('ref_count') + count)
+
+
+def release(name):
+    """Drop one reference to a stored name; gc_blobs deletes it once unused for GRACE_HOURS"""
+    if not name:
+        return
+    StoredBlob.objects.filter(name=name, ref_count__gt=0).update(
+        ref_count=F('ref_count') - 1, last_used_at=timezone.now(),
+    )
+
+
+# known_derivatives() for a blob whose derivatives cannot be built
+UNDECODABLE = ('', '')
+
+
+def known_derivatives(name):
+    """(thumb, display) already generated for this blob, UNDECODABLE, or None if not tried yet"""
+    row = StoredBlob.objects.filter(name=name).values_list('thumb_name', 'display_name', 'undecodable').first()
+    if row is None or not (row[0] or row[2]):
+        return None
+    return UNDECODABLE if row[2] else row[:2]
+
+
+def remember_derivatives(name, thumb_name, display_name):
+    StoredBlob.objects.filter(name=name).update(thumb_name=thumb_name, display_name=display_name)
+
+
+def remember_undecodable(name):
+    StoredBlob.objects.filter(name=name).update(undecodable=True)
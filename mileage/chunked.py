@@ -0,0 +1,157 @@
+"""
+Resumable chunked photo uploads.
+
+A client announces a file (name, size, SHA-256), then sends it in
+chunks, each tagged with the byte offset it starts at. Chunks are
+appended to a spool file on local disk, so a photo never sits whole in
+worker memory, and after a dropped connection the client asks for the
+current offset and sends only the missing bytes. Once every byte is in,
+the checksum is verified and the file is stored content-addressed
+(see blobs.py). The submit and edit forms then refer to the finished
+upload by token instead of posting the photo again. A finished upload
+holds a reference on its blob until the row is discarded, so the stored
+file outlives every window in which it can still be claimed.
+
+Spool files live in settings.UPLOAD_SPOOL_DIR, which every web process
+serving the uploads must share.
+"""
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.db import transaction
+from PIL import Image
+
+from .models import ChunkedUpload, MileageImage
+from . import blobs, exif
+from .uploads import upload_files
+
+MAX_UPLOAD_SIZE = 25 * 1024 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+READ_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    """A chunk or upload the client must correct; `status` is the HTTP code"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def spool_dir():
+    path = getattr(settings, 'UPLOAD_SPOOL_DIR', None) or os.path.join(tempfile.gettempdir(), 'mileage-uploads')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def spool_path(upload):
+    return os.path.join(spool_dir(), f'{upload.token}.part')
+
+
+def start(user, filename, size, sha256):
+    """
+    The user's unfinished or finished upload of this file, or a new one.
+    Restarting a dropped upload therefore resumes it.
+    """
+    if not 0 < size <= MAX_UPLOAD_SIZE:
+        raise UploadError(f'Uploads must be between 1 byte and {MAX_UPLOAD_SIZE // (1024 * 1024)} MB.', 413)
+    sha256 = sha256.lower()
+    if len(sha256) != 64 or any(c not in '0123456789abcdef' for c in sha256):
+        raise UploadError('sha256 must be a hex SHA-256 digest.')
+
+    existing = ChunkedUpload.objects.filter(
+        user=user, sha256=sha256, size=size, status__in=['ACTIVE', 'COMPLETE'],
+    ).order_by('-status', '-updated_at').first()
+    if existing:
+        return existing
+    return ChunkedUpload.objects.create(user=user, filename=os.path.basename(filename)[:255], size=size, sha256=sha256)
+
+
+def append(upload, offset, stream):
+    """
+    Write one chunk read from `stream` at `offset`. A chunk for any other
+    offset than the next expected byte is rejected with 409 so the
+    client can resync; returns the updated upload.
+    """
+    with transaction.atomic():
+        upload = ChunkedUpload.objects.select_for_update().get(pk=upload.pk)
+        if upload.status != 'ACTIVE':
+            return upload
+        if offset != upload.offset:
+            raise UploadError(f'Expected offset {upload.offset}.', 409)
+
+        path = spool_path(upload)
+        written = 0
+        with open(path, 'ab') as spool:
+            # Drop bytes left by a chunk that failed halfway
+            spool.truncate(upload.offset)
+            for piece in iter(lambda: stream.read(READ_SIZE), b''):
+                written += len(piece)
+                if written > MAX_CHUNK_SIZE or upload.offset + written > upload.size:
+                    spool.truncate(upload.offset)
+                    raise UploadError('Chunk is larger than allowed.', 413)
+                spool.write(piece)
+
+        upload.offset += written
+        upload.save(update_fields=['offset', 'updated_at'])
+
+        # Still holding the row lock, so a retried last chunk waits for this
+        error = None
+        if upload.offset == upload.size:
+            try:
+                finish(upload)
+            except UploadError as e:
+                error = e
+    if error:
+        raise error
+    return upload
+
+
+def finish(upload):
+    """Verify the checksum of a fully received upload and store it"""
+    path = spool_path(upload)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as spool:
+        for piece in iter(lambda: spool.read(READ_SIZE), b''):
+            digest.update(piece)
+
+    if digest.hexdigest() != upload.sha256:
+        fail(upload)
+        raise UploadError('Checksum mismatch; start the upload again.', 422)
+
+    try:
+        # Header only, like the form upload's content-type check
+        Image.open(path).close()
+    except (OSError, Image.DecompressionBombError):
+        fail(upload)
+        raise UploadError('Only image files can be uploaded.', 415)
+
+    with open(path, 'rb') as spool:
+        content = UploadedFile(spool, name=upload.filename, size=upload.size)
+        upload.metadata = exif.read(content)
+        [upload.stored_name] = upload_files([(MileageImage._meta.get_field('image'), content)])
+    os.remove(path)
+    upload.status = 'COMPLETE'
+    upload.save(update_fields=['status', 'stored_name', 'metadata', 'updated_at'])
+    blobs.acquire([upload.stored_name])
+
+
+def fail(upload):
+    os.remove(spool_path(upload))
+    upload.status = 'FAILED'
+    upload.save(update_fields=['status', 'updated_at'])
+
+
+def discard(upload):
+    """Delete an upload, its spool file and its blob reference"""
+    try:
+        os.remove(spool_path(upload))
+    except FileNotFoundError:
+        pass
+    with transaction.atomic():
+        upload.delete()
+        if upload.status == 'COMPLETE':
+            blobs.release(upload.stored_name)
@@ -0,0 +1,121 @@
+"""
+Capture metadata read from photo EXIF headers.
+
+Image.open() only parses the file header; pixels are never decoded, so
+reading the capture time, device and GPS position of an upload costs a
+few kilobytes of I/O. A record is flagged when any of its photos was
+taken on a different calendar day (device local time) than the record.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db.models import Q
+from django.utils import timezone
+from PIL import Image
+
+from .models import MileageRecord, PhotoMetadata
+
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+
+MAKE = 271
+MODEL = 272
+DATETIME = 306
+DATETIME_ORIGINAL = 36867
+OFFSET_TIME_ORIGINAL = 36881
+
+GPS_LATITUDE_REF = 1
+GPS_LATITUDE = 2
+GPS_LONGITUDE_REF = 3
+GPS_LONGITUDE = 4
+
+
+def _capture_time(stamp, offset):
+    """Aware capture datetime from EXIF 'YYYY:MM:DD HH:MM:SS' and optional '+HH:MM'"""
+    try:
+        naive = datetime.strptime(stamp.strip('\x00 '), '%Y:%m:%d %H:%M:%S')
+    except (AttributeError, ValueError):
+        return None
+    try:
+        sign = -1 if offset[0] == '-' else 1
+        hours, minutes = offset[1:].split(':')
+        tz = dt_timezone(sign * timedelta(hours=int(hours), minutes=int(minutes)))
+    except (TypeError, IndexError, ValueError):
+        # No recorded offset: assume the device clock matches ours
+        return timezone.make_aware(naive)
+    return naive.replace(tzinfo=tz)
+
+
+def _coordinate(values, ref):
+    try:
+        degrees, minutes, seconds = (float(v) for v in values)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    value = degrees + minutes / 60 + seconds / 3600
+    return -value if ref in ('S', 'W') else value
+
+
+def read(content):
+    """
+    Capture metadata from an uploaded file's EXIF header as a dict of
+    PhotoMetadata fields, or None if there is none. Leaves the file at
+    position 0.
+    """
+    try:
+        with Image.open(content) as img:
+            exif = img.getexif()
+            details = exif.get_ifd(EXIF_IFD)
+            gps = exif.get_ifd(GPS_IFD)
+    except (OSError, Image.DecompressionBombError):
+        return None
+    finally:
+        content.seek(0)
+
+    if not (exif or details or gps):
+        return None
+
+    captured_at = _capture_time(details.get(DATETIME_ORIGINAL) or exif.get(DATETIME), details.get(OFFSET_TIME_ORIGINAL))
+    return {
+        'captured_at': captured_at,
+        # Calendar day on the device, which is what the trainer saw
+        'captured_on': captured_at.date() if captured_at else None,
+        'device_make': str(exif.get(MAKE, '')).strip('\x00 ')[:100],
+        'device_model': str(exif.get(MODEL, '')).strip('\x00 ')[:100],
+        'latitude': _coordinate(gps.get(GPS_LATITUDE), gps.get(GPS_LATITUDE_REF)),
+        'longitude': _coordinate(gps.get(GPS_LONGITUDE), gps.get(GPS_LONGITUDE_REF)),
+    }
+
+
+def store(record, images, metadata):
+    """
+    Save metadata ({stored name: read() result}) for the record's photos
+    and the given MileageImages, then refresh the record's flag.
+    """
+    rows = []
+    kept = Q()
+    for field in ('start_photo', 'end_photo'):
+        photo = getattr(record, field)
+        if photo and metadata.get(photo.name):
+            rows.append(PhotoMetadata(record=record, field=field, name=photo.name, **metadata[photo.name]))
+        elif photo:
+            kept |= Q(field=field, name=photo.name)
+    for image in images:
+        if metadata.get(image.image.name):
+            rows.append(PhotoMetadata(record=record, image=image, field='image', name=image.image.name,
+                                      **metadata[image.image.name]))
+
+    # Photo metadata that is replaced, or belongs to a replaced photo, goes
+    stale = PhotoMetadata.objects.filter(record=record, image__isnull=True)
+    deleted, _ = (stale.exclude(kept) if kept else stale).delete()
+    PhotoMetadata.objects.bulk_create(rows)
+    if rows or deleted:
+        flag(record)
+
+
+def flag(record):
+    """Mark the record if any photo was captured on a day other than the record date"""
+    mismatch = PhotoMetadata.objects.filter(record=record, captured_on__isnull=False).exclude(
+        captured_on=record.date
+    ).exists()
+    MileageRecord.objects.filter(pk=record.pk).update(capture_mismatch=mismatch)
+    record.capture_mismatch = mismatch
+    return mismatch
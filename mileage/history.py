@@ -0,0 +1,77 @@
+"""
+Edit history for mileage records.
+
+Every change made through edit_mileage, change_status or the admin appends
+a RecordVersion holding only the fields that changed, as {field: [old,
+new]}. Version 0 is the record as it was before its first tracked change;
+version n is rebuilt from the diffs, so the timeline of a record is a
+single indexed query on (record, version).
+"""
+from django.db import transaction
+from django.db.models import Max
+
+from .models import RecordVersion
+
+EDIT = 'EDIT'
+STATUS = 'STATUS'
+ADMIN = 'ADMIN'
+
+TRACKED_FIELDS = (
+    'start_km', 'end_km', 'start_photo', 'end_photo',
+    'distance', 'status', 'submission_status', 'edit_count',
+)
+PHOTO_FIELDS = ('start_photo', 'end_photo')
+
+
+def snapshot(record):
+    """The tracked field values of a record, photos as stored names"""
+    values = {}
+    for field in TRACKED_FIELDS:
+        value = getattr(record, field)
+        values[field] = (value.name or None) if field in PHOTO_FIELDS else value
+    return values
+
+
+def diff(before, after):
+    return {field: [before[field], after[field]] for field in TRACKED_FIELDS if before[field] != after[field]}
+
+
+def record_change(record, before, user, source):
+    """Append a version for the changes since the `before` snapshot; None if nothing changed"""
+    changes = diff(before, snapshot(record))
+    if not changes:
+        return None
+    with transaction.atomic():
+        latest = RecordVersion.objects.filter(record=record).aggregate(latest=Max('version'))['latest']
+        return RecordVersion.objects.create(
+            record=record,
+            version=(latest or 0) + 1,
+            source=source,
+            changed_by=user if user is not None and user.is_authenticated else None,
+            changes=changes,
+        )
+
+
+def states(record, versions):
+    """
+    The full tracked state after each version, oldest first, starting
+    with version 0. A field takes its value from the latest diff at or
+    before the version, else the old value of the next diff that touches
+    it, else the record's current value.
+    """
+    current = snapshot(record)
+    result = []
+    for index in range(len(versions) + 1):
+        state = {}
+        for field in TRACKED_FIELDS:
+            earlier = [v.changes[field][1] for v in versions[:index] if field in v.changes]
+            later = [v.changes[field][0] for v in versions[index:] if field in v.changes]
+            state[field] = earlier[-1] if earlier else later[0] if later else current[field]
+        result.append(state)
+    return result
+
+
+def timeline(record):
+    """[(RecordVersion or None for the original, state)] for a record, in one query"""
+    versions = list(record.versions.select_related('changed_by'))
+    return list(zip([None, *versions], states(record, versions)))
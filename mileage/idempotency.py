@@ -0,0 +1,106 @@
+"""
+Idempotency keys for the submission forms.
+
+Each rendered form carries a random key (the {% idempotency_field %} tag),
+or a client sends an Idempotency-Key header. The first POST with a key
+claims it; a double-tap or browser retry with the same key is answered
+from the stored outcome of the first one (one indexed lookup) instead of
+running validation, uploads and the write again. Keys expire after
+IDEMPOTENCY_TTL.
+"""
+from datetime import timedelta
+from functools import wraps
+
+from django.contrib import messages
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse
+from django.shortcuts import redirect, render
+from django.utils import timezone
+
+from .models import IdempotencyKey
+
+KEY_FIELD = 'idempotency_key'
+HEADER = 'Idempotency-Key'
+IDEMPOTENCY_TTL = timedelta(hours=24)
+# A claim still pending after this long belongs to a request that died
+PENDING_TIMEOUT = timedelta(minutes=5)
+
+
+def request_key(request):
+    # Prefer the header, which does not need the (multipart) body parsed
+    key = request.headers.get(HEADER) or request.POST.get(KEY_FIELD)
+    return key[:100] if key else None
+
+
+def claim(user, key, scope):
+    """(True, new entry) if this request owns the key, else (False, existing entry)"""
+    now = timezone.now()
+    entry = IdempotencyKey.objects.select_related('record').filter(user=user, key=key).first()
+    if entry and entry.expires_at > now and not (entry.status == 'PENDING' and entry.created_at < now - PENDING_TIMEOUT):
+        return False, entry
+    if entry:
+        entry.delete()
+    try:
+        with transaction.atomic():
+            return True, IdempotencyKey.objects.create(
+                user=user, key=key, scope=scope, expires_at=now + IDEMPOTENCY_TTL,
+            )
+    except IntegrityError:
+        # A concurrent duplicate claimed it first
+        return False, IdempotencyKey.objects.select_related('record').get(user=user, key=key)
+
+
+def remember(request, record, template=None, message=None):
+    """
+    Record the outcome of a successful write: the rendered template (with
+    `record` as context), or the dashboard redirect if no template.
+    """
+    entry = getattr(request, 'idempotency_entry', None)
+    if entry is not None:
+        entry.record = record
+        entry.result = {'template': template, 'message': message}
+
+
+def replay(request, entry):
+    if entry.status == 'PENDING':
+        messages.info(request, 'Your earlier request is still being processed.')
+        return redirect('dashboard')
+    result = entry.result or {}
+    if result.get('message'):
+        messages.success(request, result['message'])
+    if result.get('template') and entry.record is not None:
+        return render(request, result['template'], {'record': entry.record})
+    return redirect('dashboard')
+
+
+def idempotent(scope):
+    """Replay the first outcome for POSTs repeating an idempotency key"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            key = request_key(request) if request.method == 'POST' else None
+            if not key:
+                return view(request, *args, **kwargs)
+
+            scope_name = scope.format(**kwargs)
+            claimed, entry = claim(request.user, key, scope_name)
+            if not claimed:
+                if entry.scope != scope_name:
+                    return HttpResponse('Idempotency key was used for another request.', status=409)
+                return replay(request, entry)
+
+            request.idempotency_entry = entry
+            try:
+                response = view(request, *args, **kwargs)
+            except Exception:
+                entry.delete()
+                raise
+            if entry.result is None:
+                # Validation error or failure: let the client try again with the same key
+                entry.delete()
+            else:
+                entry.status = 'DONE'
+                entry.save(update_fields=['status', 'record', 'result'])
+            return response
+        return wrapper
+    return decorator
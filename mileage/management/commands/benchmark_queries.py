@@ -0,0 +1,118 @@
+import random
+import statistics
+import time
+from datetime import date, timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from accounts.models import TrainerProfile
+from mileage.models import MileageRecord
+from mileage.utils import DASHBOARD_PAGE_SIZE, dashboard_queryset, dashboard_summary
+
+
+class Command(BaseCommand):
+    help = 'Seed N trainers x M days of mileage and report query plans and timings for the dashboard/submit queries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--trainers', type=int, default=200, help='Number of trainers to seed')
+        parser.add_argument('--days', type=int, default=365, help='Days of history per trainer')
+        parser.add_argument('--repeat', type=int, default=20, help='Timed runs per query')
+        parser.add_argument('--seed', type=int, default=42, help='Random seed for reproducible data')
+        parser.add_argument('--analyze', action='store_true',
+                            help='Use EXPLAIN ANALYZE (PostgreSQL only)')
+        parser.add_argument('--keep', action='store_true',
+                            help='Keep the seeded data instead of rolling it back')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'Database: {connection.vendor}')
+
+        with transaction.atomic():
+            supervisor, trainer = self.seed(options['trainers'], options['days'], options['seed'])
+            today = date.today()
+
+            dashboard_limit = DASHBOARD_PAGE_SIZE + 1
+            queries = [
+                ('dashboard admin page',
+                 dashboard_queryset(MileageRecord.objects.all())[:dashboard_limit]),
+                ('dashboard status filter',
+                 dashboard_queryset(MileageRecord.objects.filter(status='ALERT'))[:dashboard_limit]),
+                ('dashboard supervisor page',
+                 dashboard_queryset(MileageRecord.objects.filter(
+                     trainer__trainerprofile__supervisor=supervisor))[:dashboard_limit]),
+                ('dashboard trainer page',
+                 dashboard_queryset(MileageRecord.objects.filter(trainer=trainer))[:dashboard_limit]),
+                ('submit draft lookup',
+                 MileageRecord.objects.filter(trainer=trainer, date=today, submission_status='DRAFT')),
+                ('submit submitted lookup',
+                 MileageRecord.objects.filter(trainer=trainer, date=today, submission_status='SUBMITTED')),
+            ]
+
+            for label, queryset in queries:
+                self.report(label, queryset, options)
+
+            # Aggregates have no queryset to EXPLAIN, so only time them
+            timings = self.time(lambda: dashboard_summary(MileageRecord.objects.all()), options['repeat'])
+            self.write_timings('dashboard summary cards', timings)
+
+            if not options['keep']:
+                transaction.set_rollback(True)
+
+    def seed(self, trainer_count, days, seed):
+        """Insert the benchmark data set and return (supervisor, one trainer)"""
+        rng = random.Random(seed)
+        start = time.perf_counter()
+
+        supervisor = User.objects.create(username='bench_supervisor')
+        users = User.objects.bulk_create(
+            [User(username=f'bench_trainer_{i}', first_name='Bench', last_name=str(i)) for i in range(trainer_count)]
+        )
+        # bulk_create skips the post_save signal, so create profiles directly
+        TrainerProfile.objects.bulk_create([
+            TrainerProfile(user=user, designation='WT', pu_code=f'PU{i % 20}',
+                           supervisor=supervisor if i % 10 == 0 else None)
+            for i, user in enumerate(users)
+        ])
+
+        today = date.today()
+        records = []
+        for user in users:
+            for offset in range(days):
+                start_km = rng.randint(1000, 90000)
+                distance = rng.choice([rng.randint(10, 120), rng.randint(121, 125), rng.randint(126, 200)])
+                records.append(MileageRecord(
+                    trainer=user,
+                    date=today - timedelta(days=offset),
+                    start_km=start_km,
+                    end_km=start_km + distance,
+                    distance=distance,
+                    status='ALERT' if distance > 125 else 'WARNING' if distance > 120 else 'OK',
+                    submission_status='DRAFT' if offset == 0 else 'SUBMITTED',
+                    start_photo='start/bench.jpg',
+                    end_photo='end/bench.jpg',
+                ))
+        MileageRecord.objects.bulk_create(records, batch_size=2000)
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f'Seeded {trainer_count} trainers x {days} days = {len(records)} records in {elapsed:.2f}s\n')
+        return supervisor, users[0]
+
+    def time(self, func, repeat):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
+
+    def report(self, label, queryset, options):
+        explain_options = {'analyze': True} if options['analyze'] and connection.vendor == 'postgresql' else {}
+        self.stdout.write(self.style.MIGRATE_HEADING(label))
+        self.stdout.write(queryset.explain(**explain_options))
+        self.write_timings(label, self.time(lambda: list(queryset.all()), options['repeat']))
+
+    def write_timings(self, label, timings):
+        self.stdout.write(self.style.SUCCESS(
+            f'{label}: median {statistics.median(timings):.2f} ms, '
+            f'min {min(timings):.2f} ms, max {max(timings):.2f} ms\n'
+        ))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from mileage.models import MileageRecord, MileageImage
+from mileage.utils import refresh_derivatives
+
+
+class Command(BaseCommand):
+    help = 'Generate thumbnail and display copies for photos uploaded before derivatives existed'
+
+    def handle(self, *args, **options):
+        missing_start = Q(start_photo_thumb__isnull=True) | Q(start_photo_thumb='')
+        missing_end = (
+            (Q(end_photo_thumb__isnull=True) | Q(end_photo_thumb=''))
+            & Q(end_photo__isnull=False) & ~Q(end_photo='')
+        )
+        records = MileageRecord.objects.filter(missing_start | missing_end)
+        record_count = 0
+        for record in records.iterator(chunk_size=200):
+            refresh_derivatives(record, ['start_photo', 'end_photo'])
+            record_count += 1
+
+        images = MileageImage.objects.filter(Q(image_thumb__isnull=True) | Q(image_thumb=''))
+        image_count = 0
+        for image in images.iterator(chunk_size=200):
+            refresh_derivatives(image, ['image'])
+            image_count += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Processed {record_count} records and {image_count} additional images'
+        ))
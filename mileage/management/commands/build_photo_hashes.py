@@ -0,0 +1,64 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from mileage.models import MileageRecord, MileageImage, PhotoHash
+from mileage import phash
+
+
+class Command(BaseCommand):
+    help = 'Compute perceptual hashes for stored photos and flag records that reuse an earlier photo'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8,
+                            help='Photos downloaded and hashed in parallel')
+        parser.add_argument('--batch-size', type=int, default=200)
+        parser.add_argument('--all', action='store_true',
+                            help='Rehash photos that are already indexed')
+
+    def handle(self, *args, **options):
+        indexed = set()
+        if not options['all']:
+            indexed = set(PhotoHash.objects.values_list('name', flat=True).iterator())
+
+        # (record, field, image, field file) for every photo still to hash
+        pending = []
+        for record in MileageRecord.objects.only('id', 'trainer_id', 'start_photo', 'end_photo').iterator(chunk_size=500):
+            for field in ('start_photo', 'end_photo'):
+                photo = getattr(record, field)
+                if photo and photo.name not in indexed:
+                    pending.append((record, field, None, photo))
+        images = MileageImage.objects.select_related('record').only('id', 'image', 'record__id', 'record__trainer_id')
+        for image in images.iterator(chunk_size=500):
+            if image.image and image.image.name not in indexed:
+                pending.append((image.record, 'image', image, image.image))
+
+        def compute(item):
+            # Threads only read storage and decode; rows are written below
+            return phash.dhash(item[3])
+
+        hashed = 0
+        touched = set()
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            for start in range(0, len(pending), options['batch_size']):
+                batch = pending[start:start + options['batch_size']]
+                rows = [
+                    phash.hash_row(record, field, photo.name, value, image)
+                    for (record, field, image, photo), value in zip(batch, pool.map(compute, batch))
+                    if value is not None
+                ]
+                with transaction.atomic():
+                    phash.store(rows)
+                hashed += len(rows)
+                touched.update(row.record_id for row in rows)
+                self.stdout.write(f'  hashed {hashed}/{len(pending)}')
+
+        # Flag once everything is indexed so each record sees all earlier photos
+        flagged = 0
+        records = MileageRecord.objects.filter(id__in=touched).only('id', 'date', 'trainer_id')
+        for record in records.iterator(chunk_size=500):
+            flagged += phash.flag(record) is not None
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Hashed {hashed} of {len(pending)} photos, {flagged} records reuse an earlier photo'
+        ))
@@ -0,0 +1,63 @@
+from collections import Counter
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from mileage.models import ChunkedUpload, MileageRecord, MileageImage, StoredBlob
+from mileage.blobs import GRACE_HOURS
+from jobs.queue import enqueue_many
+
+
+class Command(BaseCommand):
+    help = 'Recount stored photo blob references and queue deletion of unreferenced blobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report drifted counts without fixing them')
+        parser.add_argument('--grace-hours', type=int, default=GRACE_HOURS,
+                            help='Keep blobs unreferenced for less than this; an upload reusing them may still be saving')
+
+    def handle(self, *args, **options):
+        # Count actual references across every photo field
+        references = Counter()
+        for field in ('start_photo', 'end_photo'):
+            references.update(
+                MileageRecord.objects.filter(**{f'{field}__startswith': 'blobs/'}).values_list(field, flat=True).iterator()
+            )
+        references.update(
+            MileageImage.objects.filter(image__startswith='blobs/').values_list('image', flat=True).iterator()
+        )
+        # Finished chunked uploads hold theirs until purge_uploads discards them
+        references.update(
+            ChunkedUpload.objects.filter(status='COMPLETE').exclude(stored_name='')
+            .values_list('stored_name', flat=True).iterator()
+        )
+
+        drifted = [
+            (blob_id, name, ref_count)
+            for blob_id, name, ref_count in StoredBlob.objects.values_list('id', 'name', 'ref_count').iterator()
+            if ref_count != references[name]
+        ]
+        for _, name, ref_count in drifted:
+            self.stdout.write(f'  {name}: {ref_count} -> {references[name]}')
+
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING(f'Dry run: {len(drifted)} blobs have drifted counts'))
+            return
+
+        with transaction.atomic():
+            for blob_id, name, _ in drifted:
+                StoredBlob.objects.filter(id=blob_id).update(ref_count=references[name])
+            cutoff = timezone.now() - timedelta(hours=options['grace_hours'])
+            orphans = list(
+                StoredBlob.objects.filter(ref_count=0, last_used_at__lt=cutoff).values_list('sha256', flat=True)
+            )
+            # The job re-checks the cutoff, so a blob reused after this still survives
+            enqueue_many('mileage.delete_blob', [
+                {'sha256': sha256, 'unused_since': cutoff.isoformat()} for sha256 in orphans
+            ])
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Fixed {len(drifted)} counts, queued {len(orphans)} unreferenced blobs for deletion'
+        ))
@@ -0,0 +1,181 @@
+import csv
+from collections import Counter, defaultdict
+from datetime import date, datetime
+from functools import lru_cache
+from itertools import islice
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from mileage.models import MileageRecord, MileageRollup, month_start
+from mileage import rules, services
+
+# Column holding the trainer: an email address or a PU code
+USER_COLUMNS = ('user', 'email', 'pu_code')
+SHOWN_REJECTS = 20
+
+
+class Command(BaseCommand):
+    help = 'Import historical mileage records from a CSV of (email or PU code, date, start_km, end_km)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_file', help='CSV with a user (email or PU code), date, start_km and end_km column')
+        parser.add_argument('--date-format', default='%Y-%m-%d',
+                            help='strptime format of the date column')
+        parser.add_argument('--draft', action='store_true',
+                            help='Import as drafts instead of submitted records')
+        parser.add_argument('--batch-size', type=int, default=2000,
+                            help='Number of records inserted per query')
+        parser.add_argument('--rejects',
+                            help='Write rejected rows with the reason to this CSV file')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Validate the file without writing anything')
+
+    def handle(self, *args, **options):
+        users = self.user_map()
+        submission_status = 'DRAFT' if options['draft'] else 'SUBMITTED'
+        # Rules are matched once per (designation, PU code), not once per row
+        matching = lru_cache(maxsize=None)(rules.matching_rules)
+
+        rejects = []
+        imported = 0
+        seen = set()
+        buckets = set()
+        try:
+            handle = open(options['csv_file'], newline='', encoding='utf-8-sig')
+        except OSError as e:
+            raise CommandError(f'Cannot read {options["csv_file"]}: {e}')
+
+        with handle:
+            reader = csv.DictReader(handle)
+            column = next((name for name in USER_COLUMNS if name in (reader.fieldnames or ())), None)
+            missing = {'date', 'start_km', 'end_km'} - set(reader.fieldnames or ())
+            if column is None or missing:
+                raise CommandError(f'CSV needs a {"/".join(USER_COLUMNS)} column and date, start_km, end_km')
+
+            # Line numbers count the header as line 1
+            rows = enumerate(reader, start=2)
+            while True:
+                batch = list(islice(rows, options['batch_size']))
+                if not batch:
+                    break
+
+                records = []
+                for line, row in batch:
+                    record, error = self.build(row, column, users, matching, options['date_format'])
+                    if error is None and (record.trainer_id, record.date) in seen:
+                        error = 'Duplicate trainer and date in this file'
+                    if error:
+                        rejects.append((line, row, error))
+                        continue
+                    seen.add((record.trainer_id, record.date))
+                    record.submission_status = submission_status
+                    records.append((line, row, record))
+
+                records = self.drop_existing(records, rejects)
+                if records and not options['dry_run']:
+                    with transaction.atomic():
+                        MileageRecord.objects.bulk_create([record for _, _, record in records])
+                imported += len(records)
+                buckets.update((record.trainer_id, month_start(record.date)) for _, _, record in records)
+                self.stdout.write(f'  {imported} valid, {len(rejects)} rejected')
+
+        # bulk_create skips MileageRecord.save, so bring the touched rollup buckets up to date here
+        if not options['dry_run']:
+            with transaction.atomic():
+                for trainer_id, period in buckets:
+                    MileageRollup.refresh(trainer_id, period)
+
+        self.report(rejects, options['rejects'])
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING(
+                f'Dry run: {imported} records would be imported, {len(rejects)} rows rejected'
+            ))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f'Successfully imported {imported} records, {len(rejects)} rows rejected'
+            ))
+
+    def user_map(self):
+        """{lowercase email or PU code: (user id, designation, PU code) or None if ambiguous} in one query"""
+        users = {}
+        pu_codes = defaultdict(list)
+        rows = User.objects.values_list('id', 'email', 'trainerprofile__designation', 'trainerprofile__pu_code')
+        for user_id, email, designation, pu_code in rows.iterator():
+            entry = (user_id, designation, pu_code)
+            if email:
+                # Several accounts sharing one email cannot be told apart
+                users[email.lower()] = None if email.lower() in users else entry
+            if pu_code:
+                pu_codes[pu_code.lower()].append(entry)
+        for code, entries in pu_codes.items():
+            users.setdefault(code, entries[0] if len(entries) == 1 else None)
+        return users
+
+    def build(self, row, column, users, matching, date_format):
+        """An unsaved MileageRecord for the row, with distance and status set as save() would, or an error"""
+        key = (row.get(column) or '').strip().lower()
+        if key not in users:
+            return None, f'Unknown user "{key}"'
+        if users[key] is None:
+            return None, f'"{key}" matches more than one user'
+        user_id, designation, pu_code = users[key]
+
+        try:
+            day = datetime.strptime((row.get('date') or '').strip(), date_format).date()
+        except ValueError:
+            return None, f'Invalid date "{row.get("date")}"'
+        if day > date.today():
+            return None, 'Date is in the future'
+
+        start_km, end_km, errors = services.validate(
+            services.SUBMIT, (row.get('start_km') or '').strip(), (row.get('end_km') or '').strip(),
+        )
+        if errors:
+            return None, ' '.join(errors)
+
+        distance = end_km - start_km
+        warning_km, alert_km = rules.thresholds_in(matching(designation, pu_code), day)
+        return MileageRecord(
+            trainer_id=user_id,
+            date=day,
+            start_km=start_km,
+            end_km=end_km,
+            distance=distance,
+            status=MileageRecord.status_for_distance(distance, warning_km, alert_km),
+        ), None
+
+    def drop_existing(self, records, rejects):
+        """Reject rows for a trainer and date that already has a record, with one query per batch"""
+        if not records:
+            return records
+        dates = [record.date for _, _, record in records]
+        existing = set(MileageRecord.objects.filter(
+            trainer_id__in={record.trainer_id for _, _, record in records},
+            date__range=(min(dates), max(dates)),
+        ).values_list('trainer_id', 'date'))
+
+        kept = []
+        for line, row, record in records:
+            if (record.trainer_id, record.date) in existing:
+                rejects.append((line, row, 'A record for this trainer and date already exists'))
+            else:
+                kept.append((line, row, record))
+        return kept
+
+    def report(self, rejects, path):
+        rejects.sort(key=lambda reject: reject[0])
+        for reason, count in Counter(error for _, _, error in rejects).most_common(SHOWN_REJECTS):
+            self.stdout.write(f'  {count} x {reason}')
+        for line, _, error in rejects[:SHOWN_REJECTS]:
+            self.stdout.write(self.style.WARNING(f'  line {line}: {error}'))
+        if len(rejects) > SHOWN_REJECTS:
+            self.stdout.write(f'  ... and {len(rejects) - SHOWN_REJECTS} more')
+
+        if path and rejects:
+            fields = list(rejects[0][1]) + ['line', 'error']
+            with open(path, 'w', newline='', encoding='utf-8') as handle:
+                writer = csv.DictWriter(handle, fieldnames=fields, extrasaction='ignore')
+                writer.writeheader()
+                for line, row, error in rejects:
+                    writer.writerow({**row, 'line': line, 'error': error})
@@ -0,0 +1,24 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from mileage.models import ChunkedUpload
+from mileage import chunked
+from mileage.blobs import GRACE_HOURS
+
+
+class Command(BaseCommand):
+    help = 'Delete chunked uploads (and their spool files) that have not changed for a while'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=GRACE_HOURS,
+                            help='Age, since the last chunk, after which uploads are deleted')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options['hours'])
+        # Stored photos of finished uploads stay; gc_blobs removes those nothing else uses
+        count = 0
+        for upload in ChunkedUpload.objects.filter(updated_at__lt=cutoff).iterator():
+            chunked.discard(upload)
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f'Deleted {count} stale uploads'))
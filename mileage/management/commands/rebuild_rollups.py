@@ -0,0 +1,39 @@
+from itertools import islice
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models.functions import TruncMonth
+from mileage.models import MileageRecord, MileageRollup
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the per-trainer monthly mileage rollup table from scratch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of rollup rows inserted per query')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        # One grouped aggregation over the whole history
+        rows = (
+            MileageRecord.objects
+            .annotate(period=TruncMonth('date'))
+            .values('trainer_id', 'period')
+            .annotate(**MileageRollup.totals())
+            .order_by()
+        )
+        rollups = (MileageRollup(**row) for row in rows.iterator())
+
+        created_count = 0
+        with transaction.atomic():
+            MileageRollup.objects.all().delete()
+            while True:
+                batch = list(islice(rollups, batch_size))
+                if not batch:
+                    break
+                MileageRollup.objects.bulk_create(batch)
+                created_count += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {created_count} rollup rows'))
@@ -1,25 +1,57 @@
-from django.core.management.base import BaseCommand
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count, Q
 from mileage.models import MileageRecord
+from mileage import rules
 
 class Command(BaseCommand):
-    help = 'Recalculate distance and status for all mileage records'
+    help = 'Recalculate distance and status for mileage records in set-based batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=date.fromisoformat,
+                            help='Only records dated on or after this day (YYYY-MM-DD)')
+        parser.add_argument('--trainer',
+                            help='Only records for this trainer (user id, username or email)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report what would change without writing anything')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of records updated per query')
 
     def handle(self, *args, **options):
         records = MileageRecord.objects.all()
-        updated_count = 0
-        
-        for record in records:
-            if record.start_km and record.end_km:
-                old_distance = record.distance
-                old_status = record.status
-                
-                # Force recalculation
-                record.save()
-                
-                if record.distance != old_distance or record.status != old_status:
-                    updated_count += 1
-                    self.stdout.write(
-                        f'Updated record {record.id}: distance {old_distance} -> {record.distance}, status {old_status} -> {record.status}'
-                    )
-        
-        self.stdout.write(f'Successfully updated {updated_count} records')
\ No newline at end of file
+
+        if options['since']:
+            records = records.filter(date__gte=options['since'])
+        if options['trainer']:
+            trainer = options['trainer']
+            lookup = Q(trainer__username=trainer) | Q(trainer__email=trainer)
+            if trainer.isdigit():
+                lookup |= Q(trainer_id=int(trainer))
+            records = records.filter(lookup)
+            if not records.exists():
+                raise CommandError(f'No records found for trainer "{trainer}"')
+
+        # Diff summary: old -> new status transitions among rows that change
+        transitions = {}
+        for designation, pu_code in rules.profile_groups(records):
+            stale = rules.stale_records(records, designation, pu_code)
+            for row in stale.values('status', 'new_status').annotate(count=Count('id')).order_by():
+                key = (row['status'] or '-', row['new_status'])
+                transitions[key] = transitions.get(key, 0) + row['count']
+
+        total = sum(transitions.values())
+        for (old_status, new_status), count in sorted(transitions.items()):
+            self.stdout.write(f'  {old_status} -> {new_status}: {count} records')
+
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING(f'Dry run: {total} records would be updated'))
+            return
+
+        updated_count = rules.reclassify(
+            records,
+            batch_size=options['batch_size'],
+            progress=lambda count: self.stdout.write(f'Updated {count}/{total} records'),
+        )
+
+        self.stdout.write(self.style.SUCCESS(f'Successfully updated {updated_count} records'))
@@ -0,0 +1,33 @@
+# Generated by Django 6.0 on 2026-10-18 17:43
+
+import datetime
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mileage', '0006_mileagerollup'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mileagerecord',
+            name='date',
+            field=models.DateField(default=datetime.date.today, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='mileagerecord',
+            index=models.Index(fields=['-date', '-id'], name='mileage_date_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mileagerecord',
+            index=models.Index(fields=['status', '-date', '-id'], name='mileage_status_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mileagerecord',
+            index=models.Index(fields=['trainer', 'date', 'submission_status'], name='mileage_trainer_date_sub_idx'),
+        ),
+    ]
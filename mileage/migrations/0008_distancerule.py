@@ -0,0 +1,29 @@
+# Generated by Django 6.0 on 2026-10-18 17:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mileage', '0007_mileagerecord_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DistanceRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('designation', models.CharField(blank=True, max_length=20, verbose_name='Designation')),
+                ('pu_code', models.CharField(blank=True, max_length=50, verbose_name='PU Code')),
+                ('effective_from', models.DateField()),
+                ('warning_km', models.PositiveIntegerField(verbose_name='Warning above (km)')),
+                ('alert_km', models.PositiveIntegerField(verbose_name='Alert above (km)')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['designation', 'pu_code', '-effective_from'],
+                'unique_together': {('designation', 'pu_code', 'effective_from')},
+            },
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 6.0 on 2026-10-18 17:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mileage', '0008_distancerule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mileageimage',
+            name='image_display',
+            field=models.ImageField(blank=True, editable=False, null=True, upload_to='mileage/%Y/%m/%d/'),
+        ),
+        migrations.AddField(
+            model_name='mileageimage',
+            name='image_thumb',
+            field=models.ImageField(blank=True, editable=False, null=True, upload_to='mileage/%Y/%m/%d/'),
+        ),
+        migrations.AddField(
+            model_name='mileagerecord',
+            name='end_photo_display',
+            field=models.ImageField(blank=True, editable=False, null=True, upload_to='end/'),
+        ),
+        migrations.AddField(
+            model_name='mileagerecord',
+            name='end_photo_thumb',
+            field=models.ImageField(blank=True, editable=False, null=True, upload_to='end/'),
+        ),
+        migrations.AddField(
+            model_name='mileagerecord',
+            name='start_photo_display',
+            field=models.ImageField(blank=True, editable=False, null=True, upload_to='start/'),
+        ),
+        migrations.AddField(
+            model_name='mileagerecord',
+            name='start_photo_thumb',
+            field=models.ImageField(blank=True, editable=False, null=True, upload_to='start/'),
+        ),
+    ]
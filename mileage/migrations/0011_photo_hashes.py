@@ -0,0 +1,47 @@
+# Generated by Django 6.0 on 2026-10-18 17:54
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mileage', '0010_storedblob'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mileagerecord',
+            name='photo_match',
+            field=models.CharField(blank=True, choices=[('OWN', 'Reuses own photo'), ('OTHER', "Matches another trainer's photo")], editable=False, max_length=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='mileagerecord',
+            name='photo_match_record',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='mileage.mileagerecord'),
+        ),
+        migrations.CreateModel(
+            name='PhotoHash',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.CharField(max_length=20)),
+                ('name', models.CharField(max_length=255)),
+                ('dhash', models.BigIntegerField()),
+                ('chunk0', models.PositiveIntegerField()),
+                ('chunk1', models.PositiveIntegerField()),
+                ('chunk2', models.PositiveIntegerField()),
+                ('chunk3', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('image', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='photo_hash', to='mileage.mileageimage')),
+                ('record', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='photo_hashes', to='mileage.mileagerecord')),
+                ('trainer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['chunk0'], name='photohash_chunk0_idx'), models.Index(fields=['chunk1'], name='photohash_chunk1_idx'), models.Index(fields=['chunk2'], name='photohash_chunk2_idx'), models.Index(fields=['chunk3'], name='photohash_chunk3_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('image__isnull', True)), fields=('record', 'field'), name='photohash_record_field_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 6.0 on 2026-10-18 17:56
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mileage', '0011_photo_hashes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PhotoMetadata',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.CharField(max_length=20)),
+                ('name', models.CharField(max_length=255)),
+                ('captured_at', models.DateTimeField(blank=True, null=True)),
+                ('captured_on', models.DateField(blank=True, null=True)),
+                ('device_make', models.CharField(blank=True, max_length=100)),
+                ('device_model', models.CharField(blank=True, max_length=100)),
+                ('latitude', models.FloatField(blank=True, null=True)),
+                ('longitude', models.FloatField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name_plural': 'photo metadata',
+            },
+        ),
+        migrations.AddField(
+            model_name='mileagerecord',
+            name='capture_mismatch',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='mileagerecord',
+            index=models.Index(fields=['capture_mismatch', '-date', '-id'], name='mileage_capture_date_idx'),
+        ),
+        migrations.AddField(
+            model_name='photometadata',
+            name='image',
+            field=models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='metadata', to='mileage.mileageimage'),
+        ),
+        migrations.AddField(
+            model_name='photometadata',
+            name='record',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='photo_metadata', to='mileage.mileagerecord'),
+        ),
+        migrations.AddIndex(
+            model_name='photometadata',
+            index=models.Index(fields=['record', 'captured_on'], name='photometa_record_day_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='photometadata',
+            index=models.Index(fields=['captured_at'], name='photometa_captured_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='photometadata',
+            index=models.Index(fields=['device_model'], name='photometa_device_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 6.0 on 2026-10-18 18:40
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mileage', '0015_record_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storedblob',
+            name='last_used_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 18:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mileage', '0016_storedblob_last_used_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storedblob',
+            name='undecodable',
+            field=models.BooleanField(default=False),
+        ),
+    ]
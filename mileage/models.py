@@ -1,5 +1,13 @@
-from django.db import models
+import uuid
+from datetime import date
+from django.db import models, transaction
+from django.db.models import Case, Count, Q, Sum, Value, When
+from django.db.models.lookups import GreaterThan
 from django.contrib.auth.models import User
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from jobs.queue import enqueue
+from .utils import derivative_url, derivatives_stale
 
 class MileageRecord(models.Model):
     STATUS_CHOICES = (
@@ -13,8 +21,17 @@ class MileageRecord(models.Model):
         ('SUBMITTED', 'Submitted'),
     )
 
+    PHOTO_MATCH_CHOICES = (
+        ('OWN', 'Reuses own photo'),
+        ('OTHER', "Matches another trainer's photo"),
+    )
+
+    # Daily distance thresholds (km)
+    WARNING_KM = 120
+    ALERT_KM = 125
+
     trainer = models.ForeignKey(User, on_delete=models.CASCADE)
-    date = models.DateField(auto_now_add=True)
+    date = models.DateField(default=date.today, editable=False)
 
     start_km = models.PositiveIntegerField()
     end_km = models.PositiveIntegerField(null=True, blank=True)
@@ -22,38 +39,431 @@ class MileageRecord(models.Model):
     start_photo = models.ImageField(upload_to='start/')
     end_photo = models.ImageField(upload_to='end/', null=True, blank=True)
 
+    # Downscaled copies generated from the photos above
+    start_photo_thumb = models.ImageField(upload_to='start/', null=True, blank=True, editable=False)
+    start_photo_display = models.ImageField(upload_to='start/', null=True, blank=True, editable=False)
+    end_photo_thumb = models.ImageField(upload_to='end/', null=True, blank=True, editable=False)
+    end_photo_display = models.ImageField(upload_to='end/', null=True, blank=True, editable=False)
+
     distance = models.PositiveIntegerField(null=True, blank=True)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, null=True, blank=True)
     submission_status = models.CharField(max_length=10, choices=SUBMISSION_STATUS, default='DRAFT')
     edit_count = models.PositiveIntegerField(default=0)
 
+    # Set when a photo is a near-duplicate of one on an earlier record (see phash.py)
+    photo_match = models.CharField(max_length=10, choices=PHOTO_MATCH_CHOICES, null=True, blank=True, editable=False)
+    photo_match_record = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True,
+                                           editable=False, related_name='+')
+    # Set when a photo's EXIF capture date differs from the record date (see exif.py)
+    capture_mismatch = models.BooleanField(default=False, editable=False)
+
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         unique_together = ('trainer', 'date')
+        indexes = [
+            # Dashboard: all trainers, newest first, keyset on (date, id)
+            models.Index(fields=['-date', '-id'], name='mileage_date_id_idx'),
+            # Dashboard filtered by status
+            models.Index(fields=['status', '-date', '-id'], name='mileage_status_date_idx'),
+            # Dashboard filtered to suspicious capture times
+            models.Index(fields=['capture_mismatch', '-date', '-id'], name='mileage_capture_date_idx'),
+            # submit_mileage: today's draft/submitted record for a trainer
+            models.Index(fields=['trainer', 'date', 'submission_status'], name='mileage_trainer_date_sub_idx'),
+        ]
 
-    def save(self, *args, **kwargs):
+    def compute_distance(self):
+        """Set distance and status from the KM readings and the trainer's thresholds"""
         # Only calculate distance if both start_km and end_km are provided
         if self.start_km is not None and self.end_km is not None:
+            from .rules import thresholds_for_trainer
+
             self.distance = self.end_km - self.start_km
+            warning_km, alert_km = thresholds_for_trainer(self.trainer_id, self.date)
+            self.status = self.status_for_distance(self.distance, warning_km, alert_km)
+
+    def save(self, *args, **kwargs):
+        self.compute_distance()
+
+        # Keep the monthly rollup and photo references in step within the same transaction
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            MileageRollup.refresh(self.trainer_id, self.date)
+            changed = self.sync_photo_references()
+
+        self.queue_derivatives(changed)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._stored_photos = instance.photo_names()
+        return instance
+
+    def photo_names(self):
+        return {name: getattr(self, name).name for name in ('start_photo', 'end_photo')
+                if name in self.__dict__}
 
-            if self.distance > 125:
-                self.status = 'ALERT'
-            elif self.distance > 120:
-                self.status = 'WARNING'
-            else:
-                self.status = 'OK'
+    def changed_photos(self):
+        """Photo fields whose file differs from the one last loaded or saved"""
+        stored = getattr(self, '_stored_photos', {})
+        current = self.photo_names()
+        return [name for name in current if current[name] != stored.get(name)]
 
-        super().save(*args, **kwargs)
+    def sync_photo_references(self):
+        """
+        Take blob references for newly saved photos and drop those of
+        replaced ones; returns the fields whose photo changed.
+        """
+        from .blobs import acquire, release
+
+        stored = getattr(self, '_stored_photos', {})
+        changed = self.changed_photos()
+        acquire(getattr(self, name).name for name in changed)
+        for name in changed:
+            release(stored.get(name))
+        self._stored_photos = self.photo_names()
+        return changed
+
+    def queue_derivatives(self, fields):
+        """Hand thumbnail/display generation for newly saved photos to the job queue"""
+        fields = [name for name in fields if derivatives_stale(self, name)]
+        if fields:
+            enqueue('mileage.build_derivatives', model='record', pk=self.pk, fields=fields)
+
+    @property
+    def start_photo_thumb_url(self):
+        return derivative_url(self.start_photo_thumb, self.start_photo)
+
+    @property
+    def start_photo_display_url(self):
+        return derivative_url(self.start_photo_display, self.start_photo)
+
+    @property
+    def end_photo_thumb_url(self):
+        return derivative_url(self.end_photo_thumb, self.end_photo)
+
+    @property
+    def end_photo_display_url(self):
+        return derivative_url(self.end_photo_display, self.end_photo)
+
+    @classmethod
+    def status_for_distance(cls, distance, warning_km=WARNING_KM, alert_km=ALERT_KM):
+        if distance > alert_km:
+            return 'ALERT'
+        if distance > warning_km:
+            return 'WARNING'
+        return 'OK'
+
+    @classmethod
+    def status_expression(cls, distance, warning_km=WARNING_KM, alert_km=ALERT_KM):
+        """SQL equivalent of status_for_distance, for set-based updates"""
+        return Case(
+            When(GreaterThan(distance, alert_km), then=Value('ALERT')),
+            When(GreaterThan(distance, warning_km), then=Value('WARNING')),
+            default=Value('OK'),
+            output_field=models.CharField(),
+        )
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            MileageRollup.refresh(self.trainer_id, self.date)
+        return result
 
 
 class MileageImage(models.Model):
     """Additional images related to a mileage record."""
     record = models.ForeignKey(MileageRecord, on_delete=models.CASCADE, related_name='images')
     image = models.ImageField(upload_to='mileage/%Y/%m/%d/')
+    image_thumb = models.ImageField(upload_to='mileage/%Y/%m/%d/', null=True, blank=True, editable=False)
+    image_display = models.ImageField(upload_to='mileage/%Y/%m/%d/', null=True, blank=True, editable=False)
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return f"Image for {self.record} ({self.id})"
 
+    def save(self, *args, **kwargs):
+        from .blobs import acquire
+
+        adding = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding:
+                acquire([self.image.name])
+        if adding and derivatives_stale(self, 'image'):
+            enqueue('mileage.build_derivatives', model='image', pk=self.pk, fields=['image'])
+
+    @property
+    def thumb_url(self):
+        return derivative_url(self.image_thumb, self.image)
+
+    @property
+    def display_url(self):
+        return derivative_url(self.image_display, self.image)
+
+
+def month_start(day):
+    """Return the first day of the month containing the given date"""
+    return day.replace(day=1)
+
+
+def next_month_start(day):
+    """Return the first day of the month after the given date"""
+    if day.month == 12:
+        return date(day.year + 1, 1, 1)
+    return date(day.year, day.month + 1, 1)
+
+
+class MileageRollup(models.Model):
+    """Per-trainer monthly mileage totals, maintained alongside MileageRecord"""
+    trainer = models.ForeignKey(User, on_delete=models.CASCADE, related_name='mileage_rollups')
+    period = models.DateField(help_text='First day of the month')
+    total_km = models.PositiveIntegerField(default=0)
+    record_count = models.PositiveIntegerField(default=0)
+    alert_count = models.PositiveIntegerField(default=0)
+    warning_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('trainer', 'period')
+        indexes = [
+            models.Index(fields=['period'], name='mileage_rollup_period_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.trainer} - {self.period:%Y-%m}: {self.total_km} km"
+
+    @staticmethod
+    def totals():
+        """Aggregate expressions shared by the incremental refresh and the full rebuild"""
+        return {
+            'total_km': Sum('distance', default=0),
+            'record_count': Count('id'),
+            'alert_count': Count('id', filter=Q(status='ALERT')),
+            'warning_count': Count('id', filter=Q(status='WARNING')),
+        }
+
+    @classmethod
+    def refresh(cls, trainer_id, day):
+        """Recompute the bucket for one trainer and month from its (at most 31) records"""
+        period = month_start(day)
+        totals = MileageRecord.objects.filter(
+            trainer_id=trainer_id,
+            date__gte=period,
+            date__lt=next_month_start(period),
+        ).aggregate(**cls.totals())
+
+        if totals['record_count']:
+            cls.objects.update_or_create(trainer_id=trainer_id, period=period, defaults=totals)
+        else:
+            cls.objects.filter(trainer_id=trainer_id, period=period).delete()
+
+
+class DistanceRule(models.Model):
+    """
+    WARNING/ALERT distance thresholds for a designation and/or PU code,
+    effective from a given date. Blank designation or PU code matches anyone.
+    """
+    designation = models.CharField(max_length=20, blank=True, verbose_name="Designation")
+    pu_code = models.CharField(max_length=50, blank=True, verbose_name="PU Code")
+    effective_from = models.DateField()
+    warning_km = models.PositiveIntegerField(verbose_name="Warning above (km)")
+    alert_km = models.PositiveIntegerField(verbose_name="Alert above (km)")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('designation', 'pu_code', 'effective_from')
+        ordering = ['designation', 'pu_code', '-effective_from']
+
+    def __str__(self):
+        scope = ' / '.join(filter(None, [self.designation, self.pu_code])) or 'Everyone'
+        return f"{scope} from {self.effective_from}: {self.warning_km}/{self.alert_km} km"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored scope so an edit also re-evaluates the old one
+        instance._loaded_scope = (instance.designation, instance.pu_code, instance.effective_from)
+        return instance
+
+    def affected_records(self):
+        """Records whose classification may depend on this rule, before or after an edit"""
+        scopes = {(self.designation, self.pu_code, self.effective_from)}
+        if getattr(self, '_loaded_scope', None):
+            scopes.add(self._loaded_scope)
+
+        lookup = Q()
+        for designation, pu_code, effective_from in scopes:
+            scope = Q(date__gte=effective_from)
+            if designation:
+                scope &= Q(trainer__trainerprofile__designation=designation)
+            if pu_code:
+                scope &= Q(trainer__trainerprofile__pu_code=pu_code)
+            lookup |= scope
+        return MileageRecord.objects.filter(lookup)
+
+
+class StoredBlob(models.Model):
+    """
+    One stored copy of a photo per distinct content (SHA-256), shared by
+    every record field and image that references it.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=100, unique=True, help_text='Storage name of the original')
+    size = models.PositiveIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    thumb_name = models.CharField(max_length=100, blank=True)
+    display_name = models.CharField(max_length=100, blank=True)
+    # Set when derivatives could not be built because the file is not a decodable image
+    undecodable = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Last handed out for reuse or released; gc_blobs's grace period counts from here
+    last_used_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.name} ({self.ref_count} refs)"
+
+
+class PhotoHash(models.Model):
+    """
+    64-bit dHash of a stored photo. The hash is also split into four
+    16-bit chunks, each indexed, so near-duplicates can be looked up with
+    exact-match queries instead of scanning every hash.
+    """
+    record = models.ForeignKey(MileageRecord, on_delete=models.CASCADE, related_name='photo_hashes')
+    image = models.OneToOneField(MileageImage, on_delete=models.CASCADE, null=True, blank=True, related_name='photo_hash')
+    trainer = models.ForeignKey(User, on_delete=models.CASCADE)
+    field = models.CharField(max_length=20)
+    name = models.CharField(max_length=255)
+    dhash = models.BigIntegerField()
+    chunk0 = models.PositiveIntegerField()
+    chunk1 = models.PositiveIntegerField()
+    chunk2 = models.PositiveIntegerField()
+    chunk3 = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['record', 'field'], condition=Q(image__isnull=True),
+                                    name='photohash_record_field_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['chunk0'], name='photohash_chunk0_idx'),
+            models.Index(fields=['chunk1'], name='photohash_chunk1_idx'),
+            models.Index(fields=['chunk2'], name='photohash_chunk2_idx'),
+            models.Index(fields=['chunk3'], name='photohash_chunk3_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.record} {self.field} {self.dhash & 0xFFFFFFFFFFFFFFFF:016x}"
+
+
+class PhotoMetadata(models.Model):
+    """Capture details read from a stored photo's EXIF header"""
+    record = models.ForeignKey(MileageRecord, on_delete=models.CASCADE, related_name='photo_metadata')
+    image = models.OneToOneField(MileageImage, on_delete=models.CASCADE, null=True, blank=True, related_name='metadata')
+    field = models.CharField(max_length=20)
+    name = models.CharField(max_length=255)
+    captured_at = models.DateTimeField(null=True, blank=True)
+    captured_on = models.DateField(null=True, blank=True)
+    device_make = models.CharField(max_length=100, blank=True)
+    device_model = models.CharField(max_length=100, blank=True)
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        verbose_name_plural = 'photo metadata'
+        indexes = [
+            models.Index(fields=['record', 'captured_on'], name='photometa_record_day_idx'),
+            models.Index(fields=['captured_at'], name='photometa_captured_idx'),
+            models.Index(fields=['device_model'], name='photometa_device_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.record} {self.field} {self.captured_at or 'no capture time'}"
+
+
+class ChunkedUpload(models.Model):
+    """A photo sent in chunks (see chunked.py); usable by token once complete"""
+    STATUS_CHOICES = (
+        ('ACTIVE', 'Active'),
+        ('COMPLETE', 'Complete'),
+        ('FAILED', 'Failed'),
+    )
+
+    token = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    sha256 = models.CharField(max_length=64)
+    offset = models.PositiveBigIntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='ACTIVE')
+    # Set on completion: content-addressed name and EXIF capture details
+    stored_name = models.CharField(max_length=255, blank=True)
+    metadata = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # Resuming: the user's upload of the same file
+            models.Index(fields=['user', 'sha256', 'size'], name='chunked_user_sha_idx'),
+            models.Index(fields=['updated_at'], name='chunked_updated_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} - {self.filename} ({self.offset}/{self.size})"
+
+
+class IdempotencyKey(models.Model):
+    """Outcome of a submission POST, replayed for retries with the same key (see idempotency.py)"""
+    STATUS_CHOICES = (
+        ('PENDING', 'Pending'),
+        ('DONE', 'Done'),
+    )
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    key = models.CharField(max_length=100)
+    scope = models.CharField(max_length=50)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='PENDING')
+    record = models.ForeignKey(MileageRecord, on_delete=models.CASCADE, null=True, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('user', 'key')
+        indexes = [
+            models.Index(fields=['expires_at'], name='idempotency_expires_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} {self.scope} {self.key}"
+
+
+class RecordVersion(models.Model):
+    """
+    One change to a mileage record as a field-level diff {field: [old, new]}.
+    Past versions are rebuilt from these rows (see history.py).
+    """
+    SOURCE_CHOICES = (
+        ('EDIT', 'Trainer edit'),
+        ('STATUS', 'Status change'),
+        ('ADMIN', 'Admin'),
+    )
+
+    record = models.ForeignKey(MileageRecord, on_delete=models.CASCADE, related_name='versions')
+    version = models.PositiveIntegerField()
+    source = models.CharField(max_length=10, choices=SOURCE_CHOICES)
+    changed_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    changes = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        # Also the index that serves a record's whole timeline in one query
+        unique_together = ('record', 'version')
+        ordering = ['record', 'version']
+
+    def __str__(self):
+        return f"Record {self.record_id} v{self.version} ({self.source})"
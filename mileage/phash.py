@@ -0,0 +1,143 @@
+"""
+Perceptual hashes for spotting reused odometer photos.
+
+Each photo gets a 64-bit difference hash (dHash), which survives
+re-compression, resizing and small crops. Two photos are treated as the
+same shot when their hashes differ in at most MAX_DISTANCE bits. Hashes
+are split into CHUNKS indexed columns: by the pigeonhole principle two
+hashes within MAX_DISTANCE (< CHUNKS) bits agree exactly on at least one
+chunk, so candidates come from plain index lookups (multi-index hashing)
+and only those are compared bit by bit.
+"""
+from io import BytesIO
+
+from django.db.models import Q
+from PIL import Image, ImageOps
+
+from .models import MileageRecord, PhotoHash
+
+HASH_SIZE = 8
+CHUNKS = 4
+CHUNK_BITS = 64 // CHUNKS
+MAX_DISTANCE = CHUNKS - 1
+
+# Near-uniform photos (dark, overexposed) hash to almost all 0s or 1s and
+# would match each other; they are indexed but never flagged
+MIN_BITS = 8
+MAX_BITS = 64 - MIN_BITS
+
+
+def dhash(field_file):
+    """64-bit dHash of a stored image, or None if it cannot be decoded"""
+    # Storage errors propagate so a background job can retry them
+    field_file.open('rb')
+    data = BytesIO(field_file.read())
+    field_file.close()
+
+    try:
+        with Image.open(data) as img:
+            img.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+            img = ImageOps.exif_transpose(img).convert('L')
+        pixels = list(img.resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.LANCZOS).getdata())
+    except (OSError, Image.DecompressionBombError):
+        return None
+
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            value = (value << 1) | (left > pixels[row * (HASH_SIZE + 1) + col + 1])
+    return value
+
+
+def chunks(value):
+    mask = (1 << CHUNK_BITS) - 1
+    return [(value >> (CHUNK_BITS * i)) & mask for i in range(CHUNKS)]
+
+
+def to_signed(value):
+    """Fit an unsigned 64-bit hash into a BigIntegerField"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def hamming(a, b):
+    return ((a ^ b) & 0xFFFFFFFFFFFFFFFF).bit_count()
+
+
+def informative(value):
+    return MIN_BITS <= (value & 0xFFFFFFFFFFFFFFFF).bit_count() <= MAX_BITS
+
+
+def hash_row(record, field, name, value, image=None):
+    """Unsaved PhotoHash for a computed hash"""
+    parts = chunks(value)
+    return PhotoHash(
+        record_id=record.pk, trainer_id=record.trainer_id, image=image, field=field, name=name,
+        dhash=to_signed(value), **{f'chunk{i}': part for i, part in enumerate(parts)},
+    )
+
+
+def store(rows):
+    """Replace the index entries for the given photos"""
+    for row in rows:
+        if row.image_id:
+            PhotoHash.objects.filter(image_id=row.image_id).delete()
+        else:
+            PhotoHash.objects.filter(record_id=row.record_id, field=row.field, image__isnull=True).delete()
+    PhotoHash.objects.bulk_create(rows)
+
+
+def index(instance, field_names):
+    """Hash the given photo fields of a record or additional image and re-flag its record"""
+    record = getattr(instance, 'record', instance)
+    image = instance if instance is not record else None
+    rows = []
+    for field_name in field_names:
+        field_file = getattr(instance, field_name)
+        if not field_file:
+            continue
+        value = dhash(field_file)
+        if value is not None:
+            rows.append(hash_row(record, 'image' if image else field_name, field_file.name, value, image))
+    store(rows)
+    flag(record)
+
+
+def candidates(value):
+    """Index rows sharing at least one chunk with the hash"""
+    lookup = Q()
+    for i, part in enumerate(chunks(value)):
+        lookup |= Q(**{f'chunk{i}': part})
+    return PhotoHash.objects.filter(lookup)
+
+
+def matches(record):
+    """[(PhotoHash, distance)] for near-duplicate photos on records older than this one"""
+    earlier = Q(record__date__lt=record.date) | Q(record__date=record.date, record__id__lt=record.pk)
+    found = []
+    for own in PhotoHash.objects.filter(record=record):
+        value = own.dhash
+        if not informative(value):
+            continue
+        for other in candidates(value & 0xFFFFFFFFFFFFFFFF).filter(earlier).select_related('record'):
+            distance = hamming(value, other.dhash)
+            if distance <= MAX_DISTANCE:
+                found.append((other, distance))
+    return found
+
+
+def flag(record):
+    """Store on the record whether its photos reuse an earlier shot, preferring cross-trainer matches"""
+    found = sorted(
+        matches(record),
+        key=lambda item: (item[0].trainer_id == record.trainer_id, item[1], item[0].record.date, item[0].record_id),
+    )
+    if found:
+        match = found[0][0]
+        photo_match = 'OWN' if match.trainer_id == record.trainer_id else 'OTHER'
+        match_record = match.record_id
+    else:
+        photo_match = match_record = None
+    MileageRecord.objects.filter(pk=record.pk).update(photo_match=photo_match, photo_match_record=match_record)
+    record.photo_match, record.photo_match_record_id = photo_match, match_record
+    return photo_match
@@ -0,0 +1,180 @@
+"""
+Distance threshold rules.
+
+Rules are compiled once per process and reused until a rule changes. Each
+process compares its compiled rules against the table's latest updated_at
+and row count, at most once every CHECK_INTERVAL seconds, so a rule edited
+through any worker takes effect everywhere within that interval (as does
+dropping rules compiled from an edit that was rolled back).
+"""
+import time
+from collections import namedtuple
+
+from django.db import transaction
+from django.db.models import Case, Count, F, Max, Q, Value, When
+from django.db.models.functions import TruncMonth
+from django.db.models.lookups import GreaterThan
+
+from accounts.models import TrainerProfile
+from .models import DistanceRule, MileageRecord, MileageRollup
+
+# Seconds a process trusts its compiled rules before checking the table again
+CHECK_INTERVAL = 5
+
+CompiledRule = namedtuple('CompiledRule', 'designation pu_code effective_from warning_km alert_km')
+
+_compiled = None  # (version, [CompiledRule, ...])
+_checked_at = 0.0  # time.monotonic() of the last version check
+
+
+def _version():
+    """Changes whenever a rule is added, edited or deleted"""
+    row = DistanceRule.objects.aggregate(latest=Max('updated_at'), count=Count('id'))
+    return row['latest'], row['count']
+
+
+def invalidate():
+    """Drop the compiled rules in this process; others notice on their next check"""
+    global _compiled
+    _compiled = None
+
+
+def compiled_rules():
+    """
+    All rules, most specific first (designation and PU code, PU code,
+    designation, everyone), then newest effective date first.
+    """
+    global _compiled, _checked_at
+    now = time.monotonic()
+    if _compiled is not None and now - _checked_at < CHECK_INTERVAL:
+        return _compiled[1]
+
+    version = _version()
+    if _compiled is not None and _compiled[0] == version:
+        _checked_at = now
+        return _compiled[1]
+
+    rules = [
+        CompiledRule(*row) for row in DistanceRule.objects.values_list(
+            'designation', 'pu_code', 'effective_from', 'warning_km', 'alert_km'
+        )
+    ]
+    rules.sort(key=lambda rule: (2 * bool(rule.pu_code) + bool(rule.designation), rule.effective_from),
+               reverse=True)
+    # Also cached inside transactions, where most saves run. A rule change commits with an
+    # on_commit invalidate(); if it rolls back instead, the next version check drops it.
+    _compiled = (version, rules)
+    _checked_at = now
+    return rules
+
+
+def matching_rules(designation, pu_code):
+    """Rules that apply to a trainer with this designation and PU code, in priority order"""
+    return [
+        rule for rule in compiled_rules()
+        if rule.designation in ('', designation) and rule.pu_code in ('', pu_code)
+    ]
+
+
+def thresholds_in(matching, day):
+    """(warning_km, alert_km) in force on the given day among rules from matching_rules()"""
+    for rule in matching:
+        if rule.effective_from <= day:
+            return rule.warning_km, rule.alert_km
+    return MileageRecord.WARNING_KM, MileageRecord.ALERT_KM
+
+
+def thresholds_for(designation, pu_code, day):
+    """(warning_km, alert_km) in force for this designation/PU code on the given day"""
+    return thresholds_in(matching_rules(designation, pu_code), day)
+
+
+def thresholds_for_trainer(trainer_id, day):
+    if not compiled_rules():
+        return MileageRecord.WARNING_KM, MileageRecord.ALERT_KM
+    profile = TrainerProfile.objects.filter(user_id=trainer_id).values_list('designation', 'pu_code').first()
+    designation, pu_code = profile or (None, None)
+    return thresholds_for(designation, pu_code, day)
+
+
+def status_expression(designation, pu_code, distance):
+    """SQL equivalent of thresholds_for + status_for_distance for one profile group"""
+    whens = []
+    for rule in matching_rules(designation, pu_code):
+        whens += [
+            When(Q(GreaterThan(distance, rule.alert_km), date__gte=rule.effective_from), then=Value('ALERT')),
+            When(Q(GreaterThan(distance, rule.warning_km), date__gte=rule.effective_from), then=Value('WARNING')),
+            When(date__gte=rule.effective_from, then=Value('OK')),
+        ]
+    if not whens:
+        return MileageRecord.status_expression(distance)
+    return Case(*whens, default=MileageRecord.status_expression(distance))
+
+
+def profile_groups(records):
+    """Distinct (designation, PU code) pairs among the records' trainers"""
+    return list(
+        records.order_by().values_list(
+            'trainer__trainerprofile__designation', 'trainer__trainerprofile__pu_code'
+        ).distinct()
+    )
+
+
+def stale_records(records, designation, pu_code):
+    """
+    Records of one profile group whose stored distance or status differ from
+    the current rules, annotated with new_distance and new_status.
+    """
+    distance = F('end_km') - F('start_km')
+    return records.filter(
+        trainer__trainerprofile__designation=designation,
+        trainer__trainerprofile__pu_code=pu_code,
+        start_km__isnull=False,
+        end_km__isnull=False,
+        end_km__gte=F('start_km'),
+    ).annotate(
+        new_distance=distance,
+        new_status=status_expression(designation, pu_code, distance),
+    ).filter(
+        Q(distance__isnull=True) | Q(status__isnull=True)
+        | ~Q(distance=F('new_distance')) | ~Q(status=F('new_status'))
+    )
+
+
+def apply_rules(ids, designation, pu_code):
+    """Rewrite distance and status for the given record ids with one UPDATE"""
+    distance = F('end_km') - F('start_km')
+    return MileageRecord.objects.filter(id__in=ids).update(
+        distance=distance,
+        status=status_expression(designation, pu_code, distance),
+    )
+
+
+def affected_buckets(records):
+    """(trainer_id, month) rollup buckets touched by the given records"""
+    return set(records.annotate(period=TruncMonth('date')).values_list('trainer_id', 'period').distinct())
+
+
+def reclassify(records, batch_size=1000, progress=None):
+    """
+    Bring distance and status of the given records in line with the current
+    rules, touching only rows that change. Updates run per profile group in
+    batches of ids; progress, if given, is called with the running total.
+    """
+    updated_count = 0
+    buckets = set()
+    with transaction.atomic():
+        for designation, pu_code in profile_groups(records):
+            stale = stale_records(records, designation, pu_code)
+            ids = list(stale.values_list('id', flat=True).order_by('id'))
+            if not ids:
+                continue
+            buckets |= affected_buckets(stale)
+            for offset in range(0, len(ids), batch_size):
+                updated_count += apply_rules(ids[offset:offset + batch_size], designation, pu_code)
+                if progress:
+                    progress(updated_count)
+
+        for trainer_id, period in buckets:
+            MileageRollup.refresh(trainer_id, period)
+    return updated_count
@@ -0,0 +1,218 @@
+"""
+Mileage submission service.
+
+The save and submit actions of submit_mileage and edit_mileage share one
+path: parse the form values, check the record can still change, store
+new photos, then apply the transition in a transaction that holds the
+record with select_for_update. Concurrent requests for the same trainer
+and day are serialised on that row instead of racing on unique
+(trainer, date) or on edit_count.
+"""
+from datetime import date
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import history
+from .models import MileageRecord, MileageRollup
+from .uploads import attach_images
+
+SAVE = 'save'
+SUBMIT = 'submit'
+EDIT = 'edit'
+
+MAX_EDITS = 2
+
+# Fields the draft autosave endpoint may patch
+AUTOSAVE_FIELDS = ('start_km', 'end_km')
+
+
+class SubmissionError(Exception):
+    """Form values that cannot be applied; `errors` are shown to the trainer"""
+
+    def __init__(self, errors):
+        super().__init__(' '.join(errors))
+        self.errors = errors
+
+
+class AlreadySubmitted(Exception):
+    """Today's record was submitted already"""
+
+    def __init__(self, record):
+        super().__init__('Mileage for today was already submitted.')
+        self.record = record
+
+
+class EditNotAllowed(Exception):
+    """The record cannot be edited by this user (any more)"""
+
+
+class DraftNotFound(Exception):
+    """There is no draft for today to autosave into"""
+
+
+def _parse_km(value, label, errors, suffix=''):
+    if not value:
+        errors.append(f'{label} is required{suffix}.')
+        return None
+    try:
+        km = int(float(value))
+    except (ValueError, OverflowError):
+        errors.append(f'{label} must be a valid number.')
+        return None
+    if km < 0:
+        errors.append(f'{label} cannot be negative.')
+        return None
+    return km
+
+
+def validate(action, start_km, end_km):
+    """
+    Parse the KM values for an action: (start, end, errors). Saving a
+    draft only needs start KM; an invalid end KM is left out.
+    """
+    suffix = ' for submission' if action == SUBMIT else ''
+    errors = []
+    start = _parse_km(start_km, 'Start KM', errors, suffix)
+    if action == SAVE:
+        end = _parse_km(end_km, 'End KM', []) if end_km else None
+    else:
+        end = _parse_km(end_km, 'End KM', errors, suffix)
+        if not errors and end <= start:
+            errors.append('End KM must be greater than Start KM.')
+    return start, end, errors
+
+
+def _apply(record, action, start_km, end_km, photos):
+    suffix = ' for submission' if action == SUBMIT else ''
+    for field, name in photos.items():
+        setattr(record, field, name)
+
+    errors = []
+    if not record.start_photo:
+        errors.append(f'Start Photo is required{suffix}.')
+    if action != SAVE and not record.end_photo:
+        errors.append(f'End Photo is required{suffix}.')
+    if errors:
+        raise SubmissionError(errors)
+
+    record.start_km = start_km
+    if end_km is not None:
+        record.end_km = end_km
+
+
+def ensure_open(user, day=None):
+    """
+    Raise AlreadySubmitted if the day's record is submitted. A cheap check
+    before photos are uploaded; submit() checks again under the row lock.
+    """
+    record = MileageRecord.objects.filter(trainer=user, date=day or date.today(), submission_status='SUBMITTED').first()
+    if record is not None:
+        raise AlreadySubmitted(record)
+
+
+def submit(user, action, start_km, end_km, photos, image_names=(), metadata=None, day=None):
+    """
+    Save (action SAVE) or submit today's record from validated values and
+    stored photo names ({field_name: name}); returns the record.
+    """
+    day = day or date.today()
+    for attempt in range(2):
+        try:
+            with transaction.atomic():
+                record = MileageRecord.objects.select_for_update().filter(trainer=user, date=day).first()
+                if record is not None and record.submission_status == 'SUBMITTED':
+                    raise AlreadySubmitted(record)
+                if record is None:
+                    record = MileageRecord(trainer=user, date=day)
+
+                _apply(record, action, start_km, end_km, photos)
+                record.submission_status = 'SUBMITTED' if action == SUBMIT else 'DRAFT'
+                record.save()
+                attach_images(record, image_names, metadata)
+                return record
+        except IntegrityError:
+            # A concurrent request created today's record first; apply to that one.
+            # Any other integrity failure is a real error.
+            if attempt or not MileageRecord.objects.filter(trainer=user, date=day).exists():
+                raise
+
+
+def edit(user, record_id, start_km, end_km, photos, image_names=(), metadata=None):
+    """Apply an edit to a submitted record, counting it against MAX_EDITS; returns the record"""
+    with transaction.atomic():
+        record = MileageRecord.objects.select_for_update().filter(pk=record_id).first()
+        if record is None:
+            raise EditNotAllowed('Record not found.')
+        if record.trainer_id != user.id:
+            raise EditNotAllowed('You can only edit your own records.')
+        if record.submission_status != 'SUBMITTED':
+            raise EditNotAllowed('You can only edit submitted records.')
+        if record.edit_count >= MAX_EDITS:
+            raise EditNotAllowed('You have reached the maximum edit limit for this record.')
+
+        before = history.snapshot(record)
+        _apply(record, EDIT, start_km, end_km, photos)
+        record.edit_count += 1
+        record.save()
+        history.record_change(record, before, user, history.EDIT)
+        attach_images(record, image_names, metadata)
+        return record
+
+
+def change_status(user, record_id, status):
+    """
+    Override a record's status (admins only) and record the change; returns
+    the record, or None if it does not exist. Written with update() because
+    save() recomputes the status from the distance. A later edit or rule
+    change recomputes it again.
+    """
+    with transaction.atomic():
+        record = MileageRecord.objects.select_for_update().filter(pk=record_id).first()
+        if record is None:
+            return None
+        before = history.snapshot(record)
+        record.status = status
+        record.updated_at = timezone.now()
+        MileageRecord.objects.filter(pk=record.pk).update(status=record.status, updated_at=record.updated_at)
+        MileageRollup.refresh(record.trainer_id, record.date)
+        history.record_change(record, before, user, history.STATUS)
+        return record
+
+
+def autosave(user, values, day=None):
+    """
+    Patch the KM fields given in `values` (a subset of AUTOSAVE_FIELDS) on
+    today's draft. Only values that differ are written. Returns the
+    record and the names of the fields that changed.
+    """
+    errors = []
+    changes = {}
+    if 'start_km' in values:
+        changes['start_km'] = _parse_km(str(values['start_km'] if values['start_km'] is not None else ''), 'Start KM', errors)
+    if 'end_km' in values:
+        end_km = values['end_km']
+        # Clearing end KM is allowed on a draft
+        changes['end_km'] = _parse_km(str(end_km), 'End KM', errors) if end_km not in (None, '') else None
+    if errors:
+        raise SubmissionError(errors)
+
+    with transaction.atomic():
+        record = MileageRecord.objects.select_for_update().filter(
+            trainer=user, date=day or date.today(), submission_status='DRAFT',
+        ).first()
+        if record is None:
+            raise DraftNotFound()
+
+        changed = [field for field, value in changes.items() if getattr(record, field) != value]
+        if not changed:
+            return record, []
+        for field in changed:
+            setattr(record, field, changes[field])
+        if record.end_km is not None and record.end_km <= record.start_km:
+            raise SubmissionError(['End KM must be greater than Start KM.'])
+        if record.end_km is None:
+            record.distance = record.status = None
+
+        record.save(update_fields=[*changed, 'distance', 'status', 'updated_at'])
+        return record, changed
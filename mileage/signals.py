@@ -0,0 +1,24 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.db import transaction
+from .models import DistanceRule, MileageRecord, MileageImage
+from . import blobs, rules
+
+@receiver(post_save, sender=DistanceRule)
+@receiver(post_delete, sender=DistanceRule)
+def distance_rule_changed(sender, instance, **kwargs):
+    rules.invalidate()
+    rules.reclassify(instance.affected_records())
+    # Other workers may have recompiled from the old rows before this commit
+    transaction.on_commit(rules.invalidate)
+
+
+@receiver(post_delete, sender=MileageRecord)
+def release_record_photos(sender, instance, **kwargs):
+    for name in instance.photo_names().values():
+        blobs.release(name)
+
+
+@receiver(post_delete, sender=MileageImage)
+def release_image(sender, instance, **kwargs):
+    blobs.release(instance.image.name)
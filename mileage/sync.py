@@ -0,0 +1,270 @@
+"""
+Batch sync of mileage entries queued offline.
+
+A trainer without signal keeps filling in days on the device; once back
+online the client posts the queued entries in one request. Photos are sent
+ahead through chunked uploads (see chunked.py) and referenced by token.
+
+Every entry carries its own idempotency key, so a batch that is retried
+after a dropped response replays the entries that were applied instead of
+writing them twice. The batch is validated as a whole, then all valid
+entries are upserted in one transaction: the existing records for the
+batch's dates are locked with one select_for_update, new days go in with
+bulk_create and drafts are updated with bulk_update. Entries that fail
+validation are reported per entry and do not block the rest.
+"""
+from datetime import date, timedelta
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from jobs.queue import enqueue_many
+from . import blobs
+from .models import IdempotencyKey, MileageRecord, MileageRollup, month_start
+from .services import SAVE, SUBMIT, SubmissionError, _apply, validate
+from .uploads import attach_images, finished_uploads
+from .utils import derivatives_stale
+
+MAX_BATCH = 31
+# How far back a queued entry may be dated
+MAX_AGE = timedelta(days=31)
+# Offline clients may retry a batch days later
+SYNC_KEY_TTL = timedelta(days=7)
+SCOPE = 'sync'
+
+PHOTO_FIELDS = ('start_photo', 'end_photo')
+UPDATE_FIELDS = [
+    'start_km', 'end_km', 'start_photo', 'end_photo',
+    'distance', 'status', 'submission_status', 'updated_at',
+]
+
+
+def _key(entry):
+    key = entry.get('idempotency_key')
+    return str(key)[:100] if key else None
+
+
+def _parse(entry, today, seen_keys, seen_days):
+    """Validate one entry without touching the database: (fields, errors)"""
+    errors = []
+    key = _key(entry)
+    if not key:
+        errors.append('idempotency_key is required.')
+    elif key in seen_keys:
+        errors.append('idempotency_key is repeated in this batch.')
+
+    day = None
+    try:
+        day = parse_date(str(entry.get('date') or ''))
+    except ValueError:
+        pass
+    if day is None:
+        errors.append('Date must be given as YYYY-MM-DD.')
+    elif day > today:
+        errors.append('Date cannot be in the future.')
+    elif day < today - MAX_AGE:
+        errors.append(f'Entries older than {MAX_AGE.days} days cannot be synced.')
+    elif day in seen_days:
+        errors.append('Another entry in this batch is for the same date.')
+
+    action = entry.get('action') or SAVE
+    if action not in (SAVE, SUBMIT):
+        errors.append("Action must be 'save' or 'submit'.")
+        action = SAVE
+
+    start_km, end_km, km_errors = validate(
+        action,
+        '' if entry.get('start_km') is None else str(entry['start_km']),
+        '' if entry.get('end_km') is None else str(entry['end_km']),
+    )
+    errors += km_errors
+    if key:
+        seen_keys.add(key)
+    if day:
+        seen_days.add(day)
+    return {'key': key, 'date': day, 'action': action, 'start_km': start_km, 'end_km': end_km}, errors
+
+
+def _tokens(entry):
+    photos = {field: entry.get(f'{field}_upload') for field in PHOTO_FIELDS}
+    photos = {field: str(token) for field, token in photos.items() if token}
+    images = entry.get('image_uploads') or []
+    return photos, [str(token) for token in images] if isinstance(images, list) else None
+
+
+def _resolve(entry, uploads):
+    """Stored names for an entry's upload tokens: (photos, image names, metadata, errors)"""
+    photos, images = _tokens(entry)
+    if images is None:
+        return {}, [], {}, ['image_uploads must be a list of upload tokens.']
+    errors = [f'Upload {token} is not finished or unknown.' for token in [*photos.values(), *images]
+              if token not in uploads]
+    if errors:
+        return {}, [], {}, errors
+
+    claimed = [uploads[token] for token in [*photos.values(), *images]]
+    metadata = {upload.stored_name: upload.metadata for upload in claimed if upload.metadata}
+    return (
+        {field: uploads[token].stored_name for field, token in photos.items()},
+        [uploads[token].stored_name for token in images],
+        metadata,
+        [],
+    )
+
+
+def _error(index, errors, key=None, day=None):
+    return {
+        'index': index,
+        'idempotency_key': key,
+        'date': day.isoformat() if day else None,
+        'result': 'error',
+        'errors': errors,
+    }
+
+
+def _outcome(index, key, record, result):
+    return {
+        'index': index,
+        'idempotency_key': key,
+        'date': record.date.isoformat(),
+        'result': result,
+        'record': record.pk,
+        'submission_status': record.submission_status,
+        'distance': record.distance,
+        'status': record.status,
+    }
+
+
+def sync(user, entries, today=None):
+    """
+    Apply a batch of queued day entries for `user`. Each entry is a dict
+    with date, action ('save' or 'submit'), start_km, end_km,
+    idempotency_key and optional start_photo_upload, end_photo_upload and
+    image_uploads tokens. Returns one result dict per entry, in order.
+    """
+    today = today or date.today()
+    results = [None] * len(entries)
+    pending = []
+    seen_keys, seen_days = set(), set()
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            results[index] = _error(index, ['Entry must be an object.'])
+            continue
+        fields, errors = _parse(entry, today, seen_keys, seen_days)
+        if errors:
+            results[index] = _error(index, errors, fields['key'], fields['date'])
+        else:
+            pending.append((index, entry, fields))
+
+    tokens = []
+    for _, entry, _ in pending:
+        photos, images = _tokens(entry)
+        tokens += [*photos.values(), *(images or [])]
+    uploads = finished_uploads(user, tokens)
+
+    valid = []
+    for index, entry, fields in pending:
+        photos, image_names, metadata, errors = _resolve(entry, uploads)
+        if errors:
+            results[index] = _error(index, errors, fields['key'], fields['date'])
+        else:
+            valid.append((index, dict(fields, photos=photos, images=image_names, metadata=metadata)))
+
+    if valid:
+        for attempt in range(2):
+            try:
+                _upsert(user, valid, results)
+                break
+            except IntegrityError:
+                # A live submission created one of these days first; redo the batch against it
+                if attempt:
+                    raise
+    return results
+
+
+def _upsert(user, valid, results):
+    now = timezone.now()
+    saved = []
+    with transaction.atomic():
+        keys = IdempotencyKey.objects.select_for_update().select_related('record').filter(
+            user=user, key__in=[fields['key'] for _, fields in valid],
+        )
+        keys = {entry.key: entry for entry in keys}
+        IdempotencyKey.objects.filter(pk__in=[
+            entry.pk for entry in keys.values() if entry.expires_at <= now
+        ]).delete()
+
+        todo = []
+        for index, fields in valid:
+            entry = keys.get(fields['key'])
+            if entry is None or entry.expires_at <= now:
+                todo.append((index, fields))
+            elif entry.scope != SCOPE or entry.record is None or entry.record.date != fields['date']:
+                results[index] = _error(index, ['idempotency_key was already used for another request.'],
+                                        fields['key'], fields['date'])
+            else:
+                results[index] = _outcome(index, fields['key'], entry.record, 'replayed')
+
+        records = MileageRecord.objects.select_for_update().filter(
+            trainer=user, date__in=[fields['date'] for _, fields in todo],
+        )
+        records = {record.date: record for record in records}
+
+        created, updated, released = [], [], []
+        for index, fields in todo:
+            record = records.get(fields['date'])
+            if record is not None and record.submission_status == 'SUBMITTED':
+                results[index] = _error(index, ['Mileage for this date was already submitted.'],
+                                        fields['key'], fields['date'])
+                continue
+            new = record is None
+            if new:
+                record = MileageRecord(trainer=user, date=fields['date'])
+            try:
+                _apply(record, fields['action'], fields['start_km'], fields['end_km'], fields['photos'])
+            except SubmissionError as e:
+                results[index] = _error(index, e.errors, fields['key'], fields['date'])
+                continue
+            record.submission_status = 'SUBMITTED' if fields['action'] == SUBMIT else 'DRAFT'
+            record.compute_distance()
+            record.updated_at = now
+            (created if new else updated).append(record)
+            saved.append((index, fields, record, 'created' if new else 'updated'))
+
+        # bulk_create/bulk_update skip MileageRecord.save: keep rollups and blob references in step here
+        MileageRecord.objects.bulk_create(created)
+        MileageRecord.objects.bulk_update(updated, UPDATE_FIELDS)
+        for trainer_id, period in {(record.trainer_id, month_start(record.date)) for record in created + updated}:
+            MileageRollup.refresh(trainer_id, period)
+
+        acquired, jobs = [], []
+        for record in created + updated:
+            stored = getattr(record, '_stored_photos', {})
+            changed = record.changed_photos()
+            for field in changed:
+                acquired.append(getattr(record, field).name)
+                released.append(stored.get(field))
+            record._stored_photos = record.photo_names()
+            # Only new photos need derivatives; an undecodable old one is not queued again
+            fields = [field for field in changed if derivatives_stale(record, field)]
+            if fields:
+                jobs.append({'model': 'record', 'pk': record.pk, 'fields': fields})
+        blobs.acquire(acquired)
+
+        for index, fields, record, result in saved:
+            attach_images(record, fields['images'], fields['metadata'])
+            results[index] = _outcome(index, fields['key'], record, result)
+
+        IdempotencyKey.objects.bulk_create([
+            IdempotencyKey(
+                user=user, key=fields['key'], scope=SCOPE, status='DONE', record=record,
+                result={'result': result}, expires_at=now + SYNC_KEY_TTL,
+            )
+            for index, fields, record, result in saved
+        ])
+
+        for name in released:
+            blobs.release(name)
+
+    enqueue_many('mileage.build_derivatives', jobs)
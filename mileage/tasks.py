@@ -0,0 +1,39 @@
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+from jobs.queue import task
+from .models import MileageRecord, MileageImage, StoredBlob
+from .utils import refresh_derivatives
+from . import phash
+
+DERIVATIVE_MODELS = {
+    'record': MileageRecord,
+    'image': MileageImage,
+}
+
+
+@task('mileage.build_derivatives')
+def build_derivatives(model, pk, fields):
+    """Generate thumbnail/display copies for new photos and add them to the duplicate index"""
+    instance = DERIVATIVE_MODELS[model].objects.filter(pk=pk).first()
+    if instance is None:
+        # Deleted before the worker got to it
+        return
+    refresh_derivatives(instance, fields)
+    phash.index(instance, fields)
+
+
+@task('mileage.delete_blob')
+def delete_blob(sha256, unused_since=None):
+    """Remove a blob nothing references any more, with its derivatives"""
+    storage = MileageRecord._meta.get_field('start_photo').storage
+    with transaction.atomic():
+        candidates = StoredBlob.objects.select_for_update().filter(sha256=sha256, ref_count=0)
+        if unused_since:
+            candidates = candidates.filter(last_used_at__lt=parse_datetime(unused_since))
+        blob = candidates.first()
+        if blob is None:
+            # Referenced or handed out for reuse since the deletion was queued
+            return
+        blob.delete()
+        for name in filter(None, [blob.name, blob.thumb_name, blob.display_name]):
+            storage.delete(name)
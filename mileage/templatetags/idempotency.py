@@ -0,0 +1,14 @@
+import uuid
+
+from django import template
+from django.utils.html import format_html
+
+from mileage.idempotency import KEY_FIELD
+
+register = template.Library()
+
+
+@register.simple_tag
+def idempotency_field():
+    """Hidden input with a fresh idempotency key for a submission form"""
+    return format_html('<input type="hidden" name="{}" value="{}">', KEY_FIELD, uuid.uuid4().hex)
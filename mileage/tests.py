@@ -1,3 +1,560 @@
-from django.test import TestCase
+import hashlib
+import io
+import shutil
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+
+from jobs.models import Job
+from . import blobs, history, idempotency, rules, services, sync, utils
+from .models import (ChunkedUpload, DistanceRule, IdempotencyKey, MileageImage, MileageRecord, RecordVersion,
+                     StoredBlob)
+from .uploads import upload_files, upload_photos
+
+
+def jpeg(name='photo.jpg', color='red'):
+    buffer = io.BytesIO()
+    Image.new('RGB', (40, 30), color).save(buffer, 'JPEG')
+    return SimpleUploadedFile(name, buffer.getvalue(), 'image/jpeg')
+
+
+def run_jobs():
+    call_command('run_jobs', '--once', stdout=io.StringIO())
+
+
+class MediaTestCase(TestCase):
+    """Stores media and upload spool files in a temporary directory"""
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=f'{root}/media', UPLOAD_SPOOL_DIR=f'{root}/spool')
+        media.enable()
+        self.addCleanup(media.disable)
+        self.user = User.objects.create_user('trainer', 'trainer@example.com', 'password')
+        self.client.force_login(self.user)
+
+    def save_draft(self, **data):
+        return self.client.post('/mileage/submit/', {'action': 'save', 'start_km': '10', **data})
+
+
+class RecordingStorage(FileSystemStorage):
+    """
+    Local storage that records how many saves run at once. With `parties`,
+    each save waits until that many are in flight, so uploads that do not
+    overlap fail with BrokenBarrierError instead of depending on timing.
+    """
+
+    def __init__(self, *args, parties=None, fail_on=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.barrier = threading.Barrier(parties, timeout=10) if parties else None
+        self.fail_on = fail_on
+        self.lock = threading.Lock()
+        self.active = self.peak = 0
+
+    def _save(self, name, content):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        try:
+            if self.barrier:
+                self.barrier.wait()
+            else:
+                # Stand-in for a network round-trip, so bounded pools get a chance to overlap
+                time.sleep(0.01)
+            if self.fail_on and content.name == self.fail_on:
+                raise OSError('upload rejected')
+            return super()._save(name, content)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+class UploadFilesTests(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.field = MileageImage._meta.get_field('image')
+
+    def files(self, count):
+        return [SimpleUploadedFile(f'photo{i}.jpg', f'content {i}'.encode()) for i in range(count)]
+
+    def test_uploads_run_concurrently(self):
+        storage = RecordingStorage(location=self.root, parties=4)
+        upload_files([(self.field, content) for content in self.files(4)], storage, max_workers=4)
+
+        self.assertEqual(storage.peak, 4)
+        self.assertEqual(StoredBlob.objects.count(), 4)
+
+    def test_pool_is_bounded(self):
+        storage = RecordingStorage(location=self.root)
+        upload_files([(self.field, content) for content in self.files(6)], storage, max_workers=2)
+
+        self.assertLessEqual(storage.peak, 2)
+        self.assertEqual(StoredBlob.objects.count(), 6)
+
+    def test_names_keep_input_order(self):
+        storage = RecordingStorage(location=self.root)
+        files = self.files(3)
+        # The repeated file is stored once but still gets a name in its position
+        files.append(SimpleUploadedFile('again.jpg', b'content 0'))
+
+        names = upload_files([(self.field, content) for content in files], storage)
+
+        expected = [blobs.blob_name(blobs.content_hash(content), content.name) for content in files]
+        self.assertEqual(names, expected)
+        self.assertEqual(names[0], names[3])
+        self.assertEqual(StoredBlob.objects.count(), 3)
+
+    def test_storage_error_propagates(self):
+        storage = RecordingStorage(location=self.root, fail_on='photo1.jpg')
+        uploads = [(self.field, content) for content in self.files(3)]
+
+        with self.assertRaises(OSError):
+            upload_files(uploads, storage)
+        self.assertFalse(StoredBlob.objects.exists())
+
+    def test_upload_photos_splits_record_photos_and_images(self):
+        storage = RecordingStorage(location=self.root)
+        start, end, *images = self.files(4)
+
+        photo_names, image_names, _ = upload_photos({'start_photo': start, 'end_photo': end}, images, storage)
+
+        self.assertEqual(list(photo_names), ['start_photo', 'end_photo'])
+        self.assertTrue(photo_names['start_photo'].startswith(f'{blobs.BLOB_DIR}/'))
+        self.assertEqual(len(set(photo_names.values()) | set(image_names)), 4)
+        self.assertEqual(image_names, [blobs.blob_name(blobs.content_hash(f), f.name) for f in images])
+
+
+class BlobReferenceTests(MediaTestCase):
+    def blob(self, name):
+        return StoredBlob.objects.get(name=name)
+
+    def test_records_hold_one_reference_per_photo(self):
+        self.save_draft(start_photo=jpeg(), images=[jpeg('extra.jpg', 'blue')])
+        record = MileageRecord.objects.get()
+        self.assertEqual(self.blob(record.start_photo.name).ref_count, 1)
+        self.assertEqual(self.blob(record.images.get().image.name).ref_count, 1)
+
+    def test_same_content_is_stored_once(self):
+        self.save_draft(start_photo=jpeg(), images=[jpeg('copy.jpg')])
+        self.assertEqual(StoredBlob.objects.get().ref_count, 2)
+
+    def test_replaced_photo_is_released_but_not_deleted(self):
+        self.save_draft(start_photo=jpeg())
+        old = MileageRecord.objects.get().start_photo.name
+        self.save_draft(start_photo=jpeg('new.jpg', 'green'))
+
+        self.assertEqual(self.blob(old).ref_count, 0)
+        self.assertFalse(Job.objects.filter(task='mileage.delete_blob').exists())
+        run_jobs()
+        self.assertTrue(default_storage.exists(old))
+
+    def test_gc_deletes_blobs_unused_past_the_grace_period(self):
+        self.save_draft(start_photo=jpeg())
+        old = MileageRecord.objects.get().start_photo.name
+        self.save_draft(start_photo=jpeg('new.jpg', 'green'))
+
+        call_command('gc_blobs', stdout=io.StringIO())
+        run_jobs()
+        self.assertTrue(StoredBlob.objects.filter(name=old).exists())
+
+        StoredBlob.objects.filter(name=old).update(last_used_at=timezone.now() - timedelta(hours=blobs.GRACE_HOURS + 1))
+        call_command('gc_blobs', stdout=io.StringIO())
+        run_jobs()
+        self.assertFalse(StoredBlob.objects.filter(name=old).exists())
+        self.assertFalse(default_storage.exists(old))
+
+    def test_blob_reused_after_gc_queued_it_survives(self):
+        self.save_draft(start_photo=jpeg())
+        old = self.blob(MileageRecord.objects.get().start_photo.name)
+        self.save_draft(start_photo=jpeg('new.jpg', 'green'))
+        StoredBlob.objects.filter(pk=old.pk).update(last_used_at=timezone.now() - timedelta(hours=blobs.GRACE_HOURS + 1))
+        call_command('gc_blobs', stdout=io.StringIO())
+
+        # An upload of the same content reuses the blob before the deletion runs
+        self.assertEqual(blobs.existing([old.sha256]), {old.sha256: old.name})
+        run_jobs()
+        self.assertTrue(StoredBlob.objects.filter(pk=old.pk).exists())
+        self.assertTrue(default_storage.exists(old.name))
+
+    def test_gc_repairs_drifted_counts(self):
+        self.save_draft(start_photo=jpeg())
+        name = MileageRecord.objects.get().start_photo.name
+        StoredBlob.objects.filter(name=name).update(ref_count=5)
+        call_command('gc_blobs', stdout=io.StringIO())
+        self.assertEqual(self.blob(name).ref_count, 1)
+
+
+class ChunkedUploadTests(MediaTestCase):
+    def start(self, data, sha256=None):
+        response = self.client.post('/mileage/uploads/', {
+            'filename': 'photo.jpg', 'size': len(data), 'sha256': sha256 or hashlib.sha256(data).hexdigest(),
+        })
+        return response.json()
+
+    def put(self, token, offset, data):
+        return self.client.put(f'/mileage/uploads/{token}/', data, content_type='application/octet-stream',
+                               headers={'Upload-Offset': str(offset)})
+
+    def upload(self, data):
+        token = self.start(data)['token']
+        self.put(token, 0, data)
+        return ChunkedUpload.objects.get(token=token)
+
+    def test_dropped_upload_resumes_from_its_offset(self):
+        data = jpeg().read()
+        token = self.start(data)['token']
+        self.put(token, 0, data[:500])
+
+        resumed = self.start(data)
+        self.assertEqual((resumed['token'], resumed['offset']), (token, 500))
+        self.assertEqual(self.put(token, 0, data[:500]).status_code, 409)
+        response = self.put(token, 500, data[500:])
+        self.assertTrue(response.json()['complete'])
+
+    def test_checksum_mismatch_fails_the_upload(self):
+        data = jpeg().read()
+        token = self.start(data, sha256='0' * 64)['token']
+        self.assertEqual(self.put(token, 0, data).status_code, 422)
+        self.assertEqual(ChunkedUpload.objects.get(token=token).status, 'FAILED')
+        self.assertFalse(StoredBlob.objects.exists())
+
+    def test_finished_upload_holds_a_blob_reference(self):
+        upload = self.upload(jpeg().read())
+        self.assertEqual(StoredBlob.objects.get(name=upload.stored_name).ref_count, 1)
+
+        StoredBlob.objects.update(last_used_at=timezone.now() - timedelta(hours=blobs.GRACE_HOURS + 1))
+        call_command('gc_blobs', stdout=io.StringIO())
+        run_jobs()
+        # Still claimable, so the file must still be there
+        self.assertTrue(default_storage.exists(upload.stored_name))
+        self.assertEqual(self.start(jpeg().read())['token'], str(upload.token))
+
+    def test_claimed_upload_is_referenced_by_the_record(self):
+        upload = self.upload(jpeg().read())
+        self.save_draft(start_photo_upload=str(upload.token))
+
+        record = MileageRecord.objects.get()
+        self.assertEqual(record.start_photo.name, upload.stored_name)
+        self.assertEqual(StoredBlob.objects.get(name=upload.stored_name).ref_count, 2)
+
+    def test_purge_releases_the_upload_reference(self):
+        upload = self.upload(jpeg().read())
+        self.save_draft(start_photo_upload=str(upload.token))
+        ChunkedUpload.objects.update(updated_at=timezone.now() - timedelta(hours=blobs.GRACE_HOURS + 1))
+
+        call_command('purge_uploads', stdout=io.StringIO())
+        self.assertFalse(ChunkedUpload.objects.exists())
+        self.assertEqual(StoredBlob.objects.get(name=upload.stored_name).ref_count, 1)
+
+
+class DerivativeQueueTests(MediaTestCase):
+    def pending(self):
+        return Job.objects.filter(task='mileage.build_derivatives', status='PENDING').count()
+
+    def test_only_a_new_photo_is_queued(self):
+        self.save_draft(start_photo=jpeg())
+        for km in (20, 30, 40):
+            services.autosave(self.user, {'start_km': km})
+        self.save_draft(start_km='50')
+        self.assertEqual(self.pending(), 1)
+
+        self.save_draft(start_photo=jpeg('new.jpg', 'green'))
+        self.assertEqual(self.pending(), 2)
+
+    def test_undecodable_photo_is_not_retried(self):
+        name = upload_files([(MileageRecord._meta.get_field('start_photo'),
+                              SimpleUploadedFile('broken.jpg', b'not an image'))])[0]
+        record = MileageRecord(trainer=self.user, date=timezone.localdate(), start_km=10, start_photo=name)
+        record.save()
+        run_jobs()
+        self.assertTrue(StoredBlob.objects.get(name=name).undecodable)
+
+        record.start_km = 20
+        record.save()
+        self.assertEqual(self.pending(), 0)
+        with mock.patch.object(utils, 'build_derivatives') as build:
+            utils.refresh_derivatives(MileageRecord.objects.get(pk=record.pk), ['start_photo'])
+        build.assert_not_called()
+
+
+class CompiledRulesTests(TestCase):
+    PHOTOS = {'start_photo': 'start/start.jpg', 'end_photo': 'end/end.jpg'}
+
+    def setUp(self):
+        # Test transactions roll back without on_commit, so start every test from the table
+        rules.invalidate()
+        self.addCleanup(rules.invalidate)
+        self.user = User.objects.create_user('trainer', 'trainer@example.com', 'password')
+        DistanceRule.objects.create(effective_from=date(2020, 1, 1), warning_km=50, alert_km=80)
+
+    def test_saves_in_transactions_reuse_the_compiled_rules(self):
+        with CaptureQueriesContext(connection) as queries:
+            for day in range(1, 4):
+                services.submit(self.user, services.SUBMIT, 10, 70, self.PHOTOS, day=date(2024, 1, day))
+        rule_queries = [q for q in queries if 'mileage_distancerule' in q['sql']]
+        # One version check and one fetch for all three saves
+        self.assertEqual(len(rule_queries), 2)
+        self.assertEqual(MileageRecord.objects.filter(status='WARNING').count(), 3)
+
+    def test_rule_change_applies_to_the_next_save(self):
+        services.submit(self.user, services.SUBMIT, 10, 70, self.PHOTOS, day=date(2024, 1, 1))
+        DistanceRule.objects.create(effective_from=date(2021, 1, 1), warning_km=100, alert_km=200)
+        record = services.submit(self.user, services.SUBMIT, 10, 70, self.PHOTOS, day=date(2024, 1, 2))
+        self.assertEqual(record.status, 'OK')
+
+    def test_rules_from_a_rolled_back_edit_are_dropped_at_the_next_check(self):
+        with transaction.atomic():
+            DistanceRule.objects.create(effective_from=date(2021, 1, 1), warning_km=100, alert_km=200)
+            self.assertEqual(len(rules.compiled_rules()), 2)
+            transaction.set_rollback(True)
+
+        rules._checked_at -= rules.CHECK_INTERVAL
+        self.assertEqual(len(rules.compiled_rules()), 1)
+
+
+class SubmitTests(MediaTestCase):
+    def submit(self, **data):
+        return self.client.post('/mileage/submit/', {
+            'action': 'submit', 'start_km': '10', 'end_km': '40', **data,
+        })
+
+    def test_repeated_submit_uploads_nothing(self):
+        self.submit(start_photo=jpeg(), end_photo=jpeg('end.jpg', 'blue'))
+        blobs_before = StoredBlob.objects.count()
+
+        response = self.submit(start_photo=jpeg('other.jpg', 'green'), end_photo=jpeg('end2.jpg', 'yellow'))
+        self.assertTemplateUsed(response, 'mileage/already_submitted.html')
+        self.assertEqual(StoredBlob.objects.count(), blobs_before)
+
+    def test_unrelated_integrity_error_is_not_retried(self):
+        calls = []
+
+        def fail(*args, **kwargs):
+            calls.append(1)
+            raise IntegrityError('other constraint')
+
+        with mock.patch.object(MileageRecord, 'save', fail), self.assertRaises(IntegrityError):
+            services.submit(self.user, services.SAVE, 10, None, {'start_photo': 'start/start.jpg'})
+        self.assertEqual(len(calls), 1)
+
+    def test_conflict_with_a_concurrent_draft_is_retried(self):
+        MileageRecord.objects.create(trainer=self.user, date=date.today(), start_km=5, start_photo='start/other.jpg')
+        real_select_for_update = MileageRecord.objects.select_for_update
+        lookups = []
+
+        def select_for_update(*args, **kwargs):
+            lookups.append(1)
+            if len(lookups) == 1:
+                # The first lookup runs before the concurrent request's draft commits
+                return MileageRecord.objects.none()
+            return real_select_for_update(*args, **kwargs)
+
+        with mock.patch.object(MileageRecord.objects, 'select_for_update', select_for_update):
+            record = services.submit(self.user, services.SAVE, 10, None, {'start_photo': 'start/start.jpg'})
+        self.assertEqual(len(lookups), 2)
+        self.assertEqual(MileageRecord.objects.get().pk, record.pk)
+        self.assertEqual(record.start_km, 10)
+
+
+class HistoryTests(TestCase):
+    PHOTOS = {'start_photo': 'start/start.jpg', 'end_photo': 'end/end.jpg'}
+
+    def setUp(self):
+        rules.invalidate()
+        self.addCleanup(rules.invalidate)
+        self.user = User.objects.create_user('trainer', 'trainer@example.com', 'password')
+        self.record = services.submit(self.user, services.SUBMIT, 10, 40, self.PHOTOS)
+
+    def test_timeline_rebuilds_every_version(self):
+        services.edit(self.user, self.record.pk, 10, 90, {})
+        services.edit(self.user, self.record.pk, 20, 90, {'start_photo': 'start/new.jpg'})
+
+        entries = history.timeline(MileageRecord.objects.get(pk=self.record.pk))
+        self.assertEqual([version and version.version for version, _ in entries], [None, 1, 2])
+        self.assertEqual([(state['start_km'], state['end_km'], state['edit_count']) for _, state in entries],
+                         [(10, 40, 0), (10, 90, 1), (20, 90, 2)])
+        self.assertEqual([state['start_photo'] for _, state in entries],
+                         ['start/start.jpg', 'start/start.jpg', 'start/new.jpg'])
+        self.assertEqual(entries[1][1]['distance'], 80)
+
+    def test_versions_hold_only_changed_fields(self):
+        services.edit(self.user, self.record.pk, 10, 45, {})
+        self.assertEqual(RecordVersion.objects.get().changes,
+                         {'end_km': [40, 45], 'distance': [30, 35], 'edit_count': [0, 1]})
+
+    def test_admin_status_override_is_kept_and_recorded(self):
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(admin)
+        self.client.post(f'/mileage/change-status/{self.record.pk}/', {'status': 'ALERT'})
+
+        self.assertEqual(MileageRecord.objects.get(pk=self.record.pk).status, 'ALERT')
+        version = RecordVersion.objects.get()
+        self.assertEqual((version.source, version.changed_by, version.changes),
+                         (history.STATUS, admin, {'status': ['OK', 'ALERT']}))
+
+    def test_status_change_requires_an_admin(self):
+        self.client.force_login(self.user)
+        response = self.client.post(f'/mileage/change-status/{self.record.pk}/', {'status': 'ALERT'})
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(MileageRecord.objects.get(pk=self.record.pk).status, 'OK')
+
+    def test_history_page_shows_a_past_version(self):
+        services.edit(self.user, self.record.pk, 10, 90, {})
+        self.client.force_login(self.user)
+        response = self.client.get(f'/mileage/history/{self.record.pk}/', {'version': 0})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['selected'], 0)
+        self.assertIn(('End Km', 40), response.context['state'])
+
+
+class IdempotencyTests(MediaTestCase):
+    def post(self, key, **data):
+        return self.client.post('/mileage/submit/', {
+            'action': 'save', 'start_km': '10', 'start_photo': jpeg(), 'idempotency_key': key, **data,
+        })
+
+    def test_repeated_key_replays_the_first_outcome(self):
+        first = self.post('tap-1')
+        with mock.patch('mileage.views.receive_photos') as receive:
+            second = self.post('tap-1', start_km='99')
+
+        receive.assert_not_called()
+        self.assertEqual(MileageRecord.objects.get().start_km, 10)
+        self.assertEqual([t.name for t in second.templates][:1], [t.name for t in first.templates][:1])
+        self.assertEqual(IdempotencyKey.objects.get().status, 'DONE')
+
+    def test_failed_request_releases_its_key(self):
+        self.post('tap-1', start_km='')
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+        self.post('tap-1')
+        self.assertEqual(MileageRecord.objects.get().start_km, 10)
+
+    def test_header_key_works_like_the_form_field(self):
+        headers = {idempotency.HEADER: 'header-1'}
+        data = {'action': 'save', 'start_km': '10'}
+        self.client.post('/mileage/submit/', {**data, 'start_photo': jpeg()}, headers=headers)
+        self.client.post('/mileage/submit/', {**data, 'start_km': '99', 'start_photo': jpeg()}, headers=headers)
+        self.assertEqual(MileageRecord.objects.get().start_km, 10)
+
+    def test_key_used_for_another_form_is_rejected(self):
+        self.post('tap-1')
+        record = MileageRecord.objects.get()
+        response = self.client.post(f'/mileage/edit/{record.pk}/', {'idempotency_key': 'tap-1'})
+        self.assertEqual(response.status_code, 409)
+
+    def test_request_still_running_is_not_repeated(self):
+        IdempotencyKey.objects.create(user=self.user, key='tap-1', scope='submit',
+                                      expires_at=timezone.now() + idempotency.IDEMPOTENCY_TTL)
+        response = self.post('tap-1')
+        self.assertRedirects(response, '/mileage/dashboard/', fetch_redirect_response=False)
+        self.assertFalse(MileageRecord.objects.exists())
+
+    def test_abandoned_and_expired_keys_can_be_claimed_again(self):
+        now = timezone.now()
+        abandoned = IdempotencyKey.objects.create(user=self.user, key='tap-1', scope='submit',
+                                                  expires_at=now + idempotency.IDEMPOTENCY_TTL)
+        IdempotencyKey.objects.filter(pk=abandoned.pk).update(
+            created_at=now - idempotency.PENDING_TIMEOUT - timedelta(seconds=1))
+        self.post('tap-1')
+        self.assertEqual(MileageRecord.objects.count(), 1)
+
+        IdempotencyKey.objects.update(expires_at=now)
+        call_command('purge_idempotency_keys', stdout=io.StringIO())
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+
+class SyncTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.today = date.today()
+
+    def sync(self, *entries):
+        response = self.client.post('/mileage/sync/', {'entries': list(entries)}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()['results']
+
+    def entry(self, key, days_ago=1, **fields):
+        return {'idempotency_key': key, 'date': (self.today - timedelta(days=days_ago)).isoformat(),
+                'action': 'save', 'start_km': 10, **fields}
+
+    def upload(self):
+        data = jpeg().read()
+        token = self.client.post('/mileage/uploads/', {
+            'filename': 'photo.jpg', 'size': len(data), 'sha256': hashlib.sha256(data).hexdigest(),
+        }).json()['token']
+        self.client.put(f'/mileage/uploads/{token}/', data, content_type='application/octet-stream',
+                        headers={'Upload-Offset': '0'})
+        return ChunkedUpload.objects.get(token=token)
+
+    def test_retried_batch_replays_instead_of_writing_again(self):
+        upload = self.upload()
+        entry = self.entry('day-1', start_photo_upload=str(upload.token))
+
+        self.assertEqual(self.sync(entry)[0]['result'], 'created')
+        record = MileageRecord.objects.get()
+        self.assertEqual(record.start_photo.name, upload.stored_name)
+        # The upload's own reference plus the record's
+        self.assertEqual(StoredBlob.objects.get(name=upload.stored_name).ref_count, 2)
+        self.assertEqual(Job.objects.filter(task='mileage.build_derivatives').count(), 1)
+
+        result = self.sync(entry)[0]
+        self.assertEqual((result['result'], result['record']), ('replayed', record.pk))
+        self.assertEqual(MileageRecord.objects.count(), 1)
+        self.assertEqual(StoredBlob.objects.get(name=upload.stored_name).ref_count, 2)
+        self.assertEqual(Job.objects.filter(task='mileage.build_derivatives').count(), 1)
+
+    def test_draft_is_updated_and_submitted(self):
+        upload = self.upload()
+        self.sync(self.entry('day-1', start_photo_upload=str(upload.token)))
+        end = self.upload()
+
+        result = self.sync(self.entry('day-1b', action='submit', end_km=50, end_photo_upload=str(end.token)))[0]
+        self.assertEqual((result['result'], result['submission_status'], result['distance']),
+                         ('updated', 'SUBMITTED', 40))
+
+    def test_submitted_day_is_not_changed(self):
+        photo = self.upload().stored_name
+        MileageRecord.objects.create(trainer=self.user, date=self.today - timedelta(days=1), start_km=1, end_km=2,
+                                     start_photo=photo, end_photo=photo, submission_status='SUBMITTED')
+        result = self.sync(self.entry('day-1', start_photo_upload=str(self.upload().token)))[0]
+        self.assertEqual(result['errors'], ['Mileage for this date was already submitted.'])
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_key_reused_for_another_day_is_rejected(self):
+        token = str(self.upload().token)
+        self.sync(self.entry('day-1', start_photo_upload=token))
+        result = self.sync(self.entry('day-1', days_ago=2, start_photo_upload=token))[0]
+        self.assertEqual(result['errors'], ['idempotency_key was already used for another request.'])
+        self.assertEqual(MileageRecord.objects.count(), 1)
+
+    def test_invalid_entries_do_not_block_the_rest(self):
+        token = str(self.upload().token)
+        results = self.sync(
+            self.entry('day-1', start_photo_upload=token),
+            self.entry('day-2', days_ago=2, start_photo_upload='not-a-token'),
+            self.entry('day-3', days_ago=-1, start_photo_upload=token),
+        )
+        self.assertEqual([result['result'] for result in results], ['created', 'error', 'error'])
+        self.assertEqual(results[1]['errors'], ['Upload not-a-token is not finished or unknown.'])
+        self.assertEqual(results[2]['errors'], ['Date cannot be in the future.'])
+        self.assertEqual(MileageRecord.objects.count(), 1)
+
+    def test_oversized_batch_is_rejected(self):
+        entries = [self.entry(f'day-{i}') for i in range(sync.MAX_BATCH + 1)]
+        response = self.client.post('/mileage/sync/', {'entries': entries}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
@@ -0,0 +1,141 @@
+"""
+Concurrent photo uploads.
+
+Each upload to remote storage (Cloudinary in production) is a network
+round-trip, so the photos of one submission are pushed on a small thread
+pool instead of one after another. Photos are stored content-addressed
+(see blobs.py), so content that is already stored is not sent again.
+Threads only talk to the storage backend, never to the database.
+"""
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import transaction
+
+from jobs.queue import enqueue_many
+from . import blobs, exif
+from .models import ChunkedUpload, MileageRecord, MileageImage
+
+UPLOAD_WORKERS = 4
+MAX_IMAGE_SIZE = 5 * 1024 * 1024
+
+
+def uploaded_photos(request):
+    """New start/end photos in the request, keyed by MileageRecord field name"""
+    return {name: request.FILES[name] for name in ('start_photo', 'end_photo') if name in request.FILES}
+
+
+def extra_images(request):
+    """Additional images from the request that pass the basic type and size checks"""
+    return [
+        img for img in request.FILES.getlist('images')
+        if img.content_type.startswith('image/') and img.size <= MAX_IMAGE_SIZE
+    ]
+
+
+def finished_uploads(user, tokens):
+    """{token: ChunkedUpload} for the user's finished chunked uploads among `tokens`"""
+    valid = set()
+    for token in tokens:
+        try:
+            valid.add(uuid.UUID(str(token)))
+        except (TypeError, ValueError, AttributeError):
+            continue
+    if not valid:
+        return {}
+    uploads = ChunkedUpload.objects.filter(user=user, token__in=valid, status='COMPLETE')
+    return {str(upload.token): upload for upload in uploads}
+
+
+def claimed_uploads(request):
+    """
+    Finished chunked uploads (see chunked.py) the request refers to by
+    token: ({field_name: ChunkedUpload}, [ChunkedUpload for extra images]).
+    Unknown, unfinished and other users' tokens are ignored.
+    """
+    fields = {name: request.POST.get(f'{name}_upload') for name in ('start_photo', 'end_photo')}
+    images = request.POST.getlist('image_uploads')
+    found = finished_uploads(request.user, [*fields.values(), *images])
+    claimed = {name: found[token] for name, token in fields.items() if token in found}
+    return claimed, [found[token] for token in images if token in found]
+
+
+def upload_files(uploads, storage=None, max_workers=UPLOAD_WORKERS):
+    """
+    Store (field, file) pairs in each field's storage (or the given one)
+    and return the stored names in the same order. Only content not
+    stored yet is uploaded, once per distinct hash, on a bounded thread
+    pool. The rows saving these names take the blob references.
+    """
+    hashes = [blobs.content_hash(content) for _, content in uploads]
+    names = blobs.existing(hashes)
+
+    pending = {}
+    for upload, sha256 in zip(uploads, hashes):
+        if sha256 not in names:
+            pending.setdefault(sha256, upload)
+    pending = list(pending.items())
+
+    def save(item):
+        sha256, (field, content) = item
+        target = storage or field.storage
+        return target.save(blobs.blob_name(sha256, content.name), content, max_length=field.max_length)
+
+    if len(pending) <= 1:
+        stored = [save(item) for item in pending]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(pending))) as pool:
+            stored = list(pool.map(save, pending))
+
+    for (sha256, (field, content)), name in zip(pending, stored):
+        names[sha256] = blobs.register(sha256, name, content.size, storage or field.storage)
+    return [names[sha256] for sha256 in hashes]
+
+
+def upload_photos(photos, images, storage=None, max_workers=UPLOAD_WORKERS):
+    """
+    Upload new record photos ({field_name: file}) and additional images
+    together. Returns ({field_name: stored name}, [stored image names],
+    {stored name: EXIF capture metadata}).
+    """
+    uploads = [(MileageRecord._meta.get_field(name), content) for name, content in photos.items()]
+    uploads += [(MileageImage._meta.get_field('image'), content) for content in images]
+    # Header-only read, before the files are handed to the upload threads
+    captures = [exif.read(content) for _, content in uploads]
+    names = upload_files(uploads, storage, max_workers)
+    metadata = {name: capture for name, capture in zip(names, captures) if capture}
+    return dict(zip(photos, names)), names[len(photos):], metadata
+
+
+def receive_photos(request, claimed):
+    """
+    upload_photos() for the request's files, with the finished chunked
+    uploads from claimed_uploads() merged in. Same return value.
+    """
+    photo_names, image_names, metadata = upload_photos(uploaded_photos(request), extra_images(request))
+    claimed_photos, claimed_images = claimed
+    for name, upload in claimed_photos.items():
+        photo_names.setdefault(name, upload.stored_name)
+    image_names += [upload.stored_name for upload in claimed_images]
+    for upload in [*claimed_photos.values(), *claimed_images]:
+        if upload.metadata:
+            metadata.setdefault(upload.stored_name, upload.metadata)
+    return photo_names, image_names, metadata
+
+
+def attach_images(record, names, metadata=None):
+    """
+    Insert MileageImage rows for already stored images, queue their
+    derivatives and save the capture metadata of the record's uploads.
+    """
+    images = []
+    if names:
+        # bulk_create skips MileageImage.save, so take the blob references here
+        with transaction.atomic():
+            images = MileageImage.objects.bulk_create([MileageImage(record=record, image=name) for name in names])
+            blobs.acquire(names)
+        enqueue_many('mileage.build_derivatives', [
+            {'model': 'image', 'pk': image.pk, 'fields': ['image']} for image in images
+        ])
+    exif.store(record, images, metadata or {})
+    return images
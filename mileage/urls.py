@@ -1,9 +1,15 @@
 from django.urls import path
-from .views import submit_mileage, dashboard, edit_mileage, change_status
+from .views import submit_mileage, dashboard, export_mileage, edit_mileage, change_status, upload_start, upload_chunk, autosave_draft, sync_entries, record_history
 
 urlpatterns = [
     path('submit/', submit_mileage, name='submit'),
     path('dashboard/', dashboard, name='dashboard'),
+    path('export/', export_mileage, name='export_mileage'),
+    path('draft/', autosave_draft, name='autosave_draft'),
+    path('sync/', sync_entries, name='sync_entries'),
+    path('uploads/', upload_start, name='upload_start'),
+    path('uploads/<uuid:token>/', upload_chunk, name='upload_chunk'),
     path('edit/<int:record_id>/', edit_mileage, name='edit_mileage'),
+    path('history/<int:record_id>/', record_history, name='record_history'),
     path('change-status/<int:record_id>/', change_status, name='change_status'),
 ]
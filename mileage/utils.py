@@ -1,6 +1,25 @@
-from PIL import Image
+import os
+from PIL import Image, ImageOps
 from io import BytesIO
+from datetime import date
 from django.core.files.base import ContentFile
+from django.db.models import Q, Prefetch, Count, Sum
+from accounts.roles import roles_for
+
+DASHBOARD_PAGE_SIZE = 50
+
+# Derivatives written next to every uploaded photo: (suffix, max size, JPEG quality)
+THUMBNAIL = ('thumb', (240, 240), 70)
+DISPLAY = ('display', (1600, 1600), 80)
+
+# Columns the dashboard table actually renders
+DASHBOARD_RECORD_FIELDS = (
+    'id', 'date', 'start_km', 'end_km', 'distance', 'status',
+    'submission_status', 'edit_count', 'photo_match', 'capture_mismatch', 'start_photo', 'end_photo',
+    'start_photo_thumb', 'start_photo_display', 'end_photo_thumb', 'end_photo_display',
+    'trainer__id', 'trainer__username', 'trainer__first_name', 'trainer__last_name',
+)
+
 
 def compress_image(image):
     img = Image.open(image)
@@ -9,5 +28,158 @@ def compress_image(image):
     return ContentFile(buffer.getvalue())
 
 def is_supervisor(user):
-    return user.groups.filter(name='Supervisor').exists()
+    return roles_for(user).is_supervisor
+
+
+def _encode_jpeg(img, quality):
+    buffer = BytesIO()
+    img.save(buffer, format='JPEG', quality=quality, optimize=True)
+    return ContentFile(buffer.getvalue())
+
+
+def build_derivatives(field_file):
+    """
+    Write a thumbnail and a capped-resolution display copy next to an
+    uploaded image and return their storage names as (thumb, display).
+    The photo is decoded once; for JPEGs draft() lets the decoder scale
+    down while decoding instead of producing the full camera resolution.
+    Returns None if the file cannot be decoded as an image.
+    """
+    base = os.path.splitext(field_file.name)[0]
+    # Storage errors propagate so a background job can retry them
+    field_file.open('rb')
+    data = BytesIO(field_file.read())
+    field_file.close()
+
+    try:
+        with Image.open(data) as img:
+            img.draft('RGB', DISPLAY[1])
+            img = ImageOps.exif_transpose(img).convert('RGB')
+        img.thumbnail(DISPLAY[1])
+        display = _encode_jpeg(img, DISPLAY[2])
+        img.thumbnail(THUMBNAIL[1])
+        thumb = _encode_jpeg(img, THUMBNAIL[2])
+    except (OSError, Image.DecompressionBombError):
+        return None
+
+    storage = field_file.storage
+    return (
+        storage.save(f'{base}_{THUMBNAIL[0]}.jpg', thumb),
+        storage.save(f'{base}_{DISPLAY[0]}.jpg', display),
+    )
+
+
+def derivatives_stale(instance, field_name):
+    """True if the image field has an upload without derivatives made from it"""
+    original = getattr(instance, field_name)
+    thumb = getattr(instance, f'{field_name}_thumb')
+    if not original:
+        return False
+    return not (thumb and thumb.name.startswith(f'{os.path.splitext(original.name)[0]}_{THUMBNAIL[0]}'))
+
+
+def refresh_derivatives(instance, field_names):
+    """
+    Build derivatives for each image field whose upload has none yet (or
+    only ones made from a previous upload) and store their names on the
+    instance without going through save() again.
+    """
+    from .blobs import UNDECODABLE, known_derivatives, remember_derivatives, remember_undecodable
+
+    changes = {}
+    for field_name in field_names:
+        if not derivatives_stale(instance, field_name):
+            continue
+        original = getattr(instance, field_name)
+        # Photos shared through a blob only need their derivatives built once
+        names = known_derivatives(original.name)
+        if names is UNDECODABLE:
+            continue
+        if names is None:
+            names = build_derivatives(original)
+            if names is None:
+                # Not a decodable image: pages fall back to the original, and it is not tried again
+                remember_undecodable(original.name)
+                continue
+            remember_derivatives(original.name, *names)
+        thumb_name, display_name = names
+        changes[f'{field_name}_thumb'] = thumb_name
+        changes[f'{field_name}_display'] = display_name
+
+    if changes:
+        for field_name, name in changes.items():
+            getattr(instance, field_name).name = name
+        type(instance).objects.filter(pk=instance.pk).update(**changes)
+
+
+def derivative_url(derivative, original):
+    """URL of the derivative if one exists, else of the original file"""
+    if derivative:
+        return derivative.url
+    if original:
+        return original.url
+    return ''
+
+
+def encode_cursor(record):
+    """Build the keyset cursor pointing just after the given record"""
+    return f"{record.date.isoformat()}_{record.id}"
+
+
+def decode_cursor(cursor):
+    """Parse a cursor into (date, id), or None if it is missing or malformed"""
+    if not cursor:
+        return None
+    try:
+        date_part, id_part = cursor.split('_', 1)
+        return date.fromisoformat(date_part), int(id_part)
+    except ValueError:
+        return None
+
+
+def dashboard_queryset(records, cursor=None):
+    """Order, project and seek the dashboard records for the given cursor"""
+    from .models import MileageImage
+
+    records = records.select_related('trainer').only(*DASHBOARD_RECORD_FIELDS).prefetch_related(
+        Prefetch('images', queryset=MileageImage.objects.only('id', 'record_id', 'image', 'image_thumb', 'image_display').order_by('id'))
+    ).order_by('-date', '-id')
+
+    position = decode_cursor(cursor)
+    if position:
+        last_date, last_id = position
+        records = records.filter(Q(date__lt=last_date) | Q(date=last_date, id__lt=last_id))
+    return records
+
+
+def dashboard_page(records, cursor=None, page_size=DASHBOARD_PAGE_SIZE):
+    """
+    Return one page of dashboard records (newest first) and the cursor for
+    the next page. Paging seeks on (date, id) instead of using OFFSET, so
+    every page costs the same regardless of how much history exists.
+    """
+    records = dashboard_queryset(records, cursor)
+
+    # Fetch one extra row to know whether another page exists
+    page = list(records[:page_size + 1])
+    next_cursor = encode_cursor(page[page_size - 1]) if len(page) > page_size else None
+    return page[:page_size], next_cursor
+
 
+def dashboard_summary(records):
+    """
+    Compute the dashboard summary cards for the (already filtered) records
+    in a single conditional-aggregation query.
+    """
+    summary = records.order_by().aggregate(
+        total_records=Count('id'),
+        ok_count=Count('id', filter=Q(status='OK')),
+        warning_count=Count('id', filter=Q(status='WARNING')),
+        alert_count=Count('id', filter=Q(status='ALERT')),
+        draft_count=Count('id', filter=Q(submission_status='DRAFT')),
+        submitted_count=Count('id', filter=Q(submission_status='SUBMITTED')),
+        active_trainers=Count('trainer', distinct=True),
+        total_km=Sum('distance'),
+    )
+    summary['total_km'] = summary['total_km'] or 0
+    return summary
@@ -1,14 +1,22 @@
+import csv
+import json
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponseForbidden
+from django.http import HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_http_methods
 from datetime import date
 
 from .forms import MileageForm
 from .models import MileageRecord, MileageImage
 from accounts.utils import is_trainer
-from .utils import is_supervisor
+from .utils import is_supervisor, dashboard_page, dashboard_summary
+from .uploads import claimed_uploads, receive_photos
+from . import chunked, history, services, sync
+from .idempotency import idempotent, remember
+from .models import ChunkedUpload
 
 from accounts.utils import is_admin
+from accounts.roles import roles_for
 from accounts.models import TrainerProfile
 
 
@@ -18,286 +26,180 @@ from django.contrib import messages
 
 
 @login_required
+@idempotent('submit')
 def submit_mileage(request):
     today = date.today()
-    
-    # Check if there's an existing draft for today
-    existing_draft = MileageRecord.objects.filter(
-        trainer=request.user,
-        date=today,
-        submission_status='DRAFT'
-    ).first()
-    
-    # Check if there's already a submitted record for today
-    existing_submitted = MileageRecord.objects.filter(
-        trainer=request.user,
-        date=today,
-        submission_status='SUBMITTED'
-    ).first()
-    
-    if existing_submitted:
-        return render(request, 'mileage/already_submitted.html', {
-            'latest_submission': existing_submitted
-        })
 
     if request.method == 'POST':
         action = request.POST.get('action', 'submit')
         # Don't use instance for POST requests since we handle data manually
         form = MileageForm(request.POST, request.FILES)
-        
-        if action == 'save':
-            # For Save: start_km and start_photo required; optionally save end_km and end_photo if provided
-            start_km = request.POST.get('start_km')
-            end_km = request.POST.get('end_km')
-            start_photo = request.FILES.get('start_photo') if 'start_photo' in request.FILES else (existing_draft.start_photo if existing_draft else None)
-            end_photo = request.FILES.get('end_photo') if 'end_photo' in request.FILES else (existing_draft.end_photo if existing_draft else None)
-            
-            # Validate save requirements
-            errors = []
-            if not start_km:
-                errors.append('Start KM is required.')
-            else:
-                try:
-                    start_km_value = int(float(start_km))
-                    if start_km_value < 0:
-                        errors.append('Start KM cannot be negative.')
-                except ValueError:
-                    errors.append('Start KM must be a valid number.')
-            
-            if not start_photo:
-                errors.append('Start Photo is required.')
-            
+
+        if action in (services.SAVE, services.SUBMIT):
+            start_km, end_km, errors = services.validate(action, request.POST.get('start_km'), request.POST.get('end_km'))
             if errors:
                 for error in errors:
                     messages.error(request, error)
                 return render(request, 'mileage/submit.html', {'form': form})
-            
-            # Save as draft (include optional end_km/end_photo if provided)
-            if existing_draft:
-                # Update existing draft
-                existing_draft.start_km = int(float(start_km))
-                if end_km:
-                    try:
-                        existing_draft.end_km = int(float(end_km))
-                    except ValueError:
-                        pass
-                if 'start_photo' in request.FILES:
-                    existing_draft.start_photo = start_photo
-                if 'end_photo' in request.FILES:
-                    existing_draft.end_photo = end_photo
-                existing_draft.submission_status = 'DRAFT'
-                existing_draft.save()
-                record = existing_draft
-            else:
-                # Create new draft
-                kwargs = {
-                    'trainer': request.user,
-                    'date': today,
-                    'start_km': int(float(start_km)),
-                    'start_photo': start_photo,
-                    'submission_status': 'DRAFT'
-                }
-                if end_km:
-                    try:
-                        kwargs['end_km'] = int(float(end_km))
-                    except ValueError:
-                        pass
-                if end_photo:
-                    kwargs['end_photo'] = end_photo
-
-                record = MileageRecord.objects.create(**kwargs)
-
-            # Handle additional images (multiple)
-            images = request.FILES.getlist('images') if 'images' in request.FILES else []
-            for img in images:
-                # Basic validation
-                if not img.content_type.startswith('image/'):
-                    continue
-                if img.size > 5 * 1024 * 1024:
-                    continue
-                MileageImage.objects.create(record=record, image=img)
-            
-            messages.success(request, 'Mileage saved successfully. You can complete it later.')
-            return render(request, 'mileage/save_success.html', {'record': record})
-            
-        elif action == 'submit':
-            # For Submit: all four fields required
-            start_km = request.POST.get('start_km')
-            end_km = request.POST.get('end_km')
-            start_photo = request.FILES.get('start_photo') if 'start_photo' in request.FILES else (existing_draft.start_photo if existing_draft else None)
-            end_photo = request.FILES.get('end_photo') if 'end_photo' in request.FILES else (existing_draft.end_photo if existing_draft else None)
-            
-            # Validate all required fields for submit
-            errors = []
-            
-            if not start_km:
-                errors.append('Start KM is required for submission.')
-            else:
-                try:
-                    start_km_value = int(float(start_km))
-                    if start_km_value < 0:
-                        errors.append('Start KM cannot be negative.')
-                except ValueError:
-                    errors.append('Start KM must be a valid number.')
-            
-            if not end_km:
-                errors.append('End KM is required for submission.')
-            else:
-                try:
-                    end_km_value = int(float(end_km))
-                    if end_km_value < 0:
-                        errors.append('End KM cannot be negative.')
-                except ValueError:
-                    errors.append('End KM must be a valid number.')
-            
-            if not start_photo:
-                errors.append('Start Photo is required for submission.')
-            
-            if not end_photo:
-                errors.append('End Photo is required for submission.')
-            
-            if errors:
-                for error in errors:
+
+            try:
+                # Reject a repeated submit before uploading anything
+                services.ensure_open(request.user, today)
+                # Upload new photos and extra images concurrently; photos may
+                # also arrive as finished chunked uploads
+                photo_names, image_names, metadata = receive_photos(request, claimed_uploads(request))
+                record = services.submit(request.user, action, start_km, end_km, photo_names, image_names, metadata, today)
+            except services.AlreadySubmitted as e:
+                return render(request, 'mileage/already_submitted.html', {'latest_submission': e.record})
+            except services.SubmissionError as e:
+                for error in e.errors:
                     messages.error(request, error)
                 return render(request, 'mileage/submit.html', {'form': form})
-            
-            # All validations passed, create or update the record
-            try:
-                start_km_value = int(float(start_km))
-                end_km_value = int(float(end_km))
-                
-                if end_km_value <= start_km_value:
-                    messages.error(request, 'End KM must be greater than Start KM.')
-                    return render(request, 'mileage/submit.html', {'form': form})
-                
-                if existing_draft:
-                    # Update existing draft to submitted
-                    existing_draft.start_km = start_km_value
-                    existing_draft.end_km = end_km_value
-                    if 'start_photo' in request.FILES:
-                        existing_draft.start_photo = start_photo
-                    if 'end_photo' in request.FILES:
-                        existing_draft.end_photo = end_photo
-                    existing_draft.submission_status = 'SUBMITTED'
-                    existing_draft.save()
-                    record = existing_draft
-                else:
-                    # Create new submitted record
-                    record = MileageRecord.objects.create(
-                        trainer=request.user,
-                        date=today,
-                        start_km=start_km_value,
-                        end_km=end_km_value,
-                        start_photo=start_photo,
-                        end_photo=end_photo,
-                        submission_status='SUBMITTED'
-                    )
-                
-                messages.success(request, 'Mileage submitted successfully!')
-                # Save any additional images uploaded with submission
-                images = request.FILES.getlist('images') if 'images' in request.FILES else []
-                for img in images:
-                    if not img.content_type.startswith('image/'):
-                        continue
-                    if img.size > 5 * 1024 * 1024:
-                        continue
-                    MileageImage.objects.create(record=record, image=img)
-
-                return render(request, 'mileage/success.html', {'record': record})
-                
             except Exception as e:
                 messages.error(request, f'Error saving record: {str(e)}')
                 return render(request, 'mileage/submit.html', {'form': form})
+
+            if action == services.SAVE:
+                message, template = 'Mileage saved successfully. You can complete it later.', 'mileage/save_success.html'
+            else:
+                message, template = 'Mileage submitted successfully!', 'mileage/success.html'
+            messages.success(request, message)
+            remember(request, record, template, message)
+            return render(request, template, {'record': record})
     else:
-        if existing_draft:
-            form = MileageForm(instance=existing_draft)
-        else:
-            form = MileageForm()
+        # Today's draft or submitted record, if any
+        record = MileageRecord.objects.filter(trainer=request.user, date=today).first()
+        if record and record.submission_status == 'SUBMITTED':
+            return render(request, 'mileage/already_submitted.html', {
+                'latest_submission': record
+            })
+        form = MileageForm(instance=record) if record else MileageForm()
 
     return render(request, 'mileage/submit.html', {'form': form})
 
 
+def _scoped_records(request, roles):
+    """Records the user may see, with the staff trainer/date filters applied"""
+    if roles.is_admin:
+        # Admin users (PM, PRC, GE, IT) see ALL records
+        records = MileageRecord.objects.all()
+    elif roles.is_supervisor:
+        # Supervisors see only their supervised trainers' records
+        records = MileageRecord.objects.filter(
+            trainer__trainerprofile__supervisor=request.user
+        )
+    else:
+        # WTs and regular users only see their own records
+        return MileageRecord.objects.filter(trainer=request.user)
+
+    # Filters from GET (only for staff users)
+    trainer_id = request.GET.get('trainer')
+    date_filter = request.GET.get('date')
+    if trainer_id:
+        records = records.filter(trainer__id=trainer_id)
+    if date_filter:
+        records = records.filter(date=date_filter)
+    if request.GET.get('capture') == 'suspicious':
+        records = records.filter(capture_mismatch=True)
+    return records
+
 
 @login_required
 def dashboard(request):
     # Check user designation for permissions
-    try:
-        profile = request.user.trainerprofile
-        is_admin_user = profile.is_admin()  # PM, PRC, GE, IT
-        is_pum_user = profile.is_pum()
-        is_wt_user = profile.is_wt()
-    except:
-        is_admin_user = is_admin(request.user)
-        is_pum_user = False
-        is_wt_user = False
-    
-    is_supervisor_user = request.user.groups.filter(name='Supervisor').exists()
-    is_staff_user = is_admin_user or is_supervisor_user or is_pum_user
-
-    # Filters from GET (only for staff users)
-    trainer_id = request.GET.get('trainer') if is_staff_user else None
-    date_filter = request.GET.get('date') if is_staff_user else None
+    roles = roles_for(request.user)
+    records = _scoped_records(request, roles)
 
-    # Base queryset based on user permissions
-    if is_admin_user:
-        # Admin users (PM, PRC, GE, IT) see ALL records
-        records = MileageRecord.objects.all().order_by('-date')
-        
-        # Apply filters for admin users
-        if trainer_id:
-            records = records.filter(trainer__id=trainer_id)
-        if date_filter:
-            records = records.filter(date=date_filter)
-        
-        trainers = TrainerProfile.objects.all()
+    if roles.is_admin:
+        trainers = TrainerProfile.objects.select_related('user')
         
         context = {
-            'records': records,
             'trainers': trainers,
-            'is_supervisor': is_supervisor_user,
+            'is_supervisor': roles.is_supervisor,
             'is_staff': True,
-            'is_admin': is_admin_user,
-            'designation': profile.designation if hasattr(request.user, 'trainerprofile') else None,
+            'is_admin': True,
+            'designation': roles.designation,
         }
-    elif is_supervisor_user:
-        # Supervisors see only their supervised trainers' records
-        records = MileageRecord.objects.filter(
-            trainer__trainerprofile__supervisor=request.user
-        ).order_by('-date')
-        
-        # Apply filters
-        if trainer_id:
-            records = records.filter(trainer__id=trainer_id)
-        if date_filter:
-            records = records.filter(date=date_filter)
-        
-        trainers = TrainerProfile.objects.filter(supervisor=request.user)
+    elif roles.is_supervisor:
+        trainers = TrainerProfile.objects.filter(supervisor=request.user).select_related('user')
 
         context = {
-            'records': records,
             'trainers': trainers,
-            'is_supervisor': is_supervisor_user,
+            'is_supervisor': True,
             'is_staff': True,
-            'is_admin': is_admin_user,
+            'is_admin': False,
         }
     else:
-        # WTs and regular users only see their own records
-        records = MileageRecord.objects.filter(
-            trainer=request.user
-        ).order_by('-date')
-
         context = {
-            'records': records,
             'is_staff': False,
-            'is_admin': is_admin_user,
-            'is_wt': is_wt_user,
-            'designation': profile.designation if hasattr(request.user, 'trainerprofile') else None,
+            'is_admin': False,
+            'is_wt': roles.is_wt,
+            'designation': roles.designation,
         }
 
+    # Summary cards are computed in the database, not by loading every row
+    if context['is_staff']:
+        context['summary'] = dashboard_summary(records)
+
+    # Keyset pagination: one page of rows plus the cursor for the next one
+    cursor = request.GET.get('cursor')
+    page, next_cursor = dashboard_page(records, cursor)
+    context['records'] = page
+    context['is_first_page'] = not cursor
+    if next_cursor:
+        query = request.GET.copy()
+        query['cursor'] = next_cursor
+        context['next_page_query'] = query.urlencode()
+    first_query = request.GET.copy()
+    first_query.pop('cursor', None)
+    context['first_page_query'] = first_query.urlencode()
+
     return render(request, 'mileage/dashboard.html', context)
 
 
+class _Echo:
+    """File-like object whose write() hands the line back to csv.writer's caller"""
+    def write(self, value):
+        return value
+
+
 @login_required
+def export_mileage(request):
+    """Stream the dashboard's records, with the same scoping and filters, as CSV"""
+    roles = roles_for(request.user)
+    rows = _scoped_records(request, roles).order_by('-date', '-id').values_list(
+        'date',
+        'trainer__first_name',
+        'trainer__last_name',
+        'trainer__username',
+        'trainer__trainerprofile__pu_code',
+        'trainer__trainerprofile__designation',
+        'start_km',
+        'end_km',
+        'distance',
+        'status',
+        'submission_status',
+    )
+
+    def stream():
+        writer = csv.writer(_Echo())
+        yield writer.writerow(['Date', 'Trainer', 'PU Code', 'Designation', 'Start KM', 'End KM',
+                               'Distance', 'Status', 'Submission Status'])
+        # iterator() fetches in chunks instead of caching the whole result set
+        for (record_date, first_name, last_name, username, pu_code, designation,
+             start_km, end_km, distance, status, submission_status) in rows.iterator(chunk_size=2000):
+            trainer_name = f'{first_name} {last_name}'.strip() or username
+            yield writer.writerow([record_date.isoformat(), trainer_name, pu_code or '', designation or '',
+                                   start_km, end_km if end_km is not None else '',
+                                   distance if distance is not None else '', status or '', submission_status])
+
+    response = StreamingHttpResponse(stream(), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="mileage_{date.today().isoformat()}.csv"'
+    return response
+
+
+@login_required
+@idempotent('edit:{record_id}')
 def edit_mileage(request, record_id):
     try:
         record = MileageRecord.objects.get(id=record_id)
@@ -314,7 +216,7 @@ def edit_mileage(request, record_id):
         messages.error(request, 'You can only edit submitted records.')
         return redirect('dashboard')
 
-    if record.edit_count >= 2:
+    if record.edit_count >= services.MAX_EDITS:
         messages.error(request, 'You have reached the maximum edit limit for this record.')
         return redirect('dashboard')
 
@@ -323,106 +225,180 @@ def edit_mileage(request, record_id):
 
         if action == 'submit':
             # For editing: all four fields required
-            start_km = request.POST.get('start_km')
-            end_km = request.POST.get('end_km')
-            start_photo = request.FILES.get('start_photo') if 'start_photo' in request.FILES else record.start_photo
-            end_photo = request.FILES.get('end_photo') if 'end_photo' in request.FILES else record.end_photo
-
-            # Validate all required fields for submit
-            errors = []
-
-            if not start_km:
-                errors.append('Start KM is required.')
-            else:
-                try:
-                    start_km_value = int(float(start_km))
-                    if start_km_value < 0:
-                        errors.append('Start KM cannot be negative.')
-                except ValueError:
-                    errors.append('Start KM must be a valid number.')
-
-            if not end_km:
-                errors.append('End KM is required.')
-            else:
-                try:
-                    end_km_value = int(float(end_km))
-                    if end_km_value < 0:
-                        errors.append('End KM cannot be negative.')
-                except ValueError:
-                    errors.append('End KM must be a valid number.')
-
-            if not start_photo:
-                errors.append('Start Photo is required.')
-
-            if not end_photo:
-                errors.append('End Photo is required.')
-
+            start_km, end_km, errors = services.validate(services.EDIT, request.POST.get('start_km'), request.POST.get('end_km'))
             if errors:
                 for error in errors:
                     messages.error(request, error)
                 form = MileageForm(instance=record)
                 return render(request, 'mileage/edit.html', {'form': form, 'record': record})
 
-            # All validations passed, update the record
             try:
-                start_km_value = int(float(start_km))
-                end_km_value = int(float(end_km))
-
-                if end_km_value <= start_km_value:
-                    messages.error(request, 'End KM must be greater than Start KM.')
-                    form = MileageForm(instance=record)
-                    return render(request, 'mileage/edit.html', {'form': form, 'record': record})
-
-                # Update the record
-                record.start_km = start_km_value
-                record.end_km = end_km_value
-                if 'start_photo' in request.FILES:
-                    record.start_photo = start_photo
-                if 'end_photo' in request.FILES:
-                    record.end_photo = end_photo
-                record.edit_count += 1
-                record.save()
-
-                # Save any additional images added during edit
-                images = request.FILES.getlist('images') if 'images' in request.FILES else []
-                for img in images:
-                    if not img.content_type.startswith('image/'):
-                        continue
-                    if img.size > 5 * 1024 * 1024:
-                        continue
-                    MileageImage.objects.create(record=record, image=img)
-
-                messages.success(request, f'Mileage updated successfully! You have {2 - record.edit_count} edit(s) remaining.')
+                # Upload new photos and extra images concurrently before saving
+                photo_names, image_names, metadata = receive_photos(request, claimed_uploads(request))
+                record = services.edit(request.user, record.id, start_km, end_km, photo_names, image_names, metadata)
+            except services.EditNotAllowed as e:
+                # Another request used up the edit meanwhile
+                messages.error(request, str(e))
                 return redirect('dashboard')
-
+            except services.SubmissionError as e:
+                for error in e.errors:
+                    messages.error(request, error)
+                form = MileageForm(instance=record)
+                return render(request, 'mileage/edit.html', {'form': form, 'record': record})
             except Exception as e:
                 messages.error(request, f'Error updating record: {str(e)}')
                 form = MileageForm(instance=record)
                 return render(request, 'mileage/edit.html', {'form': form, 'record': record})
+
+            message = f'Mileage updated successfully! You have {services.MAX_EDITS - record.edit_count} edit(s) remaining.'
+            messages.success(request, message)
+            remember(request, record, message=message)
+            return redirect('dashboard')
     else:
         form = MileageForm(instance=record)
 
     return render(request, 'mileage/edit.html', {'form': form, 'record': record})
 
 
+@login_required
+def record_history(request, record_id):
+    """A record's versions with the changed fields, and the full state of any past version"""
+    record = _scoped_records(request, roles_for(request.user)).filter(id=record_id).first()
+    if record is None:
+        messages.error(request, 'Record not found.')
+        return redirect('dashboard')
+
+    entries = history.timeline(record)
+    try:
+        selected = int(request.GET.get('version', len(entries) - 1))
+    except ValueError:
+        selected = len(entries) - 1
+    selected = min(max(selected, 0), len(entries) - 1)
+
+    labels = {field: MileageRecord._meta.get_field(field).verbose_name.title() for field in history.TRACKED_FIELDS}
+    return render(request, 'mileage/history.html', {
+        'record': record,
+        'versions': [
+            {
+                'number': number,
+                'version': version,
+                'changes': [(labels[field], old, new) for field, (old, new) in version.changes.items()] if version else [],
+            }
+            for number, (version, _) in enumerate(entries)
+        ],
+        'selected': selected,
+        'state': [(labels[field], value) for field, value in entries[selected][1].items()],
+    })
+
+
+@login_required
+@require_http_methods(['POST'])
+def autosave_draft(request):
+    """Patch today's draft KM values from a JSON body, without photos or a page render"""
+    try:
+        values = json.loads(request.body or b'{}')
+    except ValueError:
+        values = None
+    if not isinstance(values, dict):
+        return JsonResponse({'errors': ['Expected a JSON object.']}, status=400)
+
+    try:
+        record, changed = services.autosave(
+            request.user, {field: values[field] for field in services.AUTOSAVE_FIELDS if field in values},
+        )
+    except services.DraftNotFound:
+        return JsonResponse({'errors': ['Save a draft with a start photo first.']}, status=404)
+    except services.SubmissionError as e:
+        return JsonResponse({'errors': e.errors}, status=400)
+
+    return JsonResponse({
+        'changed': changed,
+        'start_km': record.start_km,
+        'end_km': record.end_km,
+        'distance': record.distance,
+        'status': record.status,
+    })
+
+
+@login_required
+@require_http_methods(['POST'])
+def sync_entries(request):
+    """Apply a batch of day entries queued offline; one result per entry (see sync.py)"""
+    try:
+        body = json.loads(request.body or b'{}')
+    except ValueError:
+        body = None
+    entries = body.get('entries') if isinstance(body, dict) else None
+    if not isinstance(entries, list):
+        return JsonResponse({'errors': ['Expected a JSON object with an entries list.']}, status=400)
+    if len(entries) > sync.MAX_BATCH:
+        return JsonResponse({'errors': [f'At most {sync.MAX_BATCH} entries can be synced at once.']}, status=400)
+
+    return JsonResponse({'results': sync.sync(request.user, entries)})
+
+
+def _upload_state(upload):
+    return {
+        'token': str(upload.token),
+        'offset': upload.offset,
+        'size': upload.size,
+        'complete': upload.status == 'COMPLETE',
+    }
+
+
+@login_required
+@require_http_methods(['POST'])
+def upload_start(request):
+    """Begin (or resume) a chunked photo upload; see chunked.py"""
+    try:
+        size = int(request.POST.get('size', ''))
+    except ValueError:
+        return JsonResponse({'error': 'size must be a number of bytes.'}, status=400)
+    try:
+        upload = chunked.start(request.user, request.POST.get('filename', 'photo.jpg'), size, request.POST.get('sha256', ''))
+    except chunked.UploadError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
+    return JsonResponse(_upload_state(upload), status=201 if upload.offset == 0 and upload.status == 'ACTIVE' else 200)
+
+
+@login_required
+@require_http_methods(['GET', 'PUT'])
+def upload_chunk(request, token):
+    """GET: how much of the upload arrived. PUT: append the body at the Upload-Offset header"""
+    upload = ChunkedUpload.objects.filter(token=token, user=request.user).first()
+    if upload is None or upload.status == 'FAILED':
+        return JsonResponse({'error': 'Unknown upload.'}, status=404)
+    if request.method == 'PUT':
+        try:
+            offset = int(request.headers.get('Upload-Offset', ''))
+        except ValueError:
+            return JsonResponse({'error': 'Upload-Offset header is required.'}, status=400)
+        try:
+            upload = chunked.append(upload, offset, request)
+        except chunked.UploadError as e:
+            upload.refresh_from_db()
+            return JsonResponse({'error': str(e), **_upload_state(upload)}, status=e.status)
+    return JsonResponse(_upload_state(upload))
+
+
 @login_required
 def change_status(request, record_id):
     # Only admins may change the status
     if not is_admin(request.user):
         return HttpResponseForbidden('Not allowed')
 
-    try:
-        record = MileageRecord.objects.get(id=record_id)
-    except MileageRecord.DoesNotExist:
+    if not MileageRecord.objects.filter(id=record_id).exists():
         messages.error(request, 'Record not found.')
         return redirect('dashboard')
 
     if request.method == 'POST':
         new_status = request.POST.get('status')
         if new_status in dict(MileageRecord.STATUS_CHOICES).keys():
-            record.status = new_status
-            record.save()
-            messages.success(request, f'Status updated to {new_status} for record {record.id}.')
+            record = services.change_status(request.user, record_id, new_status)
+            if record is None:
+                messages.error(request, 'Record not found.')
+            else:
+                messages.success(request, f'Status updated to {new_status} for record {record.id}.')
         else:
             messages.error(request, 'Invalid status selected.')
 
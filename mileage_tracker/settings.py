@@ -29,6 +29,7 @@ INSTALLED_APPS = [
     "django.contrib.staticfiles",
     'accounts',
     'mileage',
+    'jobs',
     'cloudinary_storage',
     'cloudinary',
 ]
@@ -40,6 +41,7 @@ MIDDLEWARE = [
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "accounts.roles.RolesMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -80,6 +82,19 @@ if 'DATABASE_URL' in os.environ:
         conn_health_checks=True,
     )
 
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    # Login/verification throttle buckets, shared by every web process;
+    # create the table with `python manage.py createcachetable`
+    "throttle": {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "throttle_cache",
+        "OPTIONS": {"MAX_ENTRIES": 50000},
+    },
+}
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -96,6 +111,18 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Email/password login (custom_login); username logins fall through to ModelBackend
+AUTHENTICATION_BACKENDS = [
+    "accounts.backends.EmailBackend",
+]
+
+# Cache alias holding login/verification throttle buckets (accounts/throttle.py), shared by all processes
+THROTTLE_CACHE = "throttle"
+
+# Reverse proxies in front of the app that append the address they saw to
+# X-Forwarded-For (the Heroku router is one); see accounts.throttle.client_ip
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', 1 if 'DYNO' in os.environ else 0))
+
 # Cloudinary settings (if using cloud storage)
 import cloudinary
 import cloudinary_storage
@@ -123,6 +150,9 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Chunked photo uploads are spooled here until complete; must be shared by all web processes
+UPLOAD_SPOOL_DIR = os.environ.get('UPLOAD_SPOOL_DIR', BASE_DIR / 'upload_spool')
+
 # Email settings
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = 'smtp.gmail.com'